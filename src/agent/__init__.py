@@ -140,6 +140,8 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['num_ensem_comps'] = args.num_ensem_comps
             agent = SacMlpSSEnsembleAgent(**kwargs)
         elif args.algo == 'sac_mlp':
+            kwargs['fused_update'] = args.sac_fused_update
+            kwargs['num_critics'] = args.sac_num_critics
             agent = SacMlpAgent(**kwargs)
         elif args.algo == 'ewc_sac_mlp':
             kwargs['ewc_lambda'] = args.sac_ewc_lambda
@@ -147,10 +149,12 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_batch_size'] = args.sac_ewc_estimate_fisher_batch_size
             kwargs['online_ewc'] = args.sac_online_ewc
             kwargs['online_ewc_gamma'] = args.sac_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.sac_ewc_fisher_chunk_size
             agent = EwcSacMlpAgent(**kwargs)
         elif args.algo == 'si_sac_mlp':
             kwargs['si_c'] = args.sac_si_c
             kwargs['si_epsilon'] = args.sac_si_epsilon
+            kwargs['si_accumulate_freq'] = args.sac_si_accumulate_freq
             agent = SiSacMlpAgent(**kwargs)
         elif args.algo == 'agem_sac_mlp':
             kwargs['agem_memory_budget'] = args.sac_agem_memory_budget
@@ -170,6 +174,7 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_batch_size'] = args.sac_ewc_estimate_fisher_batch_size
             kwargs['online_ewc'] = args.sac_online_ewc
             kwargs['online_ewc_gamma'] = args.sac_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.sac_ewc_fisher_chunk_size
             agent = EwcMultiHeadSacMlpAgent(**kwargs)
         elif args.algo == 'ewc_mh_sac_mlp_v2':
             kwargs['ewc_lambda'] = args.sac_ewc_lambda
@@ -177,6 +182,7 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_batch_size'] = args.sac_ewc_estimate_fisher_batch_size
             kwargs['online_ewc'] = args.sac_online_ewc
             kwargs['online_ewc_gamma'] = args.sac_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.sac_ewc_fisher_chunk_size
             agent = EwcMultiHeadSacMlpAgentV2(**kwargs)
         elif args.algo == 'ewc_v2_mh_sac_mlp_v2':
             kwargs['ewc_lambda'] = args.sac_ewc_lambda
@@ -184,6 +190,7 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_rollout_steps'] = args.sac_ewc_estimate_fisher_rollout_steps
             kwargs['online_ewc'] = args.sac_online_ewc
             kwargs['online_ewc_gamma'] = args.sac_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.sac_ewc_fisher_chunk_size
             agent = EwcV2MultiHeadSacMlpAgentV2(**kwargs)
         elif args.algo == 'ewc_v2_mi_sac_mlp_v2':
             kwargs['ewc_lambda'] = args.sac_ewc_lambda
@@ -191,18 +198,22 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_rollout_steps'] = args.sac_ewc_estimate_fisher_rollout_steps
             kwargs['online_ewc'] = args.sac_online_ewc
             kwargs['online_ewc_gamma'] = args.sac_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.sac_ewc_fisher_chunk_size
             agent = EwcV2MultiInputSacMlpAgentV2(**kwargs)
         elif args.algo == 'si_mh_sac_mlp':
             kwargs['si_c'] = args.sac_si_c
             kwargs['si_epsilon'] = args.sac_si_epsilon
+            kwargs['si_accumulate_freq'] = args.sac_si_accumulate_freq
             agent = SiMultiHeadSacMlpAgent(**kwargs)
         elif args.algo == 'si_mh_sac_mlp_v2':
             kwargs['si_c'] = args.sac_si_c
             kwargs['si_epsilon'] = args.sac_si_epsilon
+            kwargs['si_accumulate_freq'] = args.sac_si_accumulate_freq
             agent = SiMultiHeadSacMlpAgentV2(**kwargs)
         elif args.algo == 'si_mi_sac_mlp_v2':
             kwargs['si_c'] = args.sac_si_c
             kwargs['si_epsilon'] = args.sac_si_epsilon
+            kwargs['si_accumulate_freq'] = args.sac_si_accumulate_freq
             agent = SiMultiInputSacMlpAgentV2(**kwargs)
         elif args.algo == 'agem_mh_sac_mlp':
             kwargs['agem_memory_budget'] = args.sac_agem_memory_budget
@@ -247,20 +258,24 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_epochs'] = args.ppo_ewc_estimate_fisher_epochs
             kwargs['online_ewc'] = args.ppo_online_ewc
             kwargs['online_ewc_gamma'] = args.ppo_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.ppo_ewc_fisher_chunk_size
             agent = EwcPpoMlpAgent(**kwargs)
         elif args.algo == 'ewc_ppo_mlp_v2':
             kwargs['ewc_lambda'] = args.ppo_ewc_lambda
             kwargs['ewc_estimate_fisher_epochs'] = args.ppo_ewc_estimate_fisher_epochs
             kwargs['online_ewc'] = args.ppo_online_ewc
             kwargs['online_ewc_gamma'] = args.ppo_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.ppo_ewc_fisher_chunk_size
             agent = EwcPpoMlpAgentV2(**kwargs)
         elif args.algo == 'si_ppo_mlp':
             kwargs['si_c'] = args.ppo_si_c
             kwargs['si_epsilon'] = args.ppo_si_epsilon
+            kwargs['si_accumulate_freq'] = args.ppo_si_accumulate_freq
             agent = SiPpoMlpAgent(**kwargs)
         elif args.algo == 'si_ppo_mlp_v2':
             kwargs['si_c'] = args.ppo_si_c
             kwargs['si_epsilon'] = args.ppo_si_epsilon
+            kwargs['si_accumulate_freq'] = args.ppo_si_accumulate_freq
             agent = SiPpoMlpAgentV2(**kwargs)
         elif args.algo == 'agem_ppo_mlp':
             kwargs['agem_memory_budget'] = args.ppo_agem_memory_budget
@@ -286,20 +301,24 @@ def make_agent(obs_space, action_space, device, args):
             kwargs['ewc_estimate_fisher_epochs'] = args.ppo_ewc_estimate_fisher_epochs
             kwargs['online_ewc'] = args.ppo_online_ewc
             kwargs['online_ewc_gamma'] = args.ppo_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.ppo_ewc_fisher_chunk_size
             agent = EwcMultiHeadPpoMlpAgent(**kwargs)
         elif args.algo == 'ewc_mh_ppo_mlp_v2':
             kwargs['ewc_lambda'] = args.ppo_ewc_lambda
             kwargs['ewc_estimate_fisher_epochs'] = args.ppo_ewc_estimate_fisher_epochs
             kwargs['online_ewc'] = args.ppo_online_ewc
             kwargs['online_ewc_gamma'] = args.ppo_online_ewc_gamma
+            kwargs['ewc_fisher_chunk_size'] = args.ppo_ewc_fisher_chunk_size
             agent = EwcMultiHeadPpoMlpAgentV2(**kwargs)
         elif args.algo == 'si_mh_ppo_mlp':
             kwargs['si_c'] = args.ppo_si_c
             kwargs['si_epsilon'] = args.ppo_si_epsilon
+            kwargs['si_accumulate_freq'] = args.ppo_si_accumulate_freq
             agent = SiMultiHeadPpoMlpAgent(**kwargs)
         elif args.algo == 'si_mh_ppo_mlp_v2':
             kwargs['si_c'] = args.ppo_si_c
             kwargs['si_epsilon'] = args.ppo_si_epsilon
+            kwargs['si_accumulate_freq'] = args.ppo_si_accumulate_freq
             agent = SiMultiHeadPpoMlpAgentV2(**kwargs)
         elif args.algo == 'agem_mh_ppo_mlp':
             kwargs['agem_memory_budget'] = args.ppo_agem_memory_budget
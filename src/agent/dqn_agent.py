@@ -3,6 +3,7 @@ import torch
 import torch.nn.functional as F
 
 import utils
+from buffers import PrioritizedReplayBuffer
 from agent.utils import get_linear_fn
 
 from agent.network import DqnCnnSSFwdPredictorEnsem, DqnCnnSSInvPredictorEnsem, \
@@ -108,7 +109,7 @@ class DqnCnnAgent:
         self.exploration_rate = self.exploration_schedule(1.0 - float(step) / float(total_steps))
         logger.log('train/exploration_rate', self.exploration_rate, step)
 
-    def update_q_net(self, obs, action, reward, next_obs, not_done, logger, step):
+    def update_q_net(self, obs, action, reward, next_obs, not_done, logger, step, weights=None):
         with torch.no_grad():
             # compute the next Q-values using the target network
             next_q_values = self.target_q_net(next_obs)
@@ -131,7 +132,11 @@ class DqnCnnAgent:
         current_q_values = torch.gather(current_q_values, dim=1, index=action.long())
 
         # Huber loss (less sensitive to outliers)
-        q_net_loss = F.smooth_l1_loss(current_q_values, target_q_values)
+        if weights is None:
+            q_net_loss = F.smooth_l1_loss(current_q_values, target_q_values)
+        else:
+            # importance weighted for prioritized replay
+            q_net_loss = (weights * F.smooth_l1_loss(current_q_values, target_q_values, reduction='none')).mean()
 
         logger.log('train/q_net_loss', q_net_loss, step)
 
@@ -143,12 +148,21 @@ class DqnCnnAgent:
         torch.nn.utils.clip_grad_norm_(self.q_net.parameters(), self.max_grad_norm)
         self.q_net_optimizer.step()
 
+        return (current_q_values - target_q_values).abs().detach()
+
     def update(self, replay_buffer, logger, step):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        if isinstance(replay_buffer, PrioritizedReplayBuffer):
+            obs, action, reward, next_obs, not_done, weights, idxs = replay_buffer.sample(
+                self.batch_size, return_weights=True)
+        else:
+            obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+            weights = None
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        self.update_q_net(obs, action, reward, next_obs, not_done, logger, step)
+        td_error = self.update_q_net(obs, action, reward, next_obs, not_done, logger, step, weights=weights)
+        if weights is not None:
+            replay_buffer.update_priorities(idxs, td_error)
 
         # if step % self.target_update_interval == 0:
         #     utils.soft_update_params(self.q_net, self.target_q_net, self.q_net_tau)
@@ -257,7 +271,7 @@ class DqnCnnSSEnsembleAgent(DqnCnnAgent):
                 preds = self.ss_inv_pred_ensem(obs, next_obs)
 
             # (chongyi zheng): the same as equation (1) in https://arxiv.org/abs/1906.04161
-            preds = torch.stack(preds.chunk(self.num_ensem_comps, dim=0))
+            preds = preds.view(self.num_ensem_comps, -1, preds.size(-1))
             preds_var = torch.var(preds, dim=0).sum(dim=-1)
 
             return utils.to_np(preds_var)
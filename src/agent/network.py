@@ -8,7 +8,7 @@ from collections import OrderedDict
 
 
 from src.agent.encoder import PixelEncoder, DqnEncoder
-from src.utils import weight_init, SquashedNormal, gaussian_logprob, squash, DiagGaussian
+from src.utils import weight_init, SquashedNormal, gaussian_logprob, squash, DiagGaussian, FixedNormal
 
 
 class QFunction(nn.Module):
@@ -42,6 +42,121 @@ class QFunction(nn.Module):
         return self.trunk(obs_action)
 
 
+class MultiHeadMlp(nn.Module):
+    """Per-task MLP heads, evaluated one at a time, per sample or all at once.
+
+    The weights of each layer are stacked as (num_heads, in, out) tensors. The last layer is zero padded to the
+    widest head, separately for each of the num_chunks parts of the output (e.g. mean and log std) so that
+    chunk() lines up across heads. The state_dict uses the keys of a ModuleList of per-head layers, layer_keys
+    are the names of the nn.Linear layers in a head, e.g. ['{}.0', '{}.2'] for an nn.Sequential. The stacked
+    parameters are marked for utils.skip_inactive_heads().
+    """
+    def __init__(self, in_dim, hidden_dims, out_dims, layer_keys, activation=F.relu, num_chunks=1):
+        super().__init__()
+        assert isinstance(out_dims, list)
+        assert len(layer_keys) == len(hidden_dims) + 1
+
+        self.num_heads = len(out_dims)
+        self.out_dims = out_dims
+        self.layer_keys = layer_keys
+        self.activation = activation
+        self.num_chunks = num_chunks
+        self.chunk_dims = [out_dim // num_chunks for out_dim in out_dims]
+        self.max_chunk_dim = max(self.chunk_dims)
+        self.padded = min(self.chunk_dims) < self.max_chunk_dim
+
+        dims = [in_dim] + list(hidden_dims) + [num_chunks * self.max_chunk_dim]
+        self.weights = nn.ParameterList([
+            nn.Parameter(torch.empty(self.num_heads, in_dim, out_dim)) for in_dim, out_dim in zip(dims[:-1], dims[1:])
+        ])
+        self.biases = nn.ParameterList([
+            nn.Parameter(torch.zeros(self.num_heads, 1, out_dim)) for out_dim in dims[1:]
+        ])
+        for param in chain(self.weights, self.biases):
+            param._stacked_heads = True
+        self.reset_parameters()
+
+        self._register_state_dict_hook(self._state_dict_to_heads)
+        self._register_load_state_dict_pre_hook(self._state_dict_from_heads)
+
+    def _unpadded(self, tensor, idx, layer):
+        """View of the entries of head idx in the last dimension of a padded layer output"""
+        if not self.padded or layer < len(self.weights) - 1:
+            return tensor
+        return tensor.view(*tensor.size()[:-1], self.num_chunks, self.max_chunk_dim)[..., :self.chunk_dims[idx]]
+
+    def reset_parameters(self):
+        # weight_init of each nn.Linear in a head
+        with torch.no_grad():
+            for idx in range(self.num_heads):
+                for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+                    head_weight = self._unpadded(weight[idx].zero_(), idx, layer)
+                    head_weight.copy_(nn.init.orthogonal_(
+                        torch.empty(head_weight.numel() // weight.size(1), weight.size(1))
+                    ).t().reshape(head_weight.size()))
+                    bias[idx].fill_(0.0)
+
+    def _head_keys(self, prefix, idx, layer):
+        key = prefix + self.layer_keys[layer].format(idx)
+        return key + '.weight', key + '.bias'
+
+    def _state_dict_to_heads(self, module, state_dict, prefix, local_metadata):
+        for layer in range(len(self.weights)):
+            weight = state_dict.pop('{}weights.{}'.format(prefix, layer))
+            bias = state_dict.pop('{}biases.{}'.format(prefix, layer))
+            for idx in range(self.num_heads):
+                weight_key, bias_key = self._head_keys(prefix, idx, layer)
+                state_dict[weight_key] = self._unpadded(weight[idx], idx, layer).reshape(weight.size(1), -1).t() \
+                    .contiguous()
+                state_dict[bias_key] = self._unpadded(bias[idx, 0], idx, layer).reshape(-1).clone()
+
+        return state_dict
+
+    def _state_dict_from_heads(self, state_dict, prefix, local_metadata, strict,
+                               missing_keys, unexpected_keys, error_msgs):
+        if self._head_keys(prefix, 0, 0)[0] not in state_dict:
+            return
+
+        for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            keys = [self._head_keys(prefix, idx, layer) for idx in range(self.num_heads)]
+            if any(weight_key not in state_dict or bias_key not in state_dict for weight_key, bias_key in keys):
+                # leave the remaining keys to be reported as missing
+                continue
+            stacked_weight = torch.zeros_like(weight)
+            stacked_bias = torch.zeros_like(bias)
+            for idx, (weight_key, bias_key) in enumerate(keys):
+                head_weight = self._unpadded(stacked_weight[idx], idx, layer)
+                head_weight.copy_(state_dict.pop(weight_key).t().reshape(head_weight.size()))
+                head_bias = self._unpadded(stacked_bias[idx, 0], idx, layer)
+                head_bias.copy_(state_dict.pop(bias_key).reshape(head_bias.size()))
+            state_dict['{}weights.{}'.format(prefix, layer)] = stacked_weight
+            state_dict['{}biases.{}'.format(prefix, layer)] = stacked_bias
+
+    def forward(self, x, head_idx):
+        """head_idx: an int, a (batch_size,) tensor of per-sample heads or None for all heads, which returns a
+        (num_heads, batch_size, out) tensor and also takes a (num_heads, batch_size, in) x of one batch per head"""
+        if head_idx is not None and not isinstance(head_idx, torch.Tensor):
+            for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+                x = F.linear(x, weight[head_idx].t(), bias[head_idx, 0])
+                if layer < len(self.weights) - 1:
+                    x = self.activation(x)
+
+            x = self._unpadded(x, head_idx, len(self.weights) - 1)
+            return x.reshape(*x.size()[:-2], -1) if self.padded else x
+
+        assert not self.padded, "heads with different output dims can only be evaluated one at a time"
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.num_heads, *x.size())
+        for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if layer < len(self.weights) - 1:
+                x = self.activation(x)
+
+        if head_idx is None:
+            return x
+        return x[head_idx, torch.arange(x.size(1), device=x.device)]
+
+
 class MultiHeadQFunction(nn.Module):
     """MLP for q-function."""
     def __init__(self, obs_dim, action_dims, hidden_dim):
@@ -59,26 +174,18 @@ class MultiHeadQFunction(nn.Module):
             nn.ReLU(),
         )
 
-        self.heads = torch.nn.ModuleList()
-        for _ in action_dims:
-            self.heads.append(nn.Linear(hidden_dim, 1))
+        self.heads = MultiHeadMlp(hidden_dim, [], [1] * len(action_dims), ['{}'])
 
     def forward(self, obs, action, head_idx):
+        """head_idx: an int, a (batch_size,) tensor or None for the (num_heads, batch_size, 1) q-values of all
+        heads"""
         assert obs.size(0) == action.size(0)
 
-        # pad action with zero if needed
-        if action.shape[-1] < self.max_action_dim:
-            action = torch.cat([
-                action,
-                torch.zeros(
-                    list(action.size()[:-1]) + [self.max_action_dim - action.size[-1]],
-                    device=action.device
-                )
-            ], dim=-1)
-
         obs_action = torch.cat([obs, action], dim=-1)
-        hidden = self.trunk(obs_action)
-        return self.heads[head_idx](hidden)
+        # zero padding the action to max_action_dim only drops the trailing input columns of the first layer
+        hidden = F.linear(obs_action, self.trunk[0].weight[:, :obs_action.size(-1)], self.trunk[0].bias)
+        hidden = self.trunk[1:](hidden)
+        return self.heads(hidden, head_idx)
 
 
 class RotFunction(nn.Module):
@@ -345,11 +452,8 @@ class MultiHeadSacActorMlp(nn.Module):
             nn.ReLU(),
         )
 
-        self.dist_heads = torch.nn.ModuleList()
-        for action_shape in action_shapes:
-            self.dist_heads.append(
-                nn.Linear(hidden_dim, 2 * action_shape[0])
-            )
+        self.dist_heads = MultiHeadMlp(
+            hidden_dim, [], [2 * action_shape[0] for action_shape in action_shapes], ['{}'], num_chunks=2)
 
         self.apply(weight_init)
 
@@ -362,8 +466,9 @@ class MultiHeadSacActorMlp(nn.Module):
             yield elem
 
     def forward(self, obs, head_idx, compute_pi=True, compute_log_pi=True):
+        """head_idx: see MultiHeadMlp.forward"""
         hidden = self.trunk(obs)
-        mu, log_std = self.dist_heads[head_idx](hidden).chunk(2, dim=-1)
+        mu, log_std = self.dist_heads(hidden, head_idx).chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -389,7 +494,7 @@ class MultiHeadSacActorMlp(nn.Module):
 
     def compute_log_probs(self, obs, action, head_idx):
         hidden = self.trunk(obs)
-        mu, log_std = self.dist_heads[head_idx](hidden).chunk(2, dim=-1)
+        mu, log_std = self.dist_heads(hidden, head_idx).chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -421,15 +526,9 @@ class MultiInputSacActorMlp(nn.Module):
             nn.ReLU(),
         )
 
-        self.dist_heads = torch.nn.ModuleList()
-        for action_shape in action_shapes:
-            self.dist_heads.append(nn.Sequential(
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, 2 * action_shape[0]),
-            ))
+        self.dist_heads = MultiHeadMlp(
+            hidden_dim, [hidden_dim, hidden_dim], [2 * action_shape[0] for action_shape in action_shapes],
+            ['{}.0', '{}.2', '{}.4'], num_chunks=2)
 
         self.apply(weight_init)
 
@@ -442,8 +541,9 @@ class MultiInputSacActorMlp(nn.Module):
             yield elem
 
     def forward(self, obs, head_idx, compute_pi=True, compute_log_pi=True):
+        """head_idx: see MultiHeadMlp.forward"""
         hidden = self.trunk(obs)
-        mu, log_std = self.dist_heads[head_idx](hidden).chunk(2, dim=-1)
+        mu, log_std = self.dist_heads(hidden, head_idx).chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -469,7 +569,7 @@ class MultiInputSacActorMlp(nn.Module):
 
     def compute_log_probs(self, obs, action, head_idx):
         hidden = self.trunk(obs)
-        mu, log_std = self.dist_heads[head_idx](hidden).chunk(2, dim=-1)
+        mu, log_std = self.dist_heads(hidden, head_idx).chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -496,23 +596,16 @@ class IndividualSacActorMlp(nn.Module):
         self.log_std_min = log_std_min
         self.log_std_max = log_std_max
 
-        self.dist_heads = torch.nn.ModuleList()
-        for action_shape in action_shapes:
-            self.dist_heads.append(nn.Sequential(
-                nn.Linear(obs_shape[0], hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, 2 * action_shape[0])
-            ))
+        self.dist_heads = MultiHeadMlp(
+            obs_shape[0], [hidden_dim, hidden_dim, hidden_dim], [2 * action_shape[0] for action_shape in action_shapes],
+            ['{}.0', '{}.2', '{}.4', '{}.6'], num_chunks=2)
 
         self.apply(weight_init)
 
     def forward(self, obs, head_idx, compute_pi=True, compute_log_pi=True):
+        """head_idx: see MultiHeadMlp.forward"""
         # hidden = self.trunk(obs)
-        mu, log_std = self.dist_heads[head_idx](obs).chunk(2, dim=-1)
+        mu, log_std = self.dist_heads(obs, head_idx).chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -538,7 +631,7 @@ class IndividualSacActorMlp(nn.Module):
 
     def compute_log_probs(self, obs, action, head_idx):
         # hidden = self.trunk(obs)
-        mu, log_std = self.dist_heads[head_idx](obs).chunk(2, dim=-1)
+        mu, log_std = self.dist_heads(obs, head_idx).chunk(2, dim=-1)
 
         # constrain log_std inside [log_std_min, log_std_max]
         log_std = torch.tanh(log_std)
@@ -557,19 +650,83 @@ class IndividualSacActorMlp(nn.Module):
 
 
 class SacCriticMlp(nn.Module):
-    """Critic network with MLP, employes two q-functions."""
-    def __init__(self, obs_shape, action_shape, hidden_dim):
+    """Critic network with MLP, employes num_critics (two by default) q-functions.
+
+    The q-functions are evaluated as one batched ensemble, the weights of each layer are stacked
+    as (num_critics, in, out) tensors and applied with a single baddbmm. The state_dict uses the
+    Q1.trunk.*, Q2.trunk.*, ... keys of separate QFunction modules.
+    """
+    def __init__(self, obs_shape, action_shape, hidden_dim, num_critics=2):
         super().__init__()
 
-        self.Q1 = QFunction(obs_shape[0], action_shape[0], hidden_dim)
-        self.Q2 = QFunction(obs_shape[0], action_shape[0], hidden_dim)
-        self.apply(weight_init)
+        self.num_critics = num_critics
+        # same layers as QFunction.trunk
+        dims = [obs_shape[0] + action_shape[0], hidden_dim, hidden_dim, hidden_dim, 1]
+        self.weights = nn.ParameterList([
+            nn.Parameter(torch.empty(num_critics, in_dim, out_dim)) for in_dim, out_dim in zip(dims[:-1], dims[1:])
+        ])
+        self.biases = nn.ParameterList([
+            nn.Parameter(torch.zeros(num_critics, 1, out_dim)) for out_dim in dims[1:]
+        ])
+        self.reset_parameters()
+
+        self._register_state_dict_hook(self._state_dict_to_q_functions)
+        self._register_load_state_dict_pre_hook(self._state_dict_from_q_functions)
+
+    def reset_parameters(self):
+        # weight_init of each nn.Linear in QFunction.trunk
+        with torch.no_grad():
+            for idx in range(self.num_critics):
+                for weight, bias in zip(self.weights, self.biases):
+                    weight[idx].t().copy_(nn.init.orthogonal_(torch.empty(weight.size(2), weight.size(1))))
+                    bias[idx].fill_(0.0)
+
+    def _q_function_keys(self, prefix, idx, layer):
+        # nn.Linear layers sit at every other index of QFunction.trunk
+        return '{}Q{}.trunk.{}.weight'.format(prefix, idx + 1, 2 * layer), \
+               '{}Q{}.trunk.{}.bias'.format(prefix, idx + 1, 2 * layer)
+
+    def _state_dict_to_q_functions(self, module, state_dict, prefix, local_metadata):
+        for layer in range(len(self.weights)):
+            weight = state_dict.pop('{}weights.{}'.format(prefix, layer))
+            bias = state_dict.pop('{}biases.{}'.format(prefix, layer))
+            for idx in range(self.num_critics):
+                weight_key, bias_key = self._q_function_keys(prefix, idx, layer)
+                state_dict[weight_key] = weight[idx].t().contiguous()
+                state_dict[bias_key] = bias[idx, 0].clone()
+
+        return state_dict
+
+    def _state_dict_from_q_functions(self, state_dict, prefix, local_metadata, strict,
+                                     missing_keys, unexpected_keys, error_msgs):
+        if self._q_function_keys(prefix, 0, 0)[0] not in state_dict:
+            return
+
+        for layer in range(len(self.weights)):
+            keys = [self._q_function_keys(prefix, idx, layer) for idx in range(self.num_critics)]
+            if any(weight_key not in state_dict or bias_key not in state_dict for weight_key, bias_key in keys):
+                # leave the remaining keys to be reported as missing
+                continue
+            state_dict['{}weights.{}'.format(prefix, layer)] = torch.stack(
+                [state_dict.pop(weight_key).t() for weight_key, _ in keys])
+            state_dict['{}biases.{}'.format(prefix, layer)] = torch.stack(
+                [state_dict.pop(bias_key).unsqueeze(0) for _, bias_key in keys])
+
+    def forward_ensemble(self, obs, action, **kwargs):
+        """Q-values of all q-functions as a (num_critics, batch_size, 1) tensor"""
+        assert obs.size(0) == action.size(0)
 
-    def forward(self, obs, action, **kwargs):
-        q1 = self.Q1(obs, action)
-        q2 = self.Q2(obs, action)
+        h = torch.cat([obs, action], dim=-1)
+        h = h.unsqueeze(0).expand(self.num_critics, *h.size())
+        for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            h = torch.baddbmm(bias, h, weight)
+            if layer < len(self.weights) - 1:
+                h = F.relu(h)
 
-        return q1, q2
+        return h
+
+    def forward(self, obs, action, **kwargs):
+        return tuple(self.forward_ensemble(obs, action).unbind(0))
 
 
 class MultiHeadSacCriticMlp(nn.Module):
@@ -600,6 +757,10 @@ class MultiHeadSacCriticMlp(nn.Module):
 
         return q1, q2
 
+    def forward_ensemble(self, obs, action, head_idx):
+        """Q-values of both q-functions as a (2, batch_size, 1) tensor"""
+        return torch.stack(self.forward(obs, action, head_idx))
+
 
 class PpoActorMlp(nn.Module):
     """torch.distributions implementation of an diagonal Gaussian policy with MLP"""
@@ -639,7 +800,7 @@ class PpoActorMlp(nn.Module):
         dist = self.dist(hidden)
 
         log_pi = dist.log_probs(action)
-        entropy = dist.entropy().mean()
+        entropy = dist.entropy()
 
         return log_pi, entropy
 
@@ -723,14 +884,47 @@ class MultiHeadPpoActorMlp(nn.Module):
             nn.Tanh(),
         )
 
-        self.dist_heads = torch.nn.ModuleList()
-        for action_shape in action_shapes:
-            self.dist_heads.append(
-                DiagGaussian(hidden_dim, action_shape[0])
-            )
+        # DiagGaussian heads, the log stds of all heads are stacked as a (num_heads, max_action_dim) tensor
+        self.action_dims = [action_shape[0] for action_shape in action_shapes]
+        self.dist_heads = MultiHeadMlp(hidden_dim, [], self.action_dims, ['{}.fc_mean'])
+        self.dist_log_stds = nn.Parameter(torch.zeros(len(self.action_dims), max(self.action_dims)))
+        self.dist_log_stds._stacked_heads = True
 
         self.apply(weight_init)
 
+        self._register_state_dict_hook(self._state_dict_to_dist_heads)
+        self._register_load_state_dict_pre_hook(self._state_dict_from_dist_heads)
+
+    def _state_dict_to_dist_heads(self, module, state_dict, prefix, local_metadata):
+        log_stds = state_dict.pop(prefix + 'dist_log_stds')
+        for idx, action_dim in enumerate(self.action_dims):
+            state_dict['{}dist_heads.{}.logstd._bias'.format(prefix, idx)] = \
+                log_stds[idx, :action_dim].unsqueeze(1).clone()
+
+        return state_dict
+
+    def _state_dict_from_dist_heads(self, state_dict, prefix, local_metadata, strict,
+                                    missing_keys, unexpected_keys, error_msgs):
+        keys = ['{}dist_heads.{}.logstd._bias'.format(prefix, idx) for idx in range(len(self.action_dims))]
+        if any(key not in state_dict for key in keys):
+            return
+
+        log_stds = torch.zeros_like(self.dist_log_stds)
+        for idx, (key, action_dim) in enumerate(zip(keys, self.action_dims)):
+            log_stds[idx, :action_dim] = state_dict.pop(key).squeeze(1)
+        state_dict[prefix + 'dist_log_stds'] = log_stds
+
+    def _dist(self, hidden, head_idx):
+        action_mean = self.dist_heads(hidden, head_idx)
+        if head_idx is None:
+            action_log_std = self.dist_log_stds.unsqueeze(1)
+        elif isinstance(head_idx, torch.Tensor):
+            action_log_std = self.dist_log_stds[head_idx]
+        else:
+            action_log_std = self.dist_log_stds[head_idx, :self.action_dims[head_idx]]
+
+        return FixedNormal(action_mean, action_log_std.exp().expand_as(action_mean))
+
     def common_parameters(self, recurse=True):
         for name, param in self.trunk.named_parameters(recurse=recurse):
             yield param
@@ -740,8 +934,9 @@ class MultiHeadPpoActorMlp(nn.Module):
             yield elem
 
     def forward(self, obs, head_idx, compute_pi=True, compute_log_pi=True):
+        """head_idx: see MultiHeadMlp.forward"""
         hidden = self.trunk(obs)
-        dist = self.dist_heads[head_idx](hidden)
+        dist = self._dist(hidden, head_idx)
 
         mu = dist.mode()
         if compute_pi:
@@ -758,10 +953,10 @@ class MultiHeadPpoActorMlp(nn.Module):
 
     def compute_log_probs(self, obs, action, head_idx):
         hidden = self.trunk(obs)
-        dist = self.dist_heads[head_idx](hidden)
+        dist = self._dist(hidden, head_idx)
 
         log_pi = dist.log_probs(action)
-        entropy = dist.entropy().mean()
+        entropy = dist.entropy()
 
         return log_pi, entropy
 
@@ -877,6 +1072,34 @@ class InvFunction(nn.Module):
         return self.trunk(joint_h)
 
 
+class EnsembleMlp(MultiHeadMlp):
+    """Ensemble of MLP trunks evaluated in one batched pass, the components are the heads of a MultiHeadMlp
+
+    The state_dict uses the keys of a ModuleList of nn.Sequential trunks with ReLU activations.
+    """
+    def __init__(self, in_dim, hidden_dims, out_dim, num_comps):
+        super().__init__(in_dim, hidden_dims, [out_dim] * num_comps,
+                         ['{{}}.{}'.format(2 * layer) for layer in range(len(hidden_dims) + 1)])
+        self.num_comps = num_comps
+
+    def forward(self, x, split=False):
+        """Predictions of all components concatenated along the batch dimension
+
+        split: give each component its own uniform slice of x, the last x.size(0) % num_comps samples are dropped
+        """
+        if split:
+            num_samples_each_slice = x.size(0) // self.num_comps
+            x = x[:self.num_comps * num_samples_each_slice].reshape(self.num_comps, num_samples_each_slice, -1)
+
+        return super().forward(x, None).flatten(0, 1)
+
+
+def _drop_trunk_keys(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # ensembles used to share their first component with trunk, it is trunks.0 now
+    for key in [key for key in state_dict if key.startswith(prefix + 'trunk.')]:
+        state_dict.pop(key)
+
+
 class SelfSupervisedCnnInvPredictor(nn.Module):
     def __init__(self, obs_shape, action_shape, hidden_dim,
                  encoder_feature_dim, num_layers, num_filters):
@@ -911,40 +1134,22 @@ class SelfSupervisedCnnInvPredictorEnsem(SelfSupervisedCnnInvPredictor):
                          encoder_feature_dim, num_layers, num_filters)
         self.num_comps = num_comps
 
-        trunks = [self.trunk]
-        for _ in range(self.num_comps - 1):
-            trunk = nn.Sequential(
-                nn.Linear(2 * encoder_feature_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, action_shape[0])
-            )
-            trunks.append(trunk)
-        self.trunks = nn.ModuleList(trunks)
+        del self.trunk
+        self.trunks = EnsembleMlp(2 * encoder_feature_dim, [hidden_dim, hidden_dim], action_shape[0], num_comps)
         self.apply(weight_init)
 
+        self._register_load_state_dict_pre_hook(_drop_trunk_keys)
+
     def forward(self, obs, next_obs, detach_encoder=False, split_hidden=False):
         """
             split_hidden: split encoder outputs uniformly for each components
         """
-        num_samples_each_slice = obs.shape[0] // self.num_comps if split_hidden else None
-
         # detach_encoder allows to stop gradient propogation to encoder's convolutional layers
         h = self.encoder(obs, detach=detach_encoder)
         next_h = self.encoder(next_obs, detach=detach_encoder)
 
         joint_h = torch.cat([h, next_h], dim=-1)
-        pred_actions = []
-        for idx, trunk in enumerate(self.trunks):
-            if split_hidden:
-                joint_h_slice = joint_h[idx * num_samples_each_slice:(idx + 1) * num_samples_each_slice]
-                pred_action = trunk(joint_h_slice)
-            else:
-                pred_action = trunk(joint_h)
-            pred_actions.append(pred_action)
-
-        pred_actions = torch.cat(pred_actions, dim=0)
+        pred_actions = self.trunks(joint_h, split=split_hidden)
 
         return pred_actions
 
@@ -983,39 +1188,22 @@ class SelfSupervisedCnnFwdPredictorEnsem(SelfSupervisedCnnFwdPredictor):
                          encoder_feature_dim, num_layers, num_filters)
         self.num_comps = num_comps
 
-        trunks = [self.trunk]
-        for _ in range(self.num_comps - 1):
-            trunk = nn.Sequential(
-                nn.Linear(encoder_feature_dim + action_shape[0], hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, encoder_feature_dim)
-            )
-            trunks.append(trunk)
-        self.trunks = nn.ModuleList(trunks)
+        del self.trunk
+        self.trunks = EnsembleMlp(encoder_feature_dim + action_shape[0], [hidden_dim, hidden_dim],
+                                  encoder_feature_dim, num_comps)
         self.apply(weight_init)
 
+        self._register_load_state_dict_pre_hook(_drop_trunk_keys)
+
     def forward(self, obs, action, detach_encoder=False, split_hidden=False):
         """
             split_hidden: split encoder outputs uniformly for each components
         """
-        num_samples_each_slice = obs.shape[0] // self.num_comps if split_hidden else None
-
         # detach_encoder allows to stop gradient propogation to encoder's convolutional layers
         h = self.encoder(obs, detach=detach_encoder)
 
         joint_h_act = torch.cat([h, action], dim=-1)
-        pred_next_hs = []
-        for idx, trunk in enumerate(self.trunks):
-            if split_hidden:
-                joint_h_act_slice = joint_h_act[idx * num_samples_each_slice:(idx + 1) * num_samples_each_slice]
-                pred_next_h = trunk(joint_h_act_slice)
-            else:
-                pred_next_h = trunk(joint_h_act)
-            pred_next_hs.append(pred_next_h)
-
-        pred_next_hs = torch.cat(pred_next_hs, dim=0)
+        pred_next_hs = self.trunks(joint_h_act, split=split_hidden)
 
         return pred_next_hs
 
@@ -1045,18 +1233,10 @@ class SelfSupervisedMlpInvPredictorEnsem(SelfSupervisedMlpInvPredictor):
         super().__init__(obs_shape, action_shape, hidden_dim)
         self.num_comps = num_comps
 
-        trunks = [self.trunk]
-        for _ in range(self.num_comps - 1):
-            trunk = nn.Sequential(
-                nn.Linear(2 * obs_shape[0], hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, action_shape[0])
-            )
-            trunks.append(trunk)
-        self.trunks = nn.ModuleList(trunks)
-        self.apply(weight_init)
+        del self.trunk
+        self.trunks = EnsembleMlp(2 * obs_shape[0], [hidden_dim, hidden_dim], action_shape[0], num_comps)
+
+        self._register_load_state_dict_pre_hook(_drop_trunk_keys)
 
     def forward(self, obs, next_obs, split_input=False):
         """
@@ -1066,17 +1246,7 @@ class SelfSupervisedMlpInvPredictorEnsem(SelfSupervisedMlpInvPredictor):
             assert obs.shape[0] % self.num_comps == 0, 'input is not splitable'
 
         joint_obs = torch.cat([obs, next_obs], dim=-1)
-        if split_input:
-            joint_obs = joint_obs.chunk(self.num_comps, dim=0)
-        pred_actions = []
-        for idx, trunk in enumerate(self.trunks):
-            if split_input:
-                pred_action = trunk(joint_obs[idx])
-            else:
-                pred_action = trunk(joint_obs)
-            pred_actions.append(pred_action)
-
-        pred_actions = torch.cat(pred_actions, dim=0)
+        pred_actions = self.trunks(joint_obs, split=split_input)
 
         return pred_actions
 
@@ -1106,18 +1276,10 @@ class SelfSupervisedMlpFwdPredictorEnsem(SelfSupervisedMlpFwdPredictor):
         super().__init__(obs_shape, action_shape, hidden_dim)
         self.num_comps = num_comps
 
-        trunks = [self.trunk]
-        for _ in range(self.num_comps - 1):
-            trunk = nn.Sequential(
-                nn.Linear(obs_shape[0] + action_shape[0], hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, hidden_dim),
-                nn.ReLU(),
-                nn.Linear(hidden_dim, obs_shape[0])
-            )
-            trunks.append(trunk)
-        self.trunks = nn.ModuleList(trunks)
-        self.apply(weight_init)
+        del self.trunk
+        self.trunks = EnsembleMlp(obs_shape[0] + action_shape[0], [hidden_dim, hidden_dim], obs_shape[0], num_comps)
+
+        self._register_load_state_dict_pre_hook(_drop_trunk_keys)
 
     def forward(self, obs, action, split_input=False):
         """
@@ -1127,17 +1289,7 @@ class SelfSupervisedMlpFwdPredictorEnsem(SelfSupervisedMlpFwdPredictor):
             assert obs.shape[0] % self.num_comps == 0, 'input is not splitable'
 
         joint_obs_act = torch.cat([obs, action], dim=-1)
-        if split_input:
-            joint_obs_act = joint_obs_act.chunk(self.num_comps, dim=0)
-        pred_next_obss = []
-        for idx, trunk in enumerate(self.trunks):
-            if split_input:
-                pred_next_obs = trunk(joint_obs_act[idx])
-            else:
-                pred_next_obs = trunk(joint_obs_act)
-            pred_next_obss.append(pred_next_obs)
-
-        pred_next_obss = torch.cat(pred_next_obss, dim=0)
+        pred_next_obss = self.trunks(joint_obs_act, split=split_input)
 
         return pred_next_obss
 
@@ -1182,39 +1334,22 @@ class DqnCnnSSInvPredictorEnsem(DqnCnnSSInvPredictor):
             flatten_dim = np.prod(
                 self.encoder(torch.zeros(1, *obs_shape)).shape[1:])
 
-        trunks = [self.trunk]
-        for _ in range(self.num_comps - 1):
-            trunk = nn.Sequential(
-                nn.Linear(2 * flatten_dim, feature_dim),
-                nn.ReLU(),
-                nn.Linear(feature_dim, action_shape)
-            )
-            trunks.append(trunk)
-
-        self.trunks = nn.ModuleList(trunks)
+        del self.trunk
+        self.trunks = EnsembleMlp(2 * flatten_dim, [feature_dim], action_shape, num_comps)
         self.apply(weight_init)
 
+        self._register_load_state_dict_pre_hook(_drop_trunk_keys)
+
     def forward(self, obs, next_obs, detach_encoder=False, split_hidden=False):
         """
             split_hidden: split encoder outputs uniformly for each components
         """
-        num_samples_each_slice = obs.shape[0] // self.num_comps if split_hidden else None
-
         # detach_encoder allows to stop gradient propogation to encoder's convolutional layers
         h = self.encoder(obs, detach=detach_encoder)
         next_h = self.encoder(next_obs, detach=detach_encoder)
 
         joint_h = torch.cat([h, next_h], dim=-1)
-        pred_logits = []
-        for idx, trunk in enumerate(self.trunks):
-            if split_hidden:
-                joint_h_slice = joint_h[idx * num_samples_each_slice:(idx + 1) * num_samples_each_slice]
-                pred_logit = trunk(joint_h_slice)
-            else:
-                pred_logit = trunk(joint_h)
-            pred_logits.append(pred_logit)
-
-        pred_logits = torch.cat(pred_logits, dim=0)
+        pred_logits = self.trunks(joint_h, split=split_hidden)
 
         return pred_logits
 
@@ -1247,7 +1382,7 @@ class DqnCnnSSFwdPredictor(nn.Module):
         return pred_next_h
 
 
-class DqnCnnSSFwdPredictorEnsem(SelfSupervisedCnnFwdPredictor):
+class DqnCnnSSFwdPredictorEnsem(DqnCnnSSFwdPredictor):
     def __init__(self, obs_shape, feature_dim, num_comps):
         super().__init__(obs_shape, feature_dim)
         self.num_comps = num_comps
@@ -1257,36 +1392,20 @@ class DqnCnnSSFwdPredictorEnsem(SelfSupervisedCnnFwdPredictor):
             flatten_dim = np.prod(
                 self.encoder(torch.zeros(1, *obs_shape)).shape[1:])
 
-        trunks = [self.trunk]
-        for _ in range(self.num_comps - 1):
-            trunk = nn.Sequential(
-                nn.Linear(flatten_dim + 1, feature_dim),
-                nn.ReLU(),
-                nn.Linear(feature_dim, flatten_dim)
-            )
-            trunks.append(trunk)
-        self.trunks = nn.ModuleList(trunks)
+        del self.trunk
+        self.trunks = EnsembleMlp(flatten_dim + 1, [feature_dim], flatten_dim, num_comps)
         self.apply(weight_init)
 
+        self._register_load_state_dict_pre_hook(_drop_trunk_keys)
+
     def forward(self, obs, action, detach_encoder=False, split_hidden=False):
         """
             split_hidden: split encoder outputs uniformly for each components
         """
-        num_samples_each_slice = obs.shape[0] // self.num_comps if split_hidden else None
-
         # detach_encoder allows to stop gradient propogation to encoder's convolutional layers
         h = self.encoder(obs, detach=detach_encoder)
 
         joint_h_act = torch.cat([h, action], dim=-1)
-        pred_next_hs = []
-        for idx, trunk in enumerate(self.trunks):
-            if split_hidden:
-                joint_h_act_slice = joint_h_act[idx * num_samples_each_slice:(idx + 1) * num_samples_each_slice]
-                pred_next_h = trunk(joint_h_act_slice)
-            else:
-                pred_next_h = trunk(joint_h_act)
-            pred_next_hs.append(pred_next_h)
-
-        pred_next_hs = torch.cat(pred_next_hs, dim=0)
+        pred_next_hs = self.trunks(joint_h_act, split=split_hidden)
 
         return pred_next_hs
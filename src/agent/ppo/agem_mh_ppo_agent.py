@@ -1,6 +1,7 @@
 import torch
 from itertools import chain
 
+import utils
 from agent.ppo import MultiHeadPpoMlpAgent, AgemPpoMlpAgent
 
 
@@ -59,12 +60,8 @@ class AgemMultiHeadPpoMlpAgent(MultiHeadPpoMlpAgent, AgemPpoMlpAgent):
             loss.backward()
 
             # compute reference gradient
-            single_ref_grad = []
-            for param in chain(self.actor.common_parameters(),
-                               self.critic.common_parameters()):
-                if param.requires_grad:
-                    single_ref_grad.append(param.grad.detach().clone().flatten())
-            single_ref_grad = torch.cat(single_ref_grad)
+            single_ref_grad = utils.get_flat_grad(chain(self.actor.common_parameters(),
+                                                        self.critic.common_parameters())).clone()
             self.optimizer.zero_grad()
 
             ref_grad.append(single_ref_grad)
@@ -77,23 +74,14 @@ class AgemMultiHeadPpoMlpAgent(MultiHeadPpoMlpAgent, AgemPpoMlpAgent):
         if ref_grad is None:
             return
 
-        grad = []
-        for param in chain(self.actor.common_parameters(),
-                           self.critic.common_parameters()):
-            if param.requires_grad:
-                grad.append(param.grad.flatten())
-        grad = torch.cat(grad)
+        grad = utils.get_flat_grad(chain(self.actor.common_parameters(),
+                                         self.critic.common_parameters()))
 
         # inequality constrain
-        angle = (grad * ref_grad).sum()
+        angle = torch.dot(grad, ref_grad)
         if angle < 0:
             # project the gradient of the current transitions onto the gradient of the memory transitions ...
-            proj_grad = grad - (angle / (ref_grad * ref_grad).sum()) * ref_grad
+            proj_grad = grad - (angle / torch.dot(ref_grad, ref_grad)) * ref_grad
             # replace all the gradients within the model with this projected gradient
-            idx = 0
-            for param in chain(self.actor.common_parameters(),
-                               self.critic.common_parameters()):
-                if param.requires_grad:
-                    num_param = param.numel()  # number of parameters in [p]
-                    param.grad.copy_(proj_grad[idx:idx + num_param].reshape(param.shape))
-                    idx += num_param
+            utils.set_flat_grad(chain(self.actor.common_parameters(),
+                                      self.critic.common_parameters()), proj_grad)
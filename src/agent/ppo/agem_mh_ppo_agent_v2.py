@@ -1,5 +1,6 @@
 import torch
 
+import utils
 from agent.ppo import MultiHeadPpoMlpAgentV2
 from agent.ppo import AgemPpoMlpAgentV2
 
@@ -59,11 +60,7 @@ class AgemMultiHeadPpoMlpAgentV2(MultiHeadPpoMlpAgentV2, AgemPpoMlpAgentV2):
                 self.grad_clip_norm)
 
             # compute reference gradient
-            single_ref_grad = []
-            for param in self.actor.common_parameters():
-                if param.requires_grad:
-                    single_ref_grad.append(param.grad.detach().clone().flatten())
-            single_ref_grad = torch.cat(single_ref_grad)
+            single_ref_grad = utils.get_flat_grad(self.actor.common_parameters()).clone()
             self.optimizer.zero_grad()
 
             ref_grad.append(single_ref_grad)
@@ -76,21 +73,12 @@ class AgemMultiHeadPpoMlpAgentV2(MultiHeadPpoMlpAgentV2, AgemPpoMlpAgentV2):
         if ref_grad is None:
             return
 
-        grad = []
-        for param in self.actor.common_parameters():
-            if param.requires_grad:
-                grad.append(param.grad.flatten())
-        grad = torch.cat(grad)
+        grad = utils.get_flat_grad(self.actor.common_parameters())
 
         # inequality constrain
-        angle = (grad * ref_grad).sum()
+        angle = torch.dot(grad, ref_grad)
         if angle < 0:
             # project the gradient of the current transitions onto the gradient of the memory transitions ...
-            proj_grad = grad - (angle / (ref_grad * ref_grad).sum()) * ref_grad
+            proj_grad = grad - (angle / torch.dot(ref_grad, ref_grad)) * ref_grad
             # replace all the gradients within the model with this projected gradient
-            idx = 0
-            for param in self.actor.common_parameters():
-                if param.requires_grad:
-                    num_param = param.numel()  # number of parameters in [p]
-                    param.grad.copy_(proj_grad[idx:idx + num_param].reshape(param.shape))
-                    idx += num_param
+            utils.set_flat_grad(self.actor.common_parameters(), proj_grad)
@@ -36,48 +36,61 @@ class AgemPpoMlpAgentV2(PpoMlpAgent):
 
         self.agem_task_count = 0
         self.agem_memories = {}
+        self._agem_memory_cache = utils.TaskMemoryCache()
 
     def _adjust_memory_size(self, size):
         for mem in self.agem_memories.values():
             mem.update_num_steps(size)
 
+    def _sample_memories(self):
+        """Draw agem_ref_grad_batch_size // agem_task_count transitions without replacement from every task memory,
+        advantages are normalized within each memory as in update()"""
+        memories = list(self.agem_memories.values())
+
+        def task_fields():
+            fields = []
+            for memory in memories:
+                num_samples = memory.rewards.size(0) * memory.rewards.size(1)
+                advantages = memory.returns[:-1] - memory.value_preds[:-1]
+                advantages = (advantages - advantages.mean()) / (
+                        advantages.std() + 1e-5)
+                fields.append({
+                    'obs': memory.obs[:-1].reshape(num_samples, *memory.obs.size()[2:]),
+                    'actions': memory.actions.reshape(num_samples, memory.actions.size(-1)),
+                    'value_preds': memory.value_preds[:-1].reshape(num_samples, 1),
+                    'returns': memory.returns[:-1].reshape(num_samples, 1),
+                    'log_pis': memory.log_pis.reshape(num_samples, 1),
+                    'advantages': advantages.reshape(num_samples, 1),
+                })
+            return fields
+
+        self._agem_memory_cache.update(
+            [tensor for memory in memories for tensor in
+             (memory.obs, memory.actions, memory.value_preds, memory.returns, memory.log_pis)],
+            task_fields)
+        batch = self._agem_memory_cache.sample(
+            self.agem_ref_grad_batch_size // self.agem_task_count, replacement=False)
+        batch['obs'] = memories[0].obs_codec.decode(batch['obs'])
+
+        return batch
+
     def _compute_ref_grad(self):
         if not self.agem_memories:
             return None
 
-        ref_grad = []
-        for memory in self.agem_memories.values():
-            advantages = memory.returns[:-1] - memory.value_preds[:-1]
-            advantages = (advantages - advantages.mean()) / (
-                    advantages.std() + 1e-5)
-            data_generator = memory.feed_forward_generator(
-                advantages, mini_batch_size=self.agem_ref_grad_batch_size // self.agem_task_count)
-
-            # (chongyi zheng): we only use one batch of rollouts to compute ref_grad
-            obs_batch, actions_batch, value_preds_batch, \
-            return_batch, old_log_pis, adv_targets = next(data_generator)
-
-            actor_loss, entropy = self.compute_actor_loss(
-                obs_batch, actions_batch, old_log_pis, adv_targets)
-            loss = actor_loss - self.entropy_coef * entropy
-
-            self.optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(
-                self.actor.parameters(),
-                self.grad_clip_norm)
+        batch = self._sample_memories()
 
-            # compute reference gradient
-            single_ref_grad = []
-            for param in self.actor.parameters():
-                if param.requires_grad:
-                    single_ref_grad.append(param.grad.detach().clone().flatten())
-            single_ref_grad = torch.cat(single_ref_grad)
-            self.optimizer.zero_grad()
+        # one forward pass for the minibatches of all tasks, the loss of each task is kept apart
+        # to clip its gradient on its own
+        actor_losses, entropies = self.compute_actor_losses(
+            batch['obs'], batch['actions'], batch['log_pis'], batch['advantages'])
 
-            ref_grad.append(single_ref_grad)
+        actor_losses = actor_losses.view(self.agem_task_count, -1).mean(dim=1)
+        entropies = entropies.view(self.agem_task_count, -1).mean(dim=1)
+        losses = actor_losses - self.entropy_coef * entropies
 
-        ref_grad = torch.stack(ref_grad).mean(dim=0)
+        task_grads = utils.batched_task_grads(losses, self.actor.parameters())
+        ref_grad = utils.clip_task_grads(task_grads, self.grad_clip_norm).mean(dim=0)
 
         return ref_grad
 
@@ -85,24 +98,15 @@ class AgemPpoMlpAgentV2(PpoMlpAgent):
         if ref_grad is None:
             return
 
-        grad = []
-        for param in self.actor.parameters():
-            if param.requires_grad:
-                grad.append(param.grad.flatten())
-        grad = torch.cat(grad)
+        grad = utils.get_flat_grad(self.actor.parameters())
 
         # inequality constrain
-        angle = (grad * ref_grad).sum()
+        angle = torch.dot(grad, ref_grad)
         if angle < 0:
             # project the gradient of the current transitions onto the gradient of the memory transitions ...
-            proj_grad = grad - (angle / (ref_grad * ref_grad).sum()) * ref_grad
+            proj_grad = grad - (angle / torch.dot(ref_grad, ref_grad)) * ref_grad
             # replace all the gradients within the model with this projected gradient
-            idx = 0
-            for param in self.actor.parameters():
-                if param.requires_grad:
-                    num_param = param.numel()  # number of parameters in [p]
-                    param.grad.copy_(proj_grad[idx:idx + num_param].reshape(param.shape))
-                    idx += num_param
+            utils.set_flat_grad(self.actor.parameters(), proj_grad)
 
     def construct_memory(self, env, num_processes, compute_returns_kwargs, **kwargs):
         memory_size_per_task = self.agem_memory_budget // (self.agem_task_count + 1)
@@ -113,13 +117,12 @@ class AgemPpoMlpAgentV2(PpoMlpAgent):
                                          self.device)
 
         obs = env.reset()
-        memory.obs[0].copy_(torch.Tensor(obs).to(self.device))
+        memory.set_obs(0, obs)
 
         # construct memory using final policy for each task
         for _ in range(memory_size_per_task):
             with utils.eval_mode(self):
-                action, log_pi = self.act(obs, sample=True, compute_log_pi=True, **kwargs)
-                value = self.predict_value(obs, **kwargs)
+                action, log_pi, value = self.act_and_value(obs, sample=True, **kwargs)
 
             obs, reward, done, infos = env.step(action)
 
@@ -131,7 +134,7 @@ class AgemPpoMlpAgentV2(PpoMlpAgent):
                  for info in infos])
             memory.insert(obs, action, log_pi, value, reward, masks, bad_masks)
 
-        next_value = self.predict_value(memory.obs[-1], **kwargs)
+        next_value = self.predict_value(memory.get_obs(-1), **kwargs)
         memory.compute_returns(next_value, **compute_returns_kwargs)
 
         self.agem_memories[self.agem_task_count] = memory
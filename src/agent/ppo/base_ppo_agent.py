@@ -75,6 +75,12 @@ class PpoMlpAgent:
         self.actor.train(training)
         self.critic.train(training)
 
+    def flatten_parameters(self):
+        """Back the actor and critic parameters and gradients by contiguous buffers, see utils.FlatParams"""
+        self.flat_params = utils.FlatParams(chain(self.actor.parameters(), self.critic.parameters()))
+        utils.FlatParams.zero_grad_in_place(
+            *[value for value in vars(self).values() if isinstance(value, torch.optim.Optimizer)])
+
     def predict_value(self, obs, **kwargs):
         if not isinstance(obs, torch.Tensor):
             obs = torch.Tensor(obs).to(self.device)
@@ -94,29 +100,55 @@ class PpoMlpAgent:
 
         return utils.to_np(action), utils.to_np(log_pi)
 
-    def compute_critic_loss(self, obs, value_pred, ret, **kwargs):
+    def act_and_value(self, obs, sample=False, **kwargs):
+        """act() with compute_log_pi=True and predict_value() from one input transfer and one host copy"""
+        if not isinstance(obs, torch.Tensor):
+            obs = torch.Tensor(obs).to(self.device)
+
+        with torch.no_grad():
+            mu, pi, log_pi = self.actor(obs, compute_log_pi=True, **kwargs)
+            value = self.critic(obs, **kwargs)
+            action = pi if sample else mu
+            # some actors return log_pi without the trailing dimension
+            outputs = utils.to_np(torch.cat([action, log_pi.view(-1, 1), value], dim=-1))
+
+        action_dim = action.size(-1)
+
+        return outputs[:, :action_dim], outputs[:, action_dim:action_dim + 1], outputs[:, action_dim + 1:]
+
+    def compute_critic_losses(self, obs, value_pred, ret, **kwargs):
+        """Unreduced critic losses, one per sample"""
         value = self.critic(obs, **kwargs)
 
         if self.use_clipped_critic_loss:
             value_pred_clipped = value_pred + (value - value_pred).clamp(-self.clip_param, self.clip_param)
             critic_losses = (value - ret).pow(2)
             critic_losses_clipped = (value_pred_clipped - ret).pow(2)
-            critic_loss = 0.5 * torch.max(critic_losses, critic_losses_clipped).mean()
+            critic_losses = 0.5 * torch.max(critic_losses, critic_losses_clipped)
         else:
-            critic_loss = 0.5 * (ret - value).pow(2).mean()
+            critic_losses = 0.5 * (ret - value).pow(2)
 
-        return critic_loss
+        return critic_losses
 
-    def compute_actor_loss(self, obs, action, old_log_pi, adv_target, **kwargs):
-        log_pi, entropy = self.actor.compute_log_probs(obs, action, **kwargs)
+    def compute_critic_loss(self, obs, value_pred, ret, **kwargs):
+        return self.compute_critic_losses(obs, value_pred, ret, **kwargs).mean()
+
+    def compute_actor_losses(self, obs, action, old_log_pi, adv_target, **kwargs):
+        """Unreduced clipped surrogate losses and policy entropies, one per sample"""
+        log_pi, entropies = self.actor.compute_log_probs(obs, action, **kwargs)
 
         ratio = torch.exp(log_pi - old_log_pi)
         surr1 = ratio * adv_target
         surr2 = torch.clamp(ratio, 1.0 - self.clip_param,
                             1.0 + self.clip_param) * adv_target
-        actor_loss = -torch.min(surr1, surr2).mean()
+        actor_losses = -torch.min(surr1, surr2)
+
+        return actor_losses, entropies
+
+    def compute_actor_loss(self, obs, action, old_log_pi, adv_target, **kwargs):
+        actor_losses, entropies = self.compute_actor_losses(obs, action, old_log_pi, adv_target, **kwargs)
 
-        return actor_loss, entropy
+        return actor_losses.mean(), entropies.mean()
 
     def update_learning_rate(self, epoch, total_epochs):
         lr = self.lr - (self.lr * (epoch / float(total_epochs)))
@@ -130,31 +162,31 @@ class PpoMlpAgent:
 
         logger.log('train/batch_normalized_advantages', advantages.mean(), step)
 
-        for e in range(self.ppo_epoch):
-            data_generator = rollouts.feed_forward_generator(
-                advantages, self.num_batch)
-
-            for sample in data_generator:
-                obs_batch, actions_batch, value_preds_batch, \
-                return_batch, old_log_pis, adv_targets = sample
-
-                actor_loss, entropy = self.compute_actor_loss(
-                    obs_batch, actions_batch, old_log_pis, adv_targets, **kwargs)
-                critic_loss = self.compute_critic_loss(
-                    obs_batch, value_preds_batch, return_batch, **kwargs)
-                loss = actor_loss + self.critic_loss_coef * critic_loss - \
-                       self.entropy_coef * entropy
-
-                logger.log('train_actor/loss', actor_loss, step)
-                logger.log('train_actor/entropy', entropy, step)
-                logger.log('train_critic/loss', critic_loss, step)
-                logger.log('train/loss', loss, step)
-                self.optimizer.zero_grad()
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    chain(self.actor.parameters(), self.critic.parameters()),
-                    self.grad_clip_norm)
-                self.optimizer.step()
+        # minibatches of all epochs are drawn at once
+        data_generator = rollouts.feed_forward_generator(
+            advantages, self.num_batch, num_epochs=self.ppo_epoch)
+
+        for sample in data_generator:
+            obs_batch, actions_batch, value_preds_batch, \
+            return_batch, old_log_pis, adv_targets = sample
+
+            actor_loss, entropy = self.compute_actor_loss(
+                obs_batch, actions_batch, old_log_pis, adv_targets, **kwargs)
+            critic_loss = self.compute_critic_loss(
+                obs_batch, value_preds_batch, return_batch, **kwargs)
+            loss = actor_loss + self.critic_loss_coef * critic_loss - \
+                   self.entropy_coef * entropy
+
+            logger.log('train_actor/loss', actor_loss, step)
+            logger.log('train_actor/entropy', entropy, step)
+            logger.log('train_critic/loss', critic_loss, step)
+            logger.log('train/loss', loss, step)
+            self.optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(
+                chain(self.actor.parameters(), self.critic.parameters()),
+                self.grad_clip_norm)
+            self.optimizer.step()
 
     def save(self, model_dir, step):
         torch.save(
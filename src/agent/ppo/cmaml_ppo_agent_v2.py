@@ -4,7 +4,7 @@ import copy
 from itertools import chain
 from collections import OrderedDict
 
-
+import utils
 from agent.ppo.base_ppo_agent import PpoMlpAgent
 from agent.network import CmamlPpoActorMlp, PpoCriticMlp
 
@@ -102,27 +102,19 @@ class CmamlPpoMlpAgentV2(PpoMlpAgent):
 
     def _reservoir_sampling(self, obses, actions, value_preds,
                             returns, old_log_pis, adv_targets):
-        for obs, action, value_pred, ret, old_log_pi, adv_target \
-                in zip(obses, actions, value_preds, returns, old_log_pis, adv_targets):
-            self.cmaml_total_sample_num += 1
-            sample_num = self.cmaml_memory['sample_num']
-            if sample_num < self.cmaml_memory_budget:
-                self.cmaml_memory['obses'][sample_num].copy_(obs)
-                self.cmaml_memory['actions'][sample_num].copy_(action)
-                self.cmaml_memory['value_preds'][sample_num].copy_(value_pred)
-                self.cmaml_memory['returns'][sample_num].copy_(ret)
-                self.cmaml_memory['old_log_pis'][sample_num].copy_(old_log_pi)
-                self.cmaml_memory['adv_targets'][sample_num].copy_(adv_target)
-                self.cmaml_memory['sample_num'] += 1
-            else:
-                idx = np.random.randint(0, self.cmaml_total_sample_num)
-                if idx < self.cmaml_memory_budget:
-                    self.cmaml_memory['obses'][idx].copy_(obs)
-                    self.cmaml_memory['actions'][idx].copy_(action)
-                    self.cmaml_memory['value_preds'][idx].copy_(value_pred)
-                    self.cmaml_memory['returns'][idx].copy_(ret)
-                    self.cmaml_memory['old_log_pis'][idx].copy_(old_log_pi)
-                    self.cmaml_memory['adv_targets'][idx].copy_(adv_target)
+        batch_size = obses.size(0)
+        sample_idxs, slots = utils.reservoir_slots(
+            self.cmaml_memory['sample_num'], self.cmaml_total_sample_num,
+            self.cmaml_memory_budget, batch_size)
+        self.cmaml_total_sample_num += batch_size
+        self.cmaml_memory['sample_num'] = min(self.cmaml_memory['sample_num'] + batch_size,
+                                              self.cmaml_memory_budget)
+
+        sample_idxs = torch.as_tensor(sample_idxs, device=self.device)
+        slots = torch.as_tensor(slots, device=self.device)
+        for key, field in zip(['obses', 'actions', 'value_preds', 'returns', 'old_log_pis', 'adv_targets'],
+                              [obses, actions, value_preds, returns, old_log_pis, adv_targets]):
+            self.cmaml_memory[key].index_copy_(0, slots, field[sample_idxs].to(self.cmaml_memory[key].dtype))
 
     def reset(self):
         self.critic.load_state_dict(self._critic_init_state)
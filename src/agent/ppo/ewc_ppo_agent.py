@@ -27,6 +27,7 @@ class EwcPpoMlpAgent(PpoMlpAgent):
                  ewc_estimate_fisher_epochs=100,
                  online_ewc=False,
                  online_ewc_gamma=1.0,
+                 ewc_fisher_chunk_size=0,
                  ):
         super().__init__(obs_shape, action_shape, device, hidden_dim, discount, clip_param, ppo_epoch,
                          critic_loss_coef, entropy_coef, lr, eps, grad_clip_norm, use_clipped_critic_loss,
@@ -36,20 +37,31 @@ class EwcPpoMlpAgent(PpoMlpAgent):
         self.ewc_estimate_fisher_epochs = ewc_estimate_fisher_epochs
         self.online_ewc = online_ewc
         self.online_ewc_gamma = online_ewc_gamma
+        self.ewc_fisher_chunk_size = ewc_fisher_chunk_size
 
         self.ewc_task_count = 0
-        self.prev_task_params = {}
-        self.prev_task_fishers = {}
+        self.ewc_consolidation = utils.EwcConsolidation(online_ewc, online_ewc_gamma)
+
+    def _per_sample_fishers(self, rollouts, advantages, named_parameters, **kwargs):
+        """Mean squared per-sample gradients of the loss over the whole rollout, see utils.per_sample_fisher()"""
+        def compute_loss(obs, actions, value_preds, returns, old_log_pis, adv_targets):
+            actor_loss, entropy = self.compute_actor_loss(obs, actions, old_log_pis, adv_targets, **kwargs)
+            critic_loss = self.compute_critic_loss(obs, value_preds, returns, **kwargs)
+
+            return actor_loss + self.critic_loss_coef * critic_loss - self.entropy_coef * entropy
+
+        return utils.per_sample_fisher(named_parameters, [self.actor, self.critic], compute_loss,
+                                       next(rollouts.feed_forward_generator(advantages, num_mini_batch=1)),
+                                       self.ewc_fisher_chunk_size)
 
     def estimate_fisher(self, env, rollouts, compute_returns_kwargs, **kwargs):
         fishers = {}
         obs = env.reset()
-        rollouts.obs[0].copy_(torch.Tensor(obs).to(self.device))
+        rollouts.set_obs(0, obs)
         for epoch in range(self.ewc_estimate_fisher_epochs):
             for step in range(rollouts.num_steps):
                 with utils.eval_mode(self):
-                    action, log_pi = self.act(obs, sample=True, compute_log_pi=True, **kwargs)
-                    value = self.predict_value(obs, **kwargs)
+                    action, log_pi, value = self.act_and_value(obs, sample=True, **kwargs)
 
                 obs, reward, done, infos = env.step(action)
 
@@ -61,12 +73,24 @@ class EwcPpoMlpAgent(PpoMlpAgent):
                      for info in infos])
                 rollouts.insert(obs, action, log_pi, value, reward, masks, bad_masks)
 
-            next_value = self.predict_value(rollouts.obs[-1], **kwargs)
+            next_value = self.predict_value(rollouts.get_obs(-1), **kwargs)
             rollouts.compute_returns(next_value, **compute_returns_kwargs)
 
             advantages = rollouts.returns[:-1] - rollouts.value_preds[:-1]
             advantages = (advantages - advantages.mean()) / (
                     advantages.std() + 1e-5)
+
+            if self.ewc_fisher_chunk_size > 0:
+                # mean of the squared per-sample gradients over the rollout instead of the squared
+                # minibatch gradients
+                epoch_fishers = self._per_sample_fishers(
+                    rollouts, advantages, chain(self.actor.named_parameters(), self.critic.named_parameters()),
+                    **kwargs)
+                for name, fisher in epoch_fishers.items():
+                    fishers[name] = fisher + fishers.get(name, torch.zeros_like(fisher))
+                rollouts.after_update()
+                continue
+
             data_generator = rollouts.feed_forward_generator(
                 advantages, self.num_batch)
 
@@ -105,48 +129,16 @@ class EwcPpoMlpAgent(PpoMlpAgent):
             if param.requires_grad:
                 fisher = fishers[name]
 
-                if self.online_ewc:
-                    name = name + '_prev_task'
-                    self.prev_task_params[name] = param.detach().clone()
-                    # (chongyi zheng): Only average over epochs now
-                    self.prev_task_fishers[name] = \
-                        fisher / self.ewc_estimate_fisher_epochs + \
-                        self.online_ewc_gamma * self.prev_task_fishers.get(
-                            name, torch.zeros_like(param.grad))
-                else:
-                    name = name + f'_prev_task{self.ewc_task_count}'
-                    self.prev_task_params[name] = param.detach().clone()
-                    # (chongyi zheng): Only average over epochs now
-                    self.prev_task_fishers[name] = \
-                        fisher / self.ewc_estimate_fisher_epochs
+                self.ewc_consolidation.consolidate(name, param, fisher / self.ewc_estimate_fisher_epochs)
 
         self.ewc_task_count += 1
 
     def compute_ewc_loss(self):
-        ewc_losses = []
         if self.ewc_task_count >= 1:
-            if self.online_ewc:
-                for name, param in chain(self.actor.named_parameters(),
-                                         self.critic.named_parameters()):
-                    if param.requires_grad:
-                        name = name + '_prev_task'
-                        mean = self.prev_task_params[name]
-                        # apply decay-term to the running sum of the Fisher Information matrices
-                        fisher = self.online_ewc_gamma * self.prev_task_fishers[name]
-                        ewc_loss = torch.sum(fisher * (param - mean) ** 2)
-                        ewc_losses.append(ewc_loss)
-            else:
-                for task in range(self.ewc_task_count):
-                    # compute ewc loss for each parameter
-                    for name, param in chain(self.actor.named_parameters(),
-                                             self.critic.named_parameters()):
-                        if param.requires_grad:
-                            name = name + f'_prev_task{task}'
-                            mean = self.prev_task_params[name]
-                            fisher = self.prev_task_fishers[name]
-                            ewc_loss = torch.sum(fisher * (param - mean) ** 2)
-                            ewc_losses.append(ewc_loss)
-            return torch.sum(torch.stack(ewc_losses)) / 2.0
+            return self.ewc_consolidation.penalty(
+                (name, param) for name, param in chain(self.actor.named_parameters(),
+                                                       self.critic.named_parameters())
+                if param.requires_grad)
         else:
             return torch.tensor(0.0, device=self.device)
 
@@ -188,11 +180,11 @@ class EwcPpoMlpAgent(PpoMlpAgent):
     def save(self, model_dir, step):
         super().save(model_dir, step)
         torch.save(
-            self.prev_task_params, '%s/prev_task_params_%s.pt' % (model_dir, step)
+            self.ewc_consolidation.state_dict(), '%s/ewc_consolidation_%s.pt' % (model_dir, step)
         )
 
     def load(self, model_dir, step):
         super().load(model_dir, step)
-        self.prev_task_params = torch.load(
-            '%s/prev_task_params_%s.pt' % (model_dir, step)
-        )
+        self.ewc_consolidation.load_state_dict(torch.load(
+            '%s/ewc_consolidation_%s.pt' % (model_dir, step)
+        ))
@@ -1,6 +1,7 @@
 import torch
 import copy
 from itertools import chain
+import utils
 
 from agent.ppo.base_ppo_agent import PpoMlpAgent
 from agent.network import MultiHeadPpoActorMlp, MultiHeadPpoCriticMlp
@@ -44,6 +45,8 @@ class MultiHeadPpoMlpAgent(PpoMlpAgent):
 
         self.optimizer = torch.optim.Adam(chain(self.actor.parameters(), self.critic.parameters()),
                                           lr=self.lr, eps=self.eps)
+        # the heads of other tasks stay as they are
+        utils.skip_inactive_heads(self.optimizer)
 
         self._optimizer_init_state = copy.deepcopy(self.optimizer.state_dict())
 
@@ -1,6 +1,7 @@
 import torch
 import copy
 from itertools import chain
+import utils
 
 from agent.ppo.base_ppo_agent import PpoMlpAgent
 from agent.network import MultiHeadPpoActorMlp, PpoCriticMlp
@@ -49,6 +50,8 @@ class MultiHeadPpoMlpAgentV2(PpoMlpAgent):
 
         self.optimizer = torch.optim.Adam(chain(self.actor.parameters(), self.critic.parameters()),
                                           lr=self.lr, eps=self.eps)
+        # the heads of other tasks stay as they are
+        utils.skip_inactive_heads(self.optimizer)
 
         self._critic_init_state = copy.deepcopy(self.critic.state_dict())
         self._optimizer_init_state = copy.deepcopy(self.optimizer.state_dict())
@@ -22,7 +22,8 @@ class SiMultiHeadPpoMlpAgent(MultiHeadPpoMlpAgent, SiPpoMlpAgent):
                  use_clipped_critic_loss=True,
                  num_batch=32,
                  si_c=1.0,
-                 si_epsilon=0.1
+                 si_epsilon=0.1,
+                 si_accumulate_freq=1,
                  ):
         MultiHeadPpoMlpAgent.__init__(self, obs_shape, action_shape, device, hidden_dim, discount, clip_param,
                                       ppo_epoch, critic_loss_coef, entropy_coef, lr, eps, grad_clip_norm,
@@ -30,39 +31,11 @@ class SiMultiHeadPpoMlpAgent(MultiHeadPpoMlpAgent, SiPpoMlpAgent):
 
         SiPpoMlpAgent.__init__(self, obs_shape, action_shape, device, hidden_dim, discount, clip_param,
                                ppo_epoch, critic_loss_coef, entropy_coef, lr, eps, grad_clip_norm,
-                               use_clipped_critic_loss, num_batch, si_c, si_epsilon)
+                               use_clipped_critic_loss, num_batch, si_c, si_epsilon, si_accumulate_freq)
 
-    def _save_init_params(self):
-        # set prev_task_params as weight initializations
-        for name, param in chain(self.actor.named_common_parameters(),
-                                 self.critic.named_common_parameters()):
-            if param.requires_grad:
-                self.prev_task_params[name] = param.detach().clone()
-                self.prev_params[name] = param.detach().clone()
-
-    def update_omegas(self):
-        for name, param in chain(self.actor.named_common_parameters(),
-                                 self.critic.named_common_parameters()):
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                current_param = param.detach().clone()
-                delta_param = current_param - prev_param
-                current_omega = self.params_w[name] / (delta_param ** 2 + self.si_epsilon)
-
-                self.prev_task_params[name] = current_param
-                self.omegas[name] = current_omega + self.omegas.get(name, torch.zeros_like(param))
-
-        # clear importance buffers for the next task
-        self.params_w = {}
-
-    def _estimate_importance(self):
-        for name, param in chain(self.actor.named_common_parameters(),
-                                 self.critic.named_common_parameters()):
-            if param.requires_grad:
-                self.params_w[name] = \
-                    -param.grad.detach() * (param.detach() - self.prev_params[name]) + \
-                    self.params_w.get(name, torch.zeros_like(param))
-                self.prev_params[name] = param.detach().clone()
+    def _named_si_parameters(self):
+        return chain(self.actor.named_common_parameters(),
+                     self.critic.named_common_parameters())
 
     def update(self, rollouts, logger, step, **kwargs):
         advantages = rollouts.returns[:-1] - rollouts.value_preds[:-1]
@@ -2,6 +2,8 @@ import torch
 from itertools import chain
 from collections.abc import Iterable
 
+import utils
+
 from agent.ppo.base_ppo_agent import PpoMlpAgent
 
 
@@ -24,6 +26,7 @@ class SiPpoMlpAgentV2(PpoMlpAgent):
                  num_batch=32,
                  si_c=1.0,
                  si_epsilon=0.1,
+                 si_accumulate_freq=1,
                  ):
         super().__init__(obs_shape, action_shape, device, hidden_dim, discount, clip_param, ppo_epoch,
                          critic_loss_coef, entropy_coef, lr, eps, grad_clip_norm, use_clipped_critic_loss,
@@ -32,54 +35,24 @@ class SiPpoMlpAgentV2(PpoMlpAgent):
         self.si_c = si_c
         self.si_epsilon = si_epsilon
 
-        self.params_w = {}
-        self.omegas = {}
-        self.prev_params = {}
-        self.prev_task_params = {}
+        self.si_accumulate_freq = si_accumulate_freq
 
-        self._save_init_params()
+        self.si_path_integral = utils.SiPathIntegral(self._named_si_parameters(), si_epsilon,
+                                                     si_accumulate_freq)
 
-    def _save_init_params(self):
-        # set prev_task_params as weight initializations
-        for name, param in self.actor.named_parameters():
-            if param.requires_grad:
-                self.prev_task_params[name] = param.detach().clone()
-                self.prev_params[name] = param.detach().clone()
+    def _named_si_parameters(self):
+        return self.actor.named_parameters()
 
     def update_omegas(self):
-        for name, param in self.actor.named_parameters():
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                current_param = param.detach().clone()
-                delta_param = current_param - prev_param
-                current_omega = self.params_w[name] / (delta_param ** 2 + self.si_epsilon)
-
-                self.prev_task_params[name] = current_param
-                self.omegas[name] = current_omega + self.omegas.get(name, torch.zeros_like(param))
-
-        # clear importance buffers for the next task
-        self.params_w = {}
+        self.si_path_integral.consolidate()
 
     def _estimate_importance(self):
-        for name, param in self.actor.named_parameters():
-            if param.requires_grad:
-                self.params_w[name] = \
-                    -param.grad.detach() * (param.detach() - self.prev_params[name]) + \
-                    self.params_w.get(name, torch.zeros_like(param))
-                self.prev_params[name] = param.detach().clone()
+        self.si_path_integral.accumulate()
 
     def _compute_surrogate_loss(self, named_parameters):
         assert isinstance(named_parameters, Iterable)
 
-        si_losses = []
-        for name, param in named_parameters:
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                omega = self.omegas.get(name, torch.zeros_like(param))
-                si_loss = torch.sum(omega * (param - prev_param) ** 2)
-                si_losses.append(si_loss)
-
-        return torch.sum(torch.stack(si_losses))
+        return self.si_path_integral.penalty(named_parameters)
 
     def update(self, rollouts, logger, step, **kwargs):
         advantages = rollouts.returns[:-1] - rollouts.value_preds[:-1]
@@ -124,29 +97,11 @@ class SiPpoMlpAgentV2(PpoMlpAgent):
     def save(self, model_dir, step):
         super().save(model_dir, step)
         torch.save(
-            self.prev_params, '%s/prev_params_%s.pt' % (model_dir, step)
-        )
-        torch.save(
-            self.params_w, '%s/params_w_%s.pt' % (model_dir, step)
-        )
-        torch.save(
-            self.omegas, '%s/omegas_%s.pt' % (model_dir, step)
-        )
-        torch.save(
-            self.prev_task_params, '%s/prev_task_params_%s.pt' % (model_dir, step)
+            self.si_path_integral.state_dict(), '%s/si_path_integral_%s.pt' % (model_dir, step)
         )
 
     def load(self, model_dir, step):
         super().load(model_dir, step)
-        self.prev_params = torch.load(
-            '%s/prev_params_%s.pt' % (model_dir, step)
-        )
-        self.params_w = torch.load(
-            '%s/params_w_%s.pt' % (model_dir, step)
-        )
-        self.omegas = torch.load(
-            '%s/omegas_%s.pt' % (model_dir, step)
-        )
-        self.prev_task_params = torch.load(
-            '%s/prev_task_params_%s.pt' % (model_dir, step)
-        )
+        self.si_path_integral.load_state_dict(torch.load(
+            '%s/si_path_integral_%s.pt' % (model_dir, step)
+        ))
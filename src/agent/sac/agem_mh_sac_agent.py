@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 
+import utils
 from agent.sac import MultiHeadSacMlpAgent, AgemSacMlpAgent
 
 
@@ -58,11 +59,7 @@ class AgemMultiHeadSacMlpAgent(MultiHeadSacMlpAgent, AgemSacMlpAgent):
             self.critic_optimizer.zero_grad()  # clear current gradient
             critic_loss.backward()
 
-            single_ref_critic_grad = []
-            for param in self.critic.common_parameters():
-                if param.requires_grad:
-                    single_ref_critic_grad.append(param.grad.detach().clone().flatten())
-            single_ref_critic_grad = torch.cat(single_ref_critic_grad)
+            single_ref_critic_grad = utils.get_flat_grad(self.critic.common_parameters()).clone()
             self.critic_optimizer.zero_grad()
 
             _, actor_loss, alpha_loss = self.compute_actor_and_alpha_loss(
@@ -70,11 +67,7 @@ class AgemMultiHeadSacMlpAgent(MultiHeadSacMlpAgent, AgemSacMlpAgent):
             self.actor_optimizer.zero_grad()  # clear current gradient
             actor_loss.backward()
 
-            single_ref_actor_grad = []
-            for param in self.actor.common_parameters():
-                if param.requires_grad:
-                    single_ref_actor_grad.append(param.grad.detach().clone().flatten())
-            single_ref_actor_grad = torch.cat(single_ref_actor_grad)
+            single_ref_actor_grad = utils.get_flat_grad(self.actor.common_parameters()).clone()
             self.actor_optimizer.zero_grad()
 
             if compute_alpha_ref_grad:
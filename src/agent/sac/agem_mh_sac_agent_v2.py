@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 
+import utils
 from agent.sac import MultiHeadSacMlpAgentV2, AgemSacMlpAgentV2
 
 
@@ -69,11 +70,7 @@ class AgemMultiHeadSacMlpAgentV2(MultiHeadSacMlpAgentV2, AgemSacMlpAgentV2):
             self.actor_optimizer.zero_grad()  # clear current gradient
             actor_loss.backward()
 
-            single_ref_actor_grad = []
-            for param in self.actor.common_parameters():
-                if param.requires_grad:
-                    single_ref_actor_grad.append(param.grad.detach().clone().flatten())
-            single_ref_actor_grad = torch.cat(single_ref_actor_grad)
+            single_ref_actor_grad = utils.get_flat_grad(self.actor.common_parameters()).clone()
             self.actor_optimizer.zero_grad()
 
             # if compute_alpha_ref_grad:
@@ -38,6 +38,7 @@ class AgemSacMlpAgent(SacMlpAgent):
 
         self.agem_task_count = 0
         self.agem_memories = {}
+        self._agem_memory_cache = utils.TaskMemoryCache()
 
     def _adjust_memory_size(self, size):
         for mem in self.agem_memories.values():
@@ -52,60 +53,38 @@ class AgemSacMlpAgent(SacMlpAgent):
         if not self.agem_memories:
             return None, None, None
 
-        ref_critic_grad = []
-        ref_actor_grad = []
-        ref_alpha_grad = []
-        for memory in self.agem_memories.values():
-            idxs = np.random.randint(
-                0, len(memory['obses']), size=self.agem_ref_grad_batch_size // self.agem_task_count
-            )
-
-            obs, action, reward, next_obs, not_done = \
-                memory['obses'][idxs], memory['actions'][idxs], memory['rewards'][idxs], \
-                memory['next_obses'][idxs], memory['not_dones'][idxs]
-
-            critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done)
-            self.critic_optimizer.zero_grad()  # clear current gradient
-            critic_loss.backward()
-
-            single_ref_critic_grad = []
-            for param in self.critic.parameters():
-                if param.requires_grad:
-                    single_ref_critic_grad.append(param.grad.detach().clone().flatten())
-            single_ref_critic_grad = torch.cat(single_ref_critic_grad)
-            self.critic_optimizer.zero_grad()
-
-            _, actor_loss, alpha_loss = self.compute_actor_and_alpha_loss(
-                obs, compute_alpha_loss=compute_alpha_ref_grad)
-            self.actor_optimizer.zero_grad()  # clear current gradient
-            actor_loss.backward()
-
-            single_ref_actor_grad = []
-            for param in self.actor.parameters():
-                if param.requires_grad:
-                    single_ref_actor_grad.append(param.grad.detach().clone().flatten())
-            single_ref_actor_grad = torch.cat(single_ref_actor_grad)
-            self.actor_optimizer.zero_grad()
-
-            if compute_alpha_ref_grad:
-                self.log_alpha_optimizer.zero_grad()  # clear current gradient
-                alpha_loss.backward()
-                single_ref_alpha_grad = self.log_alpha.grad.detach().clone()
-                self.log_alpha_optimizer.zero_grad()
-            else:
-                single_ref_alpha_grad = None
-
-            ref_critic_grad.append(single_ref_critic_grad)
-            ref_actor_grad.append(single_ref_actor_grad)
-            if single_ref_alpha_grad is not None:
-                ref_alpha_grad.append(single_ref_alpha_grad)
-            else:
-                ref_alpha_grad = None
-
-        ref_critic_grad = torch.stack(ref_critic_grad).mean(dim=0)
-        ref_actor_grad = torch.stack(ref_actor_grad).mean(dim=0)
-        if ref_alpha_grad is not None:
-            ref_alpha_grad = torch.stack(ref_alpha_grad).mean(dim=0)
+        # every task memory contributes agem_ref_grad_batch_size // agem_task_count transitions, so the gradient
+        # of the mean loss over the batch is the mean of the per-task reference gradients
+        keys = ['obses', 'actions', 'rewards', 'next_obses', 'not_dones']
+        memories = list(self.agem_memories.values())
+        self._agem_memory_cache.update(
+            [memory[key] for memory in memories for key in keys],
+            lambda: [{key: memory[key] for key in keys} for memory in memories])
+        batch = self._agem_memory_cache.sample(self.agem_ref_grad_batch_size // self.agem_task_count)
+        obs, action, reward, next_obs, not_done = \
+            batch['obses'], batch['actions'], batch['rewards'], batch['next_obses'], batch['not_dones']
+
+        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done)
+        self.critic_optimizer.zero_grad()  # clear current gradient
+        critic_loss.backward()
+
+        ref_critic_grad = utils.get_flat_grad(self.critic.parameters()).clone()
+        self.critic_optimizer.zero_grad()
+
+        _, actor_loss, alpha_loss = self.compute_actor_and_alpha_loss(
+            obs, compute_alpha_loss=compute_alpha_ref_grad)
+        self.actor_optimizer.zero_grad()  # clear current gradient
+        actor_loss.backward()
+
+        ref_actor_grad = utils.get_flat_grad(self.actor.parameters()).clone()
+        self.actor_optimizer.zero_grad()
+
+        ref_alpha_grad = None
+        if compute_alpha_ref_grad:
+            self.log_alpha_optimizer.zero_grad()  # clear current gradient
+            alpha_loss.backward()
+            ref_alpha_grad = self.log_alpha.grad.detach().clone()
+            self.log_alpha_optimizer.zero_grad()
 
         return ref_critic_grad, ref_actor_grad, ref_alpha_grad
 
@@ -115,24 +94,18 @@ class AgemSacMlpAgent(SacMlpAgent):
         if ref_grad is None:
             return
 
-        grad = []
-        for param in parameters:
-            if param.requires_grad:
-                grad.append(param.grad.flatten())
-        grad = torch.cat(grad)
+        parameters = list(parameters)
+        grad = utils.get_flat_grad(parameters)
 
+        # the reference gradient of a single parameter such as log_alpha may be 0-d
+        ref_grad = ref_grad.reshape(-1)
         # inequality constrain
-        angle = (grad * ref_grad).sum()
+        angle = torch.dot(grad, ref_grad)
         if angle < 0:
             # project the gradient of the current transitions onto the gradient of the memory transitions ...
-            proj_grad = grad - (angle / (ref_grad * ref_grad).sum()) * ref_grad
+            proj_grad = grad - (angle / torch.dot(ref_grad, ref_grad)) * ref_grad
             # replace all the gradients within the model with this projected gradient
-            idx = 0
-            for param in parameters:
-                if param.requires_grad:
-                    num_param = param.numel()  # number of parameters in [p]
-                    param.grad.copy_(proj_grad[idx:idx + num_param].reshape(param.shape))
-                    idx += num_param
+            utils.set_flat_grad(parameters, proj_grad)
 
     def construct_memory(self, replay_buffer):
         memory_size_per_task = self.agem_memory_budget // (self.agem_task_count + 1)
@@ -187,13 +160,12 @@ class AgemSacMlpAgent(SacMlpAgent):
             self.log_alpha_optimizer.step()
 
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
         ref_critic_grad, ref_actor_grad, ref_alpha_grad = self._compute_ref_grad()
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         self.update_critic(critic_loss, logger, step, ref_critic_grad=ref_critic_grad)
 
         if step % self.actor_update_freq == 0:
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 
+import utils
 from agent.sac import MultiInputSacMlpAgentV2, AgemV2SacMlpAgentV2
 
 
@@ -61,11 +62,7 @@ class AgemV2MultiInputSacMlpAgentV2(MultiInputSacMlpAgentV2, AgemV2SacMlpAgentV2
             self.actor_optimizer.zero_grad()  # clear current gradient
             proj_actor_loss.backward()
 
-            single_ref_actor_grad = []
-            for param in self.actor.common_parameters():
-                if param.requires_grad:
-                    single_ref_actor_grad.append(param.grad.detach().clone().flatten())
-            single_ref_actor_grad = torch.cat(single_ref_actor_grad)
+            single_ref_actor_grad = utils.get_flat_grad(self.actor.common_parameters()).clone()
             self.actor_optimizer.zero_grad()
 
             ref_actor_grad.append(single_ref_actor_grad)
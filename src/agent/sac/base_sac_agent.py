@@ -4,6 +4,7 @@ import numpy as np
 import torch.nn.functional as F
 
 import utils
+from buffers import PrioritizedReplayBuffer, PresampledBuffer
 from agent.network import SacActorMlp, SacCriticMlp
 
 
@@ -27,6 +28,8 @@ class SacMlpAgent:
             critic_tau=0.005,
             critic_target_update_freq=2,
             batch_size=128,
+            fused_update=False,
+            num_critics=2,
     ):
         self.obs_shape = obs_shape
         self.action_shape = action_shape
@@ -45,6 +48,8 @@ class SacMlpAgent:
         self.critic_tau = critic_tau
         self.critic_target_update_freq = critic_target_update_freq
         self.batch_size = batch_size
+        self.fused_update = fused_update
+        self.num_critics = num_critics
 
         self.training = False
 
@@ -59,11 +64,11 @@ class SacMlpAgent:
         ).to(self.device)
 
         self.critic = SacCriticMlp(
-            self.obs_shape, self.action_shape, self.critic_hidden_dim
+            self.obs_shape, self.action_shape, self.critic_hidden_dim, self.num_critics
         ).to(self.device)
 
         self.critic_target = SacCriticMlp(
-            self.obs_shape, self.action_shape, self.critic_hidden_dim
+            self.obs_shape, self.action_shape, self.critic_hidden_dim, self.num_critics
         ).to(self.device)
 
         self.reset_target_critic()
@@ -88,6 +93,14 @@ class SacMlpAgent:
         self.critic.train(training)
         self.critic_target.train(training)
 
+    def flatten_parameters(self):
+        """Back the parameters and gradients of each network by contiguous buffers, see utils.FlatParams"""
+        self.actor_flat_params = utils.FlatParams(self.actor.parameters())
+        self.critic_flat_params = utils.FlatParams(self.critic.parameters())
+        self.critic_target_flat_params = utils.FlatParams(self.critic_target.parameters())
+        utils.FlatParams.zero_grad_in_place(
+            *[value for value in vars(self).values() if isinstance(value, torch.optim.Optimizer)])
+
     def reset(self, reset_critic=False):
         if reset_critic:
             self.critic.load_state_dict(self._critic_init_state)
@@ -113,24 +126,38 @@ class SacMlpAgent:
             mu, pi, _, _ = self.actor(obs, compute_log_pi=False, **kwargs)
             action = pi if sample else mu
             action = action.clamp(*self.action_range)
-            assert action.ndim == 2 and action.shape[0] == 1
+            assert action.ndim == 2
 
         return utils.to_np(action)
 
-    def compute_critic_loss(self, obs, action, reward, next_obs, not_done, **kwargs):
+    def compute_target_q(self, reward, next_obs, not_done, **kwargs):
         with torch.no_grad():
             _, policy_action, log_pi, _ = self.actor(next_obs, **kwargs)
-            target_Q1, target_Q2 = self.critic_target(next_obs, policy_action, **kwargs)
-            target_V = torch.min(target_Q1,
-                                 target_Q2) - self.alpha.detach() * log_pi
+            target_Qs = self.critic_target.forward_ensemble(next_obs, policy_action, **kwargs)
+            target_V = target_Qs.min(dim=0)[0] - self.alpha.detach() * log_pi
             target_Q = reward + (not_done * self.discount * target_V)
 
+        return target_Q
+
+    def compute_critic_loss(self, obs, action, reward, next_obs, not_done, **kwargs):
+        target_Q = self.compute_target_q(reward, next_obs, not_done, **kwargs)
+
         # get current Q estimates
-        current_Q1, current_Q2 = self.critic(obs, action, **kwargs)
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+        current_Qs = self.critic.forward_ensemble(obs, action, **kwargs)
+        critic_loss = sum(F.mse_loss(current_Q, target_Q) for current_Q in current_Qs)
 
         return critic_loss
 
+    def compute_weighted_critic_loss(self, obs, action, reward, next_obs, not_done, weights, **kwargs):
+        """Importance weighted critic loss for prioritized replay, also returns the new priorities"""
+        target_Q = self.compute_target_q(reward, next_obs, not_done, **kwargs)
+
+        td_errors = self.critic.forward_ensemble(obs, action, **kwargs) - target_Q
+        critic_loss = (weights * (td_errors ** 2).sum(dim=0)).mean()
+        priorities = td_errors.abs().mean(dim=0).detach()
+
+        return critic_loss, priorities
+
     def update_critic(self, critic_loss, logger, step, **kwargs):
         # Optimize the critic
         logger.log('train_critic/loss', critic_loss, step)
@@ -140,9 +167,7 @@ class SacMlpAgent:
 
     def compute_actor_and_alpha_loss(self, obs, compute_alpha_loss=True, **kwargs):
         _, pi, log_pi, log_std = self.actor(obs, **kwargs)
-        actor_Q1, actor_Q2 = self.critic(obs, pi, **kwargs)
-
-        actor_Q = torch.min(actor_Q1, actor_Q2)
+        actor_Q = self.critic.forward_ensemble(obs, pi, **kwargs).min(dim=0)[0]
         actor_loss = (self.alpha.detach() * log_pi - actor_Q).mean()
 
         alpha_loss = None
@@ -169,12 +194,34 @@ class SacMlpAgent:
             alpha_loss.backward()
             self.log_alpha_optimizer.step()
 
+    def compute_sampled_critic_loss(self, replay_buffer, **kwargs):
+        """Sample a minibatch and compute its critic loss
+
+        Prioritized buffers are sampled with importance weights and their priorities are updated with the TD errors.
+        """
+        if isinstance(replay_buffer, PrioritizedReplayBuffer):
+            obs, action, reward, next_obs, not_done, weights, idxs = replay_buffer.sample(
+                self.batch_size, return_weights=True)
+            critic_loss, priorities = self.compute_weighted_critic_loss(
+                obs, action, reward, next_obs, not_done, weights, **kwargs)
+            replay_buffer.update_priorities(idxs, priorities)
+        else:
+            obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+            critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
+
+        return obs, action, reward, next_obs, not_done, critic_loss
+
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        if self.fused_update and not isinstance(replay_buffer, PrioritizedReplayBuffer):
+            obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+            logger.log('train/batch_reward', reward.mean(), step)
+            self.update_fused(obs, action, reward, next_obs, not_done, logger, step, **kwargs)
+            return
+
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         self.update_critic(critic_loss, logger, step)
 
         if step % self.actor_update_freq == 0:
@@ -185,6 +232,76 @@ class SacMlpAgent:
             utils.soft_update_params(self.critic, self.critic_target,
                                      self.critic_tau)
 
+    def update_fused(self, obs, action, reward, next_obs, not_done, logger, step, **kwargs):
+        """SAC update with one actor forward on [obs; next_obs] and one online critic forward on
+        [(obs, action); (obs, pi)]
+
+        Unlike update(), the actor loss uses the critic from before this step's critic update.
+        """
+        batch_size = obs.size(0)
+        update_actor = step % self.actor_update_freq == 0
+
+        _, pi, log_pi, _ = self.actor(torch.cat([obs, next_obs], dim=0), **kwargs)
+        next_pi, next_log_pi = pi[batch_size:].detach(), log_pi[batch_size:].detach()
+        pi, log_pi = pi[:batch_size], log_pi[:batch_size]
+
+        with torch.no_grad():
+            target_Qs = self.critic_target.forward_ensemble(next_obs, next_pi)
+            target_V = target_Qs.min(dim=0)[0] - self.alpha.detach() * next_log_pi
+            target_Q = reward + (not_done * self.discount * target_V)
+
+        Qs = self.critic.forward_ensemble(torch.cat([obs, obs], dim=0), torch.cat([action, pi], dim=0))
+        critic_loss = sum(F.mse_loss(current_Q, target_Q) for current_Q in Qs[:, :batch_size])
+
+        # keep the gradients of the two losses apart, the actor loss must not update the critic.
+        # both are computed before any optimizer step modifies the parameters in the graph
+        critic_params = list(self.critic.parameters())
+        critic_grads = torch.autograd.grad(critic_loss, critic_params, retain_graph=update_actor, allow_unused=True)
+        if update_actor:
+            actor_Q = Qs[:, batch_size:].min(dim=0)[0]
+            actor_loss = (self.alpha.detach() * log_pi - actor_Q).mean()
+            alpha_loss = (self.alpha * (-log_pi - self.target_entropy).detach()).mean()
+
+            actor_params = list(self.actor.parameters())
+            actor_grads = torch.autograd.grad(actor_loss, actor_params, allow_unused=True)
+            utils.assign_grads(actor_params, actor_grads)
+            self.log_alpha_optimizer.zero_grad()
+            alpha_loss.backward()
+
+        utils.assign_grads(critic_params, critic_grads)
+        logger.log('train_critic/loss', critic_loss, step)
+        self.critic_optimizer.step()
+
+        if update_actor:
+            logger.log('train_actor/loss', actor_loss, step)
+            logger.log('train/target_entropy', self.target_entropy, step)
+            logger.log('train/entropy', -log_pi.mean(), step)
+            self.actor_optimizer.step()
+
+            logger.log('train_alpha/loss', alpha_loss, step)
+            logger.log('train_alpha/value', self.alpha, step)
+            self.log_alpha_optimizer.step()
+
+        if step % self.critic_target_update_freq == 0:
+            utils.soft_update_params(self.critic, self.critic_target,
+                                     self.critic_tau)
+
+    def update_many(self, replay_buffer, logger, step, num_updates, **kwargs):
+        """Run num_updates updates on minibatches drawn at once with replay_buffer.sample_many
+
+        Prioritized buffers and buffers prefetching minibatches of batch_size are sampled once per update instead.
+        """
+        if isinstance(replay_buffer, PrioritizedReplayBuffer) or \
+                getattr(replay_buffer, 'prefetch_batch_size', None) == self.batch_size:
+            # priorities change after every update, prefetched minibatches are served by sample()
+            for _ in range(num_updates):
+                self.update(replay_buffer, logger, step, **kwargs)
+            return
+
+        presampled_buffer = PresampledBuffer(replay_buffer.sample_many(self.batch_size, num_updates))
+        for _ in range(num_updates):
+            self.update(presampled_buffer, logger, step, **kwargs)
+
     def save(self, model_dir, step):
         torch.save(
             self.actor.state_dict(), '%s/actor_%s.pt' % (model_dir, step)
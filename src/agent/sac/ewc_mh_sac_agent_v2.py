@@ -29,6 +29,7 @@ class EwcMultiHeadSacMlpAgentV2(MultiHeadSacMlpAgentV2, EwcSacMlpAgentV2):
                  ewc_estimate_fisher_batch_size=1024,
                  online_ewc=False,
                  online_ewc_gamma=1.0,
+                 ewc_fisher_chunk_size=0,
                  ):
         MultiHeadSacMlpAgentV2.__init__(self, obs_shape, action_shape, action_range, device, actor_hidden_dim,
                                         critic_hidden_dim, discount, init_temperature, alpha_lr, actor_lr,
@@ -39,7 +40,7 @@ class EwcMultiHeadSacMlpAgentV2(MultiHeadSacMlpAgentV2, EwcSacMlpAgentV2):
                                   critic_hidden_dim, discount, init_temperature, alpha_lr, actor_lr, actor_log_std_min,
                                   actor_log_std_max, actor_update_freq, critic_lr, critic_tau,
                                   critic_target_update_freq, batch_size, ewc_lambda, ewc_estimate_fisher_iters,
-                                  ewc_estimate_fisher_batch_size, online_ewc, online_ewc_gamma)
+                                  ewc_estimate_fisher_batch_size, online_ewc, online_ewc_gamma, ewc_fisher_chunk_size)
 
     def estimate_fisher(self, replay_buffer, **kwargs):
         # TODO (chongyi zheng): save trajectory for KL divergence
@@ -49,6 +50,16 @@ class EwcMultiHeadSacMlpAgentV2(MultiHeadSacMlpAgentV2, EwcSacMlpAgentV2):
             obs, action, reward, next_obs, not_done = replay_buffer.sample(
                 self.ewc_estimate_fisher_batch_size)
 
+            if self.ewc_fisher_chunk_size > 0:
+                # mean of the squared per-sample gradients instead of the squared minibatch gradient
+                batch_fishers = utils.per_sample_fisher(
+                    self.actor.named_common_parameters(), [self.actor],
+                    lambda obs: self.compute_actor_and_alpha_loss(obs, compute_alpha_loss=False, **kwargs)[1],
+                    (obs,), self.ewc_fisher_chunk_size)
+                for name, fisher in batch_fishers.items():
+                    fishers[name] = fisher + fishers.get(name, torch.zeros_like(fisher))
+                continue
+
             # TODO (chongyi zheng): delete this block
             # critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
             # self.critic_optimizer.zero_grad()
@@ -74,27 +85,15 @@ class EwcMultiHeadSacMlpAgentV2(MultiHeadSacMlpAgentV2, EwcSacMlpAgentV2):
             if param.requires_grad:
                 fisher = fishers[name]
 
-                if self.online_ewc:
-                    name = name + '_prev_task'
-                    self.prev_task_params[name] = param.detach().clone()
-                    self.prev_task_fishers[name] = \
-                        fisher / self.ewc_estimate_fisher_iters + \
-                        self.online_ewc_gamma * self.prev_task_fishers.get(
-                            name, torch.zeros_like(param.grad))
-                else:
-                    name = name + f'_prev_task{self.ewc_task_count}'
-                    self.prev_task_params[name] = param.detach().clone()
-                    self.prev_task_fishers[name] = \
-                        fisher / self.ewc_estimate_fisher_iters
+                self.ewc_consolidation.consolidate(name, param, fisher / self.ewc_estimate_fisher_iters)
 
         self.ewc_task_count += 1
 
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         # TODO (chongyi zheng): delete this block
         # critic_ewc_loss = self._compute_ewc_loss(self.critic.named_common_parameters())
         # critic_loss = critic_loss + self.ewc_lambda * critic_ewc_loss
@@ -31,6 +31,7 @@ class EwcSacMlpAgent(SacMlpAgent):
                  ewc_estimate_fisher_batch_size=1024,
                  online_ewc=False,
                  online_ewc_gamma=1.0,
+                 ewc_fisher_chunk_size=0,
                  ):
         super().__init__(obs_shape, action_shape, action_range, device, actor_hidden_dim, critic_hidden_dim, discount,
                          init_temperature, alpha_lr, actor_lr, actor_log_std_min, actor_log_std_max,
@@ -41,10 +42,29 @@ class EwcSacMlpAgent(SacMlpAgent):
         self.ewc_estimate_fisher_batch_size = ewc_estimate_fisher_batch_size
         self.online_ewc = online_ewc
         self.online_ewc_gamma = online_ewc_gamma
+        self.ewc_fisher_chunk_size = ewc_fisher_chunk_size
 
         self.ewc_task_count = 0
-        self.prev_task_params = {}
-        self.prev_task_fishers = {}
+        self.ewc_consolidation = utils.EwcConsolidation(online_ewc, online_ewc_gamma)
+
+    def _per_sample_fishers(self, critic_named_parameters, actor_named_parameters, obs, action, reward,
+                            next_obs, not_done, **kwargs):
+        """Mean squared per-sample gradients of the critic, actor and alpha losses, see utils.per_sample_fisher()"""
+        fishers = utils.per_sample_fisher(
+            critic_named_parameters, [self.critic],
+            lambda *batch: self.compute_critic_loss(*batch, **kwargs),
+            (obs, action, reward, next_obs, not_done), self.ewc_fisher_chunk_size)
+        fishers.update(utils.per_sample_fisher(
+            actor_named_parameters, [self.actor],
+            lambda obs: self.compute_actor_and_alpha_loss(obs, compute_alpha_loss=False, **kwargs)[1],
+            (obs,), self.ewc_fisher_chunk_size))
+
+        # the gradient of alpha * (-log_pi - target_entropy) w.r.t. log_alpha is the loss itself
+        with torch.no_grad():
+            _, _, log_pi, _ = self.actor(obs, **kwargs)
+            fishers['log_alpha'] = torch.mean((self.alpha * (-log_pi - self.target_entropy)) ** 2)
+
+        return fishers
 
     def estimate_fisher(self, replay_buffer, **kwargs):
         fishers = {}
@@ -53,6 +73,15 @@ class EwcSacMlpAgent(SacMlpAgent):
                 obs, action, reward, next_obs, not_done = replay_buffer.sample(
                     self.ewc_estimate_fisher_batch_size)
 
+                if self.ewc_fisher_chunk_size > 0:
+                    # mean of the squared per-sample gradients instead of the squared minibatch gradient
+                    batch_fishers = self._per_sample_fishers(
+                        self.critic.named_parameters(), self.actor.named_parameters(),
+                        obs, action, reward, next_obs, not_done, **kwargs)
+                    for name, fisher in batch_fishers.items():
+                        fishers[name] = fisher + fishers.get(name, torch.zeros_like(fisher))
+                    continue
+
                 critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
                 self.critic_optimizer.zero_grad()
                 critic_loss.backward()
@@ -79,55 +108,24 @@ class EwcSacMlpAgent(SacMlpAgent):
             if param.requires_grad:
                 fisher = fishers[name]
 
-                if self.online_ewc:
-                    name = name + '_prev_task'
-                    self.prev_task_params[name] = param.detach().clone()
-                    self.prev_task_fishers[name] = \
-                        fisher / self.ewc_estimate_fisher_iters + \
-                        self.online_ewc_gamma * self.prev_task_fishers.get(
-                            name, torch.zeros_like(param.grad))
-                else:
-                    name = name + f'_prev_task{self.ewc_task_count}'
-                    self.prev_task_params[name] = param.detach().clone()
-                    self.prev_task_fishers[name] = \
-                        fisher / self.ewc_estimate_fisher_iters
+                self.ewc_consolidation.consolidate(name, param, fisher / self.ewc_estimate_fisher_iters)
 
         self.ewc_task_count += 1
 
     def _compute_ewc_loss(self, named_parameters):
         assert isinstance(named_parameters, Iterable), "'named_parameters' must be a iterator"
 
-        ewc_losses = []
         if self.ewc_task_count >= 1:
-            if self.online_ewc:
-                for name, param in named_parameters:
-                    if param.grad is not None:
-                        name = name + '_prev_task'
-                        mean = self.prev_task_params[name]
-                        # apply decay-term to the running sum of the Fisher Information matrices
-                        fisher = self.online_ewc_gamma * self.prev_task_fishers[name]
-                        ewc_loss = torch.sum(fisher * (param - mean) ** 2)
-                        ewc_losses.append(ewc_loss)
-            else:
-                for task in range(self.ewc_task_count):
-                    # compute ewc loss for each parameter
-                    for name, param in named_parameters:
-                        if param.grad is not None:
-                            name = name + f'_prev_task{task}'
-                            mean = self.prev_task_params[name]
-                            fisher = self.prev_task_fishers[name]
-                            ewc_loss = torch.sum(fisher * (param - mean) ** 2)
-                            ewc_losses.append(ewc_loss)
-            return torch.sum(torch.stack(ewc_losses)) / 2.0
+            return self.ewc_consolidation.penalty(
+                (name, param) for name, param in named_parameters if param.grad is not None)
         else:
             return torch.tensor(0.0, device=self.device)
 
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         critic_ewc_loss = self._compute_ewc_loss(self.critic.named_parameters())
         critic_loss = critic_loss + self.ewc_lambda * critic_ewc_loss
         self.update_critic(critic_loss, logger, step)
@@ -148,11 +146,11 @@ class EwcSacMlpAgent(SacMlpAgent):
     def save(self, model_dir, step):
         super().save(model_dir, step)
         torch.save(
-            self.prev_task_params, '%s/prev_task_params_%s.pt' % (model_dir, step)
+            self.ewc_consolidation.state_dict(), '%s/ewc_consolidation_%s.pt' % (model_dir, step)
         )
 
     def load(self, model_dir, step):
         super().load(model_dir, step)
-        self.prev_task_params = torch.load(
-            '%s/prev_task_params_%s.pt' % (model_dir, step)
-        )
+        self.ewc_consolidation.load_state_dict(torch.load(
+            '%s/ewc_consolidation_%s.pt' % (model_dir, step)
+        ))
@@ -65,6 +65,8 @@ class MultiInputSacMlpAgentV2(SacMlpAgent):
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=self.critic_lr)
 
         self.log_alpha_optimizer = torch.optim.Adam([self.log_alpha], lr=self.alpha_lr)
+        # the heads of other tasks stay as they are
+        utils.skip_inactive_heads(self.actor_optimizer)
 
         # save initial parameters
         self._critic_init_state = copy.deepcopy(self.critic.state_dict())
@@ -78,6 +80,6 @@ class MultiInputSacMlpAgentV2(SacMlpAgent):
             action = pi if sample else mu
             assert 'head_idx' in kwargs
             action = action.clamp(*self.action_range[kwargs['head_idx']])
-            assert action.ndim == 2 and action.shape[0] == 1
+            assert action.ndim == 2
 
         return utils.to_np(action)
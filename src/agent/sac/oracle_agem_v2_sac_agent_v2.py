@@ -73,11 +73,7 @@ class OracleAgemV2SacMlpAgentV2(SacMlpAgent):
             self.actor_optimizer.zero_grad()  # clear current gradient
             actor_proj_loss.backward()
 
-            single_ref_actor_grad = []
-            for param in self.actor.parameters():
-                if param.requires_grad:
-                    single_ref_actor_grad.append(param.grad.detach().clone().flatten())
-            single_ref_actor_grad = torch.cat(single_ref_actor_grad)
+            single_ref_actor_grad = utils.get_flat_grad(self.actor.parameters()).clone()
             self.actor_optimizer.zero_grad()
 
             ref_actor_grad.append(single_ref_actor_grad)
@@ -91,24 +87,16 @@ class OracleAgemV2SacMlpAgentV2(SacMlpAgent):
         if ref_grad is None:
             return
 
-        grad = []
-        for param in parameters:
-            if param.requires_grad:
-                grad.append(param.grad.flatten())
-        grad = torch.cat(grad)
+        parameters = list(parameters)
+        grad = utils.get_flat_grad(parameters)
 
         # inequality constrain
-        angle = (grad * ref_grad).sum()
+        angle = torch.dot(grad, ref_grad)
         if angle < 0:
             # project the gradient of the current transitions onto the gradient of the memory transitions ...
-            proj_grad = grad - (angle / (ref_grad * ref_grad).sum()) * ref_grad
+            proj_grad = grad - (angle / torch.dot(ref_grad, ref_grad)) * ref_grad
             # replace all the gradients within the model with this projected gradient
-            idx = 0
-            for param in parameters:
-                if param.requires_grad:
-                    num_param = param.numel()  # number of parameters in [p]
-                    param.grad.copy_(proj_grad[idx:idx + num_param].reshape(param.shape))
-                    idx += num_param
+            utils.set_flat_grad(parameters, proj_grad)
 
     def construct_memory(self, env, **kwargs):
         memory_size_per_task = self.agem_memory_budget // (self.agem_task_count + 1)
@@ -182,11 +170,10 @@ class OracleAgemV2SacMlpAgentV2(SacMlpAgent):
             self.log_alpha_optimizer.step()
 
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         self.update_critic(critic_loss, logger, step)
 
         if step % self.actor_update_freq == 0:
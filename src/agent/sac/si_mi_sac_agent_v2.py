@@ -26,6 +26,7 @@ class SiMultiInputSacMlpAgentV2(MultiInputSacMlpAgentV2, SiSacMlpAgentV2):
                  batch_size=128,
                  si_c=1.0,
                  si_epsilon=0.1,
+                 si_accumulate_freq=1,
                  ):
         MultiInputSacMlpAgentV2.__init__(self, obs_shape, action_shape, action_range, device, actor_hidden_dim,
                                          critic_hidden_dim, discount, init_temperature, alpha_lr, actor_lr,
@@ -35,43 +36,17 @@ class SiMultiInputSacMlpAgentV2(MultiInputSacMlpAgentV2, SiSacMlpAgentV2):
         SiSacMlpAgentV2.__init__(self, obs_shape, action_shape, action_range, device, actor_hidden_dim,
                                  critic_hidden_dim, discount, init_temperature, alpha_lr, actor_lr,
                                  actor_log_std_min, actor_log_std_max, actor_update_freq, critic_lr,
-                                 critic_tau, critic_target_update_freq, batch_size, si_c, si_epsilon)
+                                 critic_tau, critic_target_update_freq, batch_size, si_c, si_epsilon,
+                                 si_accumulate_freq)
 
-    def _save_init_params(self):
-        # set prev_task_params as weight initializations
-        for name, param in self.actor.named_common_parameters():
-            if param.requires_grad:
-                self.prev_task_params[name] = param.detach().clone()
-                self.prev_params[name] = param.detach().clone()
-
-    def update_omegas(self):
-        for name, param in self.actor.named_common_parameters():
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                current_param = param.detach().clone()
-                delta_param = current_param - prev_param
-                current_omega = self.params_w[name] / (delta_param ** 2 + self.si_epsilon)
-
-                self.prev_task_params[name] = current_param
-                self.omegas[name] = current_omega + self.omegas.get(name, torch.zeros_like(param))
-
-        # clear importance buffers for the next task
-        self.params_w = {}
-
-    def _estimate_importance(self):
-        for name, param in self.actor.named_common_parameters():
-            if param.requires_grad:
-                self.params_w[name] = \
-                    -param.grad.detach() * (param.detach() - self.prev_params[name]) + \
-                    self.params_w.get(name, torch.zeros_like(param))
-                self.prev_params[name] = param.detach().clone()
+    def _named_si_parameters(self):
+        return self.actor.named_common_parameters()
 
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         self.update_critic(critic_loss, logger, step)
 
         if step % self.actor_update_freq == 0:
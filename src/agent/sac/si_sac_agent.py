@@ -28,6 +28,7 @@ class SiSacMlpAgent(SacMlpAgent):
                  batch_size=128,
                  si_c=1.0,
                  si_epsilon=0.1,
+                 si_accumulate_freq=1,
                  ):
         super().__init__(obs_shape, action_shape, action_range, device, actor_hidden_dim, critic_hidden_dim,
                          discount, init_temperature, alpha_lr, actor_lr, actor_log_std_min, actor_log_std_max,
@@ -36,67 +37,32 @@ class SiSacMlpAgent(SacMlpAgent):
         self.si_c = si_c
         self.si_epsilon = si_epsilon
 
-        self.params_w = {}
-        self.omegas = {}
-        self.prev_params = {}
-        self.prev_task_params = {}
+        self.si_accumulate_freq = si_accumulate_freq
 
-        self._save_init_params()
+        self.si_path_integral = utils.SiPathIntegral(self._named_si_parameters(), si_epsilon,
+                                                     si_accumulate_freq)
 
-    def _save_init_params(self):
-        # set prev_task_params as weight initializations
-        for name, param in chain(self.actor.named_parameters(),
-                                 self.critic.named_parameters(),
-                                 iter([('log_alpha', self.log_alpha)])):
-            if param.requires_grad:
-                self.prev_task_params[name] = param.detach().clone()
-                self.prev_params[name] = param.detach().clone()
+    def _named_si_parameters(self):
+        return chain(self.actor.named_parameters(),
+                     self.critic.named_parameters(),
+                     iter([('log_alpha', self.log_alpha)]))
 
     def update_omegas(self):
-        for name, param in chain(self.critic.named_parameters(),
-                                 self.actor.named_parameters(),
-                                 iter([('log_alpha', self.log_alpha)])):
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                current_param = param.detach().clone()
-                delta_param = current_param - prev_param
-                current_omega = self.params_w[name] / (delta_param ** 2 + self.si_epsilon)
-
-                self.prev_task_params[name] = current_param
-                self.omegas[name] = current_omega + self.omegas.get(name, torch.zeros_like(param))
-
-        # clear importance buffers for the next task
-        self.params_w = {}
+        self.si_path_integral.consolidate()
 
     def _estimate_importance(self):
-        for name, param in chain(self.critic.named_parameters(),
-                                 self.actor.named_parameters(),
-                                 iter([('log_alpha', self.log_alpha)])):
-            if param.requires_grad:
-                self.params_w[name] = \
-                    -param.grad.detach() * (param.detach() - self.prev_params[name]) + \
-                    self.params_w.get(name, torch.zeros_like(param))
-                self.prev_params[name] = param.detach().clone()
+        self.si_path_integral.accumulate()
 
     def _compute_surrogate_loss(self, named_parameters):
         assert isinstance(named_parameters, Iterable), "'named_parameters' must be a iterator"
 
-        si_losses = []
-        for name, param in named_parameters:
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                omega = self.omegas.get(name, torch.zeros_like(param))
-                si_loss = torch.sum(omega * (param - prev_param) ** 2)
-                si_losses.append(si_loss)
-
-        return torch.sum(torch.stack(si_losses))
+        return self.si_path_integral.penalty(named_parameters)
 
     def update(self, replay_buffer, logger, step, **kwargs):
-        obs, action, reward, next_obs, not_done = replay_buffer.sample(self.batch_size)
+        obs, action, reward, next_obs, not_done, critic_loss = self.compute_sampled_critic_loss(replay_buffer, **kwargs)
 
         logger.log('train/batch_reward', reward.mean(), step)
 
-        critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done, **kwargs)
         critic_si_surrogate_loss = self._compute_surrogate_loss(self.critic.named_parameters())
         critic_loss = critic_loss + self.si_c * critic_si_surrogate_loss
         self.update_critic(critic_loss, logger, step)
@@ -120,29 +86,11 @@ class SiSacMlpAgent(SacMlpAgent):
     def save(self, model_dir, step):
         super().save(model_dir, step)
         torch.save(
-            self.prev_params, '%s/prev_params_%s.pt' % (model_dir, step)
-        )
-        torch.save(
-            self.params_w, '%s/params_w_%s.pt' % (model_dir, step)
-        )
-        torch.save(
-            self.omegas, '%s/omegas_%s.pt' % (model_dir, step)
-        )
-        torch.save(
-            self.prev_task_params, '%s/prev_task_params_%s.pt' % (model_dir, step)
+            self.si_path_integral.state_dict(), '%s/si_path_integral_%s.pt' % (model_dir, step)
         )
 
     def load(self, model_dir, step):
         super().load(model_dir, step)
-        self.prev_params = torch.load(
-            '%s/prev_params_%s.pt' % (model_dir, step)
-        )
-        self.params_w = torch.load(
-            '%s/params_w_%s.pt' % (model_dir, step)
-        )
-        self.omegas = torch.load(
-            '%s/omegas_%s.pt' % (model_dir, step)
-        )
-        self.prev_task_params = torch.load(
-            '%s/prev_task_params_%s.pt' % (model_dir, step)
-        )
+        self.si_path_integral.load_state_dict(torch.load(
+            '%s/si_path_integral_%s.pt' % (model_dir, step)
+        ))
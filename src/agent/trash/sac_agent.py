@@ -1267,7 +1267,7 @@ class SacMlpSSEnsembleAgent:
                 preds = self.ss_fwd_pred_ensem(obs, action)
 
             # (chongyi zheng): the same as equation (1) in https://arxiv.org/abs/1906.04161
-            preds = torch.stack(preds.chunk(self.num_ensem_comps, dim=0))
+            preds = preds.view(self.num_ensem_comps, -1, preds.size(-1))
             preds_var = torch.var(preds, dim=0).sum(dim=-1)
 
             return utils.to_np(preds_var)
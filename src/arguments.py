@@ -39,6 +39,9 @@ def parse_args():
 	parser.add_argument('--mode', default='train', type=str)
 	parser.add_argument('--add_onehot', default=False, type=str2bool)
 	parser.add_argument('--reset_agent', default=False, type=str2bool)
+	parser.add_argument('--inference_server', default=False, action='store_true')  # step vector env workers independently
+	parser.add_argument('--inference_max_wait', default=1e-3, type=float)  # seconds to wait for more ready workers
+	parser.add_argument('--inference_max_lag', default=4, type=int)  # steps a worker may run ahead of the slowest one
 
 	# locomotion tasks
 	parser.add_argument('--pixel_obs', default=False, action='store_true')  # (chongyi zheng)
@@ -55,6 +58,7 @@ def parse_args():
 	parser.add_argument('--train_steps_per_task', default=1000000, type=int)
 	parser.add_argument('--batch_size', default=128, type=int)  # 32 for dqn?
 	parser.add_argument('--device', default='cuda', type=str)
+	parser.add_argument('--flat_params', default=False, action='store_true')  # contiguous parameter / gradient buffers
 
 	# eval
 	parser.add_argument('--save_freq', default=100000, type=int)
@@ -90,6 +94,7 @@ def parse_args():
 	parser.add_argument('--sac_num_expl_steps_per_process', default=1000, type=int)
 	parser.add_argument('--sac_num_processes', default=1, type=int)
 	parser.add_argument('--sac_num_train_iters', default=1000, type=int)
+	parser.add_argument('--sac_update_block_size', default=100, type=int)  # minibatches sampled per transfer
 	parser.add_argument('--sac_actor_hidden_dim', default=400, type=int)  # 1024
 	parser.add_argument('--sac_critic_hidden_dim', default=256, type=int)
 	parser.add_argument('--init_temperature', default=1.0, type=float)  # 0.1
@@ -102,6 +107,11 @@ def parse_args():
 	parser.add_argument('--critic_lr', default=3e-4, type=float)  # 1e-3
 	parser.add_argument('--critic_tau', default=0.005, type=float)  # 0.01
 	parser.add_argument('--critic_target_update_freq', default=1, type=int)  # 1
+	parser.add_argument('--sac_fused_update', default=False, action='store_true')  # shared actor / critic forwards
+	parser.add_argument('--sac_num_critics', default=2, type=int)  # q-functions in the critic ensemble, sac_mlp only
+	parser.add_argument('--sac_async', default=False, action='store_true')  # collect in a separate process while updating
+	parser.add_argument('--sac_async_update_ratio', default=0, type=float)  # max updates per env step, 0 keeps the synchronous ratio
+	parser.add_argument('--sac_async_actor_sync_freq', default=100, type=int)  # updates between collector actor refreshes
 
 	# sac ewc
 	parser.add_argument('--sac_ewc_lambda', default=5000, type=float)
@@ -110,6 +120,7 @@ def parse_args():
 	parser.add_argument('--sac_ewc_estimate_fisher_rollout_steps', default=1000, type=int)
 	parser.add_argument('--sac_online_ewc', default=False, action='store_true')
 	parser.add_argument('--sac_online_ewc_gamma', default=1.0, type=float)
+	parser.add_argument('--sac_ewc_fisher_chunk_size', default=0, type=int)
 
 	# sac agem
 	parser.add_argument('--sac_agem_memory_budget', default=5000, type=int)
@@ -118,6 +129,7 @@ def parse_args():
 	# sac si
 	parser.add_argument('--sac_si_c', default=1.0, type=float)
 	parser.add_argument('--sac_si_epsilon', default=1e-6, type=float)
+	parser.add_argument('--sac_si_accumulate_freq', default=1, type=int)
 
 	# dqn
 	parser.add_argument('--double_q', default=False, action='store_true')
@@ -144,6 +156,7 @@ def parse_args():
 	parser.add_argument('--ppo_use_clipped_critic_loss', default=False, action='store_true')
 	parser.add_argument('--ppo_gae_lambda', default=0.95, type=float)
 	parser.add_argument('--ppo_use_proper_time_limits', default=False, action='store_true')
+	parser.add_argument('--ppo_gae_chunk_size', default=0, type=int)  # > 0 for the vectorized GAE scan
 	parser.add_argument('--ppo_num_batch', default=32, type=int)
 
 	# ppo ewc
@@ -152,6 +165,7 @@ def parse_args():
 	parser.add_argument('--ppo_ewc_rollout_steps_per_process', default=1024, type=int)
 	parser.add_argument('--ppo_online_ewc', default=False, action='store_true')
 	parser.add_argument('--ppo_online_ewc_gamma', default=1.0, type=float)
+	parser.add_argument('--ppo_ewc_fisher_chunk_size', default=0, type=int)
 
 	# ppo agem
 	parser.add_argument('--ppo_agem_memory_budget', default=10240, type=int)
@@ -160,6 +174,7 @@ def parse_args():
 	# ppo si
 	parser.add_argument('--ppo_si_c', default=1.0, type=float)
 	parser.add_argument('--ppo_si_epsilon', default=0.1, type=float)
+	parser.add_argument('--ppo_si_accumulate_freq', default=1, type=int)
 
 	# ppo cmaml
 	parser.add_argument('--ppo_cmaml_inner_grad_steps', default=8, type=int)
@@ -173,6 +188,16 @@ def parse_args():
 	parser.add_argument('--work_dir', default=None, type=str)
 	parser.add_argument('--load_checkpoint', default=None, type=str)
 	parser.add_argument('--replay_buffer_capacity', default=1000000, type=int)  # (chongyi zheng), 100000
+	parser.add_argument('--replay_buffer_on_disk', default=False, action='store_true')  # np.memmap under work_dir
+	parser.add_argument('--replay_buffer_num_prefetch', default=0, type=int)  # 0 disables background sampling
+	parser.add_argument('--persistent_replay_buffer', default=False, action='store_true')  # keep earlier tasks' data
+	parser.add_argument('--prioritized_replay', default=False, action='store_true')  # sum-tree prioritized sampling
+	parser.add_argument('--prioritized_replay_alpha', default=0.6, type=float)
+	parser.add_argument('--prioritized_replay_beta', default=0.4, type=float)
+	parser.add_argument('--prioritized_replay_eps', default=1e-6, type=float)
+	parser.add_argument('--obs_storage_dtype', default='float32', type=str,
+						choices=['float32', 'float16', 'int16'])  # non-pixel obs in replay / rollout buffers
+	parser.add_argument('--obs_storage_range', nargs=2, default=None, type=float)  # int16 range, obs space bounds by default
 	parser.add_argument('--save_model', default=False, action='store_true')
 	parser.add_argument('--save_video', default=False, action='store_true')
 	parser.add_argument('--log_freq', default=20000, type=int)
@@ -193,6 +218,11 @@ def parse_args():
 
 	assert np.sum([args.use_inv, args.use_rot, args.use_curl]) <= 1, \
 		'can use at most one self-supervised task'
+	assert not (args.prioritized_replay and args.persistent_replay_buffer), \
+		'prioritized replay is not supported by the persistent replay buffer'
+	assert not (args.sac_async and (args.prioritized_replay or args.persistent_replay_buffer or
+		args.replay_buffer_on_disk or (args.pixel_obs and args.frame_stack > 1))), \
+		'asynchronous sac collection only supports the default in-memory replay buffer'
 
 	if args.load_checkpoint is not None:
 		try:
@@ -4,9 +4,22 @@ import kornia
 import numpy as np
 import gym
 import copy
+import os
+import queue
+import shutil
+import threading
 import psutil
 
-from utils import random_crop
+from utils import random_crop, to_np, ObsCodec
+
+
+class _NoLock(object):
+    """Context manager doing nothing, as contextlib.nullcontext() which needs Python 3.7"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
 
 
 class ReplayBuffer:
@@ -17,44 +30,55 @@ class ReplayBuffer:
     Reference:
     - https://github.com/hill-a/stable-baselines/blob/master/stable_baselines/common/buffers.py
 
+    storage_dir: if not None, store transitions in np.memmap files under this directory instead of RAM
+    obs_dtype, obs_range: storage dtype of non-pixel observations, see utils.ObsCodec
     """
     def __init__(self, obs_space, action_space, capacity, device, n_envs=1,
-                 optimize_memory_usage=False, handle_timeout_termination=False):
-
-        assert n_envs == 1, "Replay buffer only support single environment for now"
+                 optimize_memory_usage=False, handle_timeout_termination=False, storage_dir=None,
+                 obs_dtype=None, obs_range=None):
 
+        # transitions from each worker are stored as an independent row,
+        # the total capacity is shared among workers
         self.obs_space = obs_space
         self.action_space = action_space
-        self.capacity = capacity
+        self.n_envs = n_envs
+        self.capacity = max(capacity // n_envs, 1)
         self.device = device
         self.optimize_memory_usage = optimize_memory_usage
         self.handle_timeout_termination = handle_timeout_termination
-
-        # Check that the replay buffer can fit into the memory
-        if psutil is not None:
+        self.storage_dir = storage_dir
+        self.obs_codec = ObsCodec(obs_space, obs_dtype, obs_range)
+
+        # Check that the replay buffer can fit into the memory (or the disk)
+        if self.storage_dir is not None:
+            os.makedirs(self.storage_dir, exist_ok=True)
+            mem_available = shutil.disk_usage(self.storage_dir).free
+        elif psutil is not None:
             mem_available = psutil.virtual_memory().available
 
-        # the proprioceptive obs is stored as float32, pixels obs as uint8
+        # the proprioceptive obs is stored as float32 (or float16 / int16), pixels obs as uint8
         obs_shape = obs_space.shape
+        obs_dtype = self.obs_codec.dtype
         action_shape = action_space.shape
+        capacity = self.capacity
 
-        self.obses = np.empty((capacity, n_envs, *obs_shape), dtype=np.float32)
+        self.obses = self._allocate('obses', (capacity, n_envs, *obs_shape), obs_dtype)
         if self.optimize_memory_usage:
             # `observations` contains also the next observation
             self.next_obses = None
         else:
-            self.next_obses = np.empty((capacity, n_envs, *obs_shape), dtype=np.float32)
+            self.next_obses = self._allocate('next_obses', (capacity, n_envs, *obs_shape), obs_dtype)
         if isinstance(action_space, gym.spaces.Discrete):
-            self.actions = np.empty((capacity, n_envs, 1), dtype=np.int32)
+            self.actions = self._allocate('actions', (capacity, n_envs, 1), np.int32)
         elif isinstance(action_space, gym.spaces.Box):
-            self.actions = np.empty((capacity, n_envs, *action_shape), dtype=np.float32)
+            self.actions = self._allocate('actions', (capacity, n_envs, *action_shape), np.float32)
         else:
             raise TypeError(f"Unknown action space type: {type(action_space)}")
-        self.rewards = np.empty((capacity, n_envs, 1), dtype=np.float32)
-        self.not_dones = np.empty((capacity, n_envs, 1), dtype=np.float32)
-        self.timeouts = np.zeros((capacity, n_envs, 1), dtype=np.float32)
+        self.rewards = self._allocate('rewards', (capacity, n_envs, 1), np.float32)
+        self.not_dones = self._allocate('not_dones', (capacity, n_envs, 1), np.float32)
+        self.timeouts = self._allocate('timeouts', (capacity, n_envs, 1), np.float32, zeros=True)
 
-        if psutil is not None:
+        if self.storage_dir is not None or psutil is not None:
             total_memory_usage = self.obses.nbytes + self.actions.nbytes + self.rewards.nbytes + self.not_dones.nbytes
             if self.next_obses is not None:
                 total_memory_usage += self.next_obses.nbytes
@@ -64,68 +88,275 @@ class ReplayBuffer:
                 total_memory_usage /= 1e9
                 mem_available /= 1e9
                 print(
-                    "This system does not have apparently enough memory to store the complete "
-                    f"replay buffer {total_memory_usage:.2f}GB > {mem_available:.2f}GB"
+                    "This system does not have apparently enough {} to store the complete "
+                    "replay buffer {:.2f}GB > {:.2f}GB".format(
+                        'disk space' if self.storage_dir is not None else 'memory',
+                        total_memory_usage, mem_available)
                 )
 
         self.idx = 0
         self.full = False
 
+        # background prefetching, see start_prefetch
+        self._lock = threading.Lock()
+        self._version = 0
+        self._prefetch_thread = None
+
+    def _allocate(self, name, shape, dtype, zeros=False):
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype) if zeros else np.empty(shape, dtype=dtype)
+
+        # newly created memory-mapped files are filled with zeros
+        return np.memmap(os.path.join(self.storage_dir, name + '.dat'),
+                         dtype=dtype, mode='w+', shape=shape)
+
     def __len__(self):
-        return self.capacity if self.full else self.idx
+        return (self.capacity if self.full else self.idx) * self.n_envs
 
     def reset(self):
-        self.idx = 0
-        self.full = False
+        with self._lock:
+            self._version += 1
+            self.idx = 0
+            self.full = False
 
     def add(self, obs, action, reward, next_obs, done, infos):
-        np.copyto(self.obses[self.idx], obs)
-        np.copyto(self.actions[self.idx], action)
-        np.copyto(self.rewards[self.idx], reward)
+        with self._lock:
+            self._version += 1
+            self._add(obs, action, reward, next_obs, done, infos)
+
+    def _add(self, obs, action, reward, next_obs, done, infos):
+        """Add one vector step, i.e. a transition from each of the n_envs workers"""
+        np.copyto(self.obses[self.idx], np.reshape(self.obs_codec.encode(obs), self.obses.shape[1:]))
+        np.copyto(self.actions[self.idx], np.reshape(action, self.actions.shape[1:]))
+        np.copyto(self.rewards[self.idx], np.reshape(reward, self.rewards.shape[1:]))
         if self.optimize_memory_usage:
-            np.copyto(self.obses[(self.idx + 1) % self.capacity], next_obs)
+            np.copyto(self.obses[self._next_rows(self.idx)],
+                      np.reshape(self.obs_codec.encode(next_obs), self.obses.shape[1:]))
         else:
-            np.copyto(self.next_obses[self.idx], next_obs)
-        not_done = [not done_ for done_ in done]
-        np.copyto(self.not_dones[self.idx], not_done)
+            np.copyto(self.next_obses[self.idx],
+                      np.reshape(self.obs_codec.encode(next_obs), self.next_obses.shape[1:]))
+        np.copyto(self.not_dones[self.idx],
+                  1.0 - np.reshape(done, self.not_dones.shape[1:]).astype(np.float32))
 
         if self.handle_timeout_termination:
-            self.timeouts[self.idx] = np.array([info.get("TimeLimit.truncated", False) for info in infos])
+            # our TimeLimitMask wrapper marks timeouts with 'bad_transition'
+            timeouts = [info.get('TimeLimit.truncated', info.get('bad_transition', False))
+                        for info in infos]
+            np.copyto(self.timeouts[self.idx], np.reshape(timeouts, self.timeouts.shape[1:]))
+
+        self._advance()
 
+    def _advance(self):
         self.idx = (self.idx + 1) % self.capacity
         self.full = self.full or self.idx == 0
 
-    def sample(self, batch_size):
+    def _next_rows(self, rows):
+        """Row holding the next observation when optimize_memory_usage is True"""
+        return (rows + 1) % self.capacity
+
+    def _sample_idxs(self, batch_size):
+        """Sample uniformly over all (step, worker) rows"""
         if not self.optimize_memory_usage:
             idxs = np.random.randint(
                 0, self.capacity if self.full else self.idx, size=batch_size
             )
-
-            next_obses = torch.as_tensor(self.next_obses[idxs], device=self.device).float()
         else:
+            # the latest step of each worker has no valid next observation yet
             if self.full:
                 idxs = (np.random.randint(1, self.capacity, size=batch_size) + self.idx) % self.capacity
             else:
                 idxs = np.random.randint(0, self.idx, size=batch_size)
+        env_idxs = np.random.randint(0, self.n_envs, size=batch_size)
 
-            next_obses = torch.as_tensor(self.obses[(idxs + 1) % self.capacity], device=self.device).float()
+        return self._storage_order(idxs, env_idxs)
 
-        obses = torch.as_tensor(self.obses[idxs], device=self.device)
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
+    def _storage_order(self, idxs, env_idxs):
+        if self.storage_dir is not None:
+            # gather in storage order for sequential disk reads
+            order = np.lexsort((env_idxs, idxs))
+            idxs, env_idxs = idxs[order], env_idxs[order]
+
+        return idxs, env_idxs
+
+    @staticmethod
+    def _take(arr, flat_idxs, out=None):
+        return np.take(arr.reshape(-1, *arr.shape[2:]), flat_idxs, axis=0, out=out)
+
+    def _gather(self, idxs, env_idxs, out=None):
+        """Gather transitions as numpy arrays, optionally into preallocated arrays"""
+        if out is None:
+            out = [None] * 5
+
+        flat_idxs = idxs * self.n_envs + env_idxs
+        obses, next_obses = self._gather_obses(idxs, env_idxs, out[0], out[3])
+        actions = self._take(self.actions, flat_idxs, out[1])
+        rewards = self._take(self.rewards, flat_idxs, out[2])
+        not_dones = self._take(self.not_dones, flat_idxs, out[4])
         if self.handle_timeout_termination:
             # Only use dones that are not due to timeouts
             # deactivated by default (timeouts is initialized as an array of False)
-            not_dones = torch.as_tensor(
-                np.logical_or(self.not_dones[idxs], self.timeouts[idxs]).astype(
-                    self.not_dones.dtype),
-                device=self.device
-            )
+            np.logical_or(not_dones, self._take(self.timeouts, flat_idxs), out=not_dones)
+
+        return obses, actions, rewards, next_obses, not_dones
+
+    def _gather_obses(self, idxs, env_idxs, obs_out=None, next_obs_out=None):
+        flat_idxs = idxs * self.n_envs + env_idxs
+        if not self.optimize_memory_usage:
+            next_obses = self._take(self.next_obses, flat_idxs, next_obs_out)
         else:
-            not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
+            next_flat_idxs = self._next_rows(idxs) * self.n_envs + env_idxs
+            next_obses = self._take(self.obses, next_flat_idxs, next_obs_out)
+        obses = self._take(self.obses, flat_idxs, obs_out)
+
+        return obses, next_obses
+
+    def _to_device(self, arrays):
+        obses, actions, rewards, next_obses, not_dones = arrays
+
+        # observations are transferred in their storage dtype and decoded on the device
+        obses = self.obs_codec.decode(torch.as_tensor(obses, device=self.device))
+        actions = torch.as_tensor(actions, device=self.device)
+        rewards = torch.as_tensor(rewards, device=self.device)
+        next_obses = self.obs_codec.decode(torch.as_tensor(next_obses, device=self.device))
+        not_dones = torch.as_tensor(not_dones, device=self.device)
 
         return obses, actions, rewards, next_obses, not_dones
 
+    def sample(self, batch_size):
+        if self._prefetch_thread is not None and batch_size == self._prefetch_batch_size:
+            return self._get_prefetched()
+
+        with self._sampling():
+            idxs, env_idxs = self._sample_idxs(batch_size)
+            arrays = self._gather(idxs, env_idxs)
+
+        return self._to_device(arrays)
+
+    def sample_many(self, batch_size, k):
+        """Sample k minibatches at once as (k, batch_size, ...) tensors from a single gather and transfer"""
+        with self._sampling():
+            idxs, env_idxs = self._sample_idxs(batch_size * k)
+            # indices may come back in storage or stratum order, shuffle them before splitting into minibatches
+            order = np.random.permutation(batch_size * k)
+            arrays = self._gather(idxs[order], env_idxs[order])
+        samples = self._to_device(arrays)
+
+        return tuple(sample.view(k, batch_size, *sample.shape[1:]) for sample in samples)
+
+    def _sampling(self):
+        """Context guarding synchronous sampling against concurrent add()"""
+        return _NoLock()
+
+    def start_prefetch(self, batch_size, num_prefetch=2):
+        """Prepare minibatches of batch_size in a background thread
+
+        Up to num_prefetch minibatches are kept ready. Minibatches sampled before the latest add() or reset()
+        are discarded. Calls to sample() with other batch sizes are served synchronously.
+        """
+        self.stop_prefetch()
+
+        self._prefetch_batch_size = batch_size
+        self._prefetch_queue = queue.Queue(maxsize=num_prefetch)
+        self._prefetch_stop = threading.Event()
+        self._prefetch_error = None
+        self._prefetch_thread = threading.Thread(target=self._prefetch_worker, daemon=True)
+        self._prefetch_thread.start()
+
+    @property
+    def prefetch_batch_size(self):
+        """Batch size of the minibatches prepared in the background, None if prefetching is off"""
+        return self._prefetch_batch_size if self._prefetch_thread is not None else None
+
+    def stop_prefetch(self):
+        if self._prefetch_thread is None:
+            return
+
+        self._prefetch_stop.set()
+        self._prefetch_thread.join()
+        self._prefetch_thread = None
+        self._prefetch_queue = None
+
+    def _prefetch_worker(self):
+        try:
+            self._prefetch_loop()
+        except Exception as e:
+            # re-raised by sample() once the minibatches prepared before the failure are consumed
+            self._prefetch_error = e
+
+    def _prefetch_loop(self):
+        use_cuda = torch.device(self.device).type == 'cuda'
+        stream = torch.cuda.Stream(self.device) if use_cuda else None
+        # two pinned staging slots, one is gathered into while the other is copied to the device
+        slots = [None, None]
+        copy_events = [None, None]
+        slot_idx = 0
+
+        while not self._prefetch_stop.is_set():
+            with self._lock:
+                version = self._version
+                if len(self) == 0:
+                    arrays = None
+                else:
+                    idxs, env_idxs = self._sample_idxs(self._prefetch_batch_size)
+                    if not use_cuda:
+                        arrays = self._gather(idxs, env_idxs)
+                    elif slots[slot_idx] is None:
+                        slots[slot_idx] = tuple(torch.from_numpy(array).pin_memory()
+                                                for array in self._gather(idxs, env_idxs))
+                        arrays = slots[slot_idx]
+                    else:
+                        # make sure the previous copy from this slot has finished before overwriting it
+                        copy_events[slot_idx].synchronize()
+                        self._gather(idxs, env_idxs, out=[staging.numpy() for staging in slots[slot_idx]])
+                        arrays = slots[slot_idx]
+
+            if arrays is None:
+                self._prefetch_stop.wait(1e-3)
+                continue
+
+            if use_cuda:
+                with torch.cuda.stream(stream):
+                    batch = tuple(staging.to(self.device, non_blocking=True) for staging in arrays)
+                    batch = self._decode(batch)
+                    copy_event = torch.cuda.Event()
+                    copy_event.record(stream)
+                copy_events[slot_idx] = copy_event
+                slot_idx = 1 - slot_idx
+            else:
+                batch = self._decode(tuple(torch.from_numpy(array) for array in arrays))
+                copy_event = None
+
+            while not self._prefetch_stop.is_set():
+                try:
+                    self._prefetch_queue.put((version, batch, copy_event), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def _decode(self, batch):
+        obses, actions, rewards, next_obses, not_dones = batch
+
+        return self.obs_codec.decode(obses), actions, rewards, self.obs_codec.decode(next_obses), not_dones
+
+    def _get_prefetched(self):
+        while True:
+            try:
+                version, batch, copy_event = self._prefetch_queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self._prefetch_thread.is_alive():
+                    raise RuntimeError("prefetching minibatches failed") from self._prefetch_error
+                continue
+            if version == self._version:
+                break
+
+        if copy_event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(copy_event)
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+
+        return batch
+
     # def sample_curl(self, batch_size):
     #     # TODO (chongyi zheng): update this function to drq style
     #     # idxs = np.random.randint(
@@ -168,6 +399,307 @@ class ReplayBuffer:
     #     return obses, actions, rewards, next_obses, not_dones, ensem_kwargs
 
 
+class PresampledBuffer:
+    """Serve the minibatches returned by ReplayBuffer.sample_many one at a time through sample()"""
+    def __init__(self, samples):
+        self.samples = samples
+        self.num_batches, self.batch_size = samples[0].shape[:2]
+        self.batch_idx = 0
+
+    def __len__(self):
+        return (self.num_batches - self.batch_idx) * self.batch_size
+
+    def sample(self, batch_size):
+        assert batch_size == self.batch_size, \
+            "Presampled minibatches have size {}, got {}".format(self.batch_size, batch_size)
+        assert self.batch_idx < self.num_batches, "All presampled minibatches have been used"
+        batch = tuple(sample[self.batch_idx] for sample in self.samples)
+        self.batch_idx += 1
+
+        return batch
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """Replay buffer in shared memory, filled by one process and sampled by another
+
+    The arrays are numpy views of shared torch tensors and the ring index lives in a shared tensor too.
+    Passing the buffer to a torch.multiprocessing process (e.g. as a Process argument) attaches it to the
+    same storage. add(), reset() and sampling are serialized by a lock of mp_context.
+    """
+    def __init__(self, obs_space, action_space, capacity, device, n_envs=1, mp_context=None, **kwargs):
+        assert kwargs.get('storage_dir') is None, "Shared replay buffers are kept in memory"
+
+        self._tensors = {}
+        # idx, full and the version checked by the prefetching thread
+        self._state = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self._state_view = self._state.numpy()
+
+        super().__init__(obs_space, action_space, capacity, device, n_envs=n_envs, **kwargs)
+        self._lock = (mp_context or torch.multiprocessing).Lock()
+
+    def _allocate(self, name, shape, dtype, zeros=False):
+        tensor = torch.from_numpy(np.empty(0, dtype=dtype)).new_zeros(shape).share_memory_()
+        self._tensors[name] = tensor
+
+        return tensor.numpy()
+
+    @property
+    def idx(self):
+        return int(self._state_view[0])
+
+    @idx.setter
+    def idx(self, idx):
+        self._state_view[0] = idx
+
+    @property
+    def full(self):
+        return bool(self._state_view[1])
+
+    @full.setter
+    def full(self, full):
+        self._state_view[1] = full
+
+    @property
+    def _version(self):
+        return int(self._state_view[2])
+
+    @_version.setter
+    def _version(self, version):
+        self._state_view[2] = version
+
+    def _sampling(self):
+        return self._lock
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._tensors:
+            del state[name]
+        del state['_state_view']
+        # a prefetching thread belongs to the process that started it
+        state['_prefetch_thread'] = None
+        state.pop('_prefetch_queue', None)
+        state.pop('_prefetch_stop', None)
+        state.pop('_prefetch_error', None)
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._state_view = self._state.numpy()
+        for name, tensor in self._tensors.items():
+            setattr(self, name, tensor.numpy())
+
+
+class TaskPartitionedReplayBuffer(ReplayBuffer):
+    """Replay buffer that is allocated once and keeps the transitions of every task
+
+    Each task owns a contiguous segment of capacity // num_tasks transitions with its own ring index.
+    add() writes into the segment of the current task, set_task() switches segments in O(1).
+    """
+    def __init__(self, obs_space, action_space, capacity, device, num_tasks, n_envs=1, **kwargs):
+        self.num_tasks = num_tasks
+        self.task_capacity = max(capacity // (num_tasks * n_envs), 1)
+        self.task_id = 0
+        self.task_idxs = np.zeros(num_tasks, dtype=np.int64)
+        self.task_fulls = np.zeros(num_tasks, dtype=bool)
+
+        super().__init__(obs_space, action_space, self.task_capacity * num_tasks * n_envs, device,
+                         n_envs=n_envs, **kwargs)
+
+    def __len__(self):
+        return self.task_len(self.task_id)
+
+    def task_len(self, task_id):
+        self._save_task_state()
+        return int(self.task_capacity if self.task_fulls[task_id] else self.task_idxs[task_id]) * self.n_envs
+
+    def _save_task_state(self):
+        self.task_idxs[self.task_id] = self.idx - self.task_id * self.task_capacity
+        self.task_fulls[self.task_id] = self.full
+
+    def set_task(self, task_id, reset=True):
+        """Write subsequent transitions into the segment of task_id"""
+        with self._lock:
+            self._version += 1
+            self._save_task_state()
+            self.task_id = task_id
+            if reset:
+                self.task_idxs[task_id] = 0
+                self.task_fulls[task_id] = False
+            self.idx = task_id * self.task_capacity + self.task_idxs[task_id]
+            self.full = bool(self.task_fulls[task_id])
+
+    def reset(self):
+        self.reset_task(self.task_id)
+
+    def reset_task(self, task_id):
+        with self._lock:
+            self._version += 1
+            self.task_idxs[task_id] = 0
+            self.task_fulls[task_id] = False
+            if task_id == self.task_id:
+                self.idx = task_id * self.task_capacity
+                self.full = False
+
+    def _advance(self):
+        start = self.task_id * self.task_capacity
+        local_idx = (self.idx - start + 1) % self.task_capacity
+        self.idx = start + local_idx
+        self.full = self.full or local_idx == 0
+
+    def _next_rows(self, rows):
+        starts = rows - rows % self.task_capacity
+        return starts + (rows - starts + 1) % self.task_capacity
+
+    def _sample_idxs(self, batch_size, task_ids=None):
+        """Sample uniformly over all transitions stored for task_ids (the current task by default)"""
+        self._save_task_state()
+        task_ids = np.atleast_1d(self.task_id if task_ids is None else task_ids)
+
+        fulls = self.task_fulls[task_ids]
+        # when full, the row at the ring index holds the latest next observation only
+        skip_latest = fulls & self.optimize_memory_usage
+        lens = np.where(fulls, self.task_capacity - skip_latest, self.task_idxs[task_ids])
+        assert lens.sum() > 0, "No transitions stored for tasks {}".format(task_ids)
+
+        sample_task_idxs = np.random.choice(len(task_ids), size=batch_size, p=lens / lens.sum())
+        offsets = (np.random.rand(batch_size) * lens[sample_task_idxs]).astype(np.int64)
+        starts = np.where(skip_latest, self.task_idxs[task_ids] + 1, 0)[sample_task_idxs]
+        idxs = task_ids[sample_task_idxs] * self.task_capacity + (starts + offsets) % self.task_capacity
+        env_idxs = np.random.randint(0, self.n_envs, size=batch_size)
+
+        return self._storage_order(idxs, env_idxs)
+
+    def sample(self, batch_size, task_ids=None):
+        if task_ids is None:
+            return super().sample(batch_size)
+
+        with self._sampling():
+            idxs, env_idxs = self._sample_idxs(batch_size, task_ids)
+            arrays = self._gather(idxs, env_idxs)
+
+        return self._to_device(arrays)
+
+
+class SumTree:
+    """Array-based binary sum tree over capacity leaves
+
+    Node i has children 2 * i and 2 * i + 1, the leaves live in tree[size:size + capacity].
+    Updates and searches are vectorized over a batch and take one numpy op per tree level.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.size = 2 ** self.depth
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxs):
+        return self.tree[self.size + idxs]
+
+    def reset(self):
+        self.tree.fill(0.0)
+
+    def update(self, idxs, priorities):
+        # duplicated idxs keep the last priority, as with sequential assignment
+        nodes = self.size + np.asarray(idxs, dtype=np.int64)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Leaf index of the prefix sum that each value falls into"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            # never descend into an empty subtree because of rounding errors
+            go_right = (values >= left_sums) & (self.tree[left + 1] > 0)
+            values -= left_sums * go_right
+            nodes = left + go_right
+
+        return np.minimum(nodes - self.size, self.capacity - 1)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer sampling transitions proportionally to priority ** alpha
+
+    Reference:
+    - Schaul et al., Prioritized Experience Replay, https://arxiv.org/abs/1511.05952
+
+    New transitions get the maximum priority seen so far. sample(batch_size, return_weights=True) also
+    returns the importance weights (normalized by the batch maximum) and the indices to pass to
+    update_priorities() together with the new TD errors.
+    """
+    def __init__(self, obs_space, action_space, capacity, device, n_envs=1,
+                 alpha=0.6, beta=0.4, eps=1e-6, **kwargs):
+        super().__init__(obs_space, action_space, capacity, device, n_envs=n_envs, **kwargs)
+
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        # one leaf per (step, worker) row
+        self.sum_tree = SumTree(self.capacity * self.n_envs)
+
+    def reset(self):
+        super().reset()
+        with self._lock:
+            self.sum_tree.reset()
+            self.max_priority = 1.0
+
+    def _add(self, obs, action, reward, next_obs, done, infos):
+        rows = self.idx * self.n_envs + np.arange(self.n_envs)
+        super()._add(obs, action, reward, next_obs, done, infos)
+        self.sum_tree.update(rows, self.max_priority ** self.alpha)
+        if self.optimize_memory_usage:
+            # the rows at the ring index only hold the latest next observations now
+            self.sum_tree.update(self.idx * self.n_envs + np.arange(self.n_envs), 0.0)
+
+    def _sample_idxs(self, batch_size):
+        """Stratified sampling, one transition from each of batch_size equal priority mass segments"""
+        total = self.sum_tree.total
+        assert total > 0, "No transitions stored"
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * (total / batch_size)
+        flat_idxs = self.sum_tree.find(np.minimum(values, np.nextafter(total, 0)))
+
+        return self._storage_order(flat_idxs // self.n_envs, flat_idxs % self.n_envs)
+
+    def _importance_weights(self, flat_idxs):
+        probs = self.sum_tree[flat_idxs] / self.sum_tree.total
+        weights = (len(self) * probs) ** (-self.beta)
+
+        return weights / weights.max()
+
+    def sample(self, batch_size, return_weights=False):
+        if not return_weights:
+            return super().sample(batch_size)
+
+        with self._sampling():
+            idxs, env_idxs = self._sample_idxs(batch_size)
+            flat_idxs = idxs * self.n_envs + env_idxs
+            weights = self._importance_weights(flat_idxs)
+            arrays = self._gather(idxs, env_idxs)
+        weights = torch.as_tensor(weights, dtype=torch.float32, device=self.device)
+
+        return (*self._to_device(arrays), weights.unsqueeze(-1), flat_idxs)
+
+    def update_priorities(self, idxs, priorities):
+        """Set the priorities of the transitions at idxs (as returned by sample) from their TD errors"""
+        if isinstance(priorities, torch.Tensor):
+            priorities = to_np(priorities)
+        priorities = np.abs(np.reshape(priorities, -1)) + self.eps
+
+        with self._lock:
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+            self.sum_tree.update(idxs, priorities ** self.alpha)
+
+
 # class AugmentReplayBuffer(ReplayBuffer):
 #     def __init__(self, obs_shape, action_shape, capacity, image_pad, device):
 #         super().__init__(obs_shape, action_shape, capacity, device)
@@ -215,94 +747,92 @@ class ReplayBuffer:
 
 
 class FrameStackReplayBuffer(ReplayBuffer):
-    # TODO (chongyi zheng): FrameStackReplayBuffer has bugs
     """Only store unique frames to save memory
 
+    Observations are stacks of frame_stack frames concatenated along the first axis (see the FrameStack
+    wrappers), only the newest frame of each observation is stored. stack_offsets keeps the number of
+    earlier frames of the same episode (at most frame_stack - 1) for each row, frames before the episode
+    start repeat its first frame as the wrappers do on reset. The stacks of a batch are rebuilt with a
+    single gather.
+
     Base on https://github.com/thu-ml/tianshou/blob/master/tianshou/data/buffer/base.py
     """
-    def __init__(self, obs_space, action_space, capacity, frame_stack, device, optimize_memory_usage=False):
-        single_frame_obs_space = copy.deepcopy(obs_space)
-        if single_frame_obs_space.shape[0] != 1:
-            # convert to single frame
-            obs_shape = list(single_frame_obs_space.shape)
-            obs_shape[0] = 1
-            single_frame_obs_space.shape = tuple(obs_shape)
-
-        super().__init__(single_frame_obs_space, action_space, capacity, device,
-                         optimize_memory_usage=optimize_memory_usage)
+    def __init__(self, obs_space, action_space, capacity, frame_stack, device, n_envs=1, **kwargs):
+        assert obs_space.shape[0] % frame_stack == 0, \
+            "Cannot split observations of shape {} into {} frames".format(obs_space.shape, frame_stack)
         self.frame_stack = frame_stack
+        self.frame_dim = obs_space.shape[0] // frame_stack
+        frame_obs_space = gym.spaces.Box(low=obs_space.low[-self.frame_dim:],
+                                         high=obs_space.high[-self.frame_dim:],
+                                         dtype=obs_space.dtype)
 
-        # self.stack_frame_dists = np.empty((capacity, self.frame_stack), dtype=np.int32)
+        super().__init__(frame_obs_space, action_space, capacity, device, n_envs=n_envs, **kwargs)
 
-        # (chongyi zheng): We need to set the final not_done = 0.0 to make sure the correct stack when the first
-        #   observation is sampled. Note that empty array is initialized to be all zeros.
-        # self.not_dones[-1] = 0.0
+        self.stack_offsets = self._allocate('stack_offsets', (self.capacity, n_envs), np.uint8, zeros=True)
+        self._episode_steps = np.zeros(n_envs, dtype=np.int64)
 
-    def prev(self, index):
-        """Return the index of previous transition.
-        The index won't be modified if it is the beginning of an episode.
-        """
-        index = (index - 1) % self.capacity
-        end_flag = np.logical_not(self.not_dones[index]).squeeze(-1) | (index == self.idx)
-        return (index + end_flag) % self.capacity
-
-    def add(self, obs, action, reward, next_obs, done):
-        np.copyto(self.obses[self.idx], obs[-1])
-        np.copyto(self.actions[self.idx], action)
-        np.copyto(self.rewards[self.idx], reward)
-        if self.optimize_memory_usage:
-            np.copyto(self.obses[(self.idx + 1) % self.capacity], next_obs[-1])
-        else:
-            np.copyto(self.next_obses[self.idx], next_obs[-1])
-        np.copyto(self.not_dones[self.idx], not done)
+    def reset(self):
+        super().reset()
+        self._episode_steps.fill(0)
 
-        self.idx = (self.idx + 1) % self.capacity
-        self.full = self.full or self.idx == 0
+    def _add(self, obs, action, reward, next_obs, done, infos):
+        frame_shape = (self.n_envs, -1, *self.obses.shape[3:])
+        obs = np.reshape(obs, frame_shape)[:, -self.frame_dim:]
+        next_obs = np.reshape(next_obs, frame_shape)[:, -self.frame_dim:]
+        np.copyto(self.stack_offsets[self.idx], np.minimum(self._episode_steps, self.frame_stack - 1),
+                  casting='unsafe')
 
-    def sample(self, batch_size):
-        if not self.optimize_memory_usage:
-            prev_idxs = idxs = np.random.randint(
-                0, self.capacity if self.full else self.idx, size=batch_size
-            )
+        super()._add(obs, action, reward, next_obs, done, infos)
 
-            obses = []
-            next_obses = []
-            for _ in range(self.frame_stack):
-                obses.append(self.obses[prev_idxs])
-                next_obses.append(self.next_obses[prev_idxs])
-                prev_idxs = self.prev(prev_idxs)
-            obses = np.concatenate(obses, axis=1)
-            next_obses = np.concatenate(next_obses, axis=1)
-
-            obses = torch.as_tensor(obses, device=self.device).float()
-            next_obses = torch.as_tensor(next_obses, device=self.device).float()
-        else:
-            if self.full:
-                prev_idxs = idxs = (np.random.randint(1, self.capacity, size=batch_size) + self.idx) % self.capacity
-            else:
-                prev_idxs = idxs = np.random.randint(0, self.idx, size=batch_size)
+        self._episode_steps = np.where(np.reshape(done, -1), 0, self._episode_steps + 1)
 
-            obses = []
-            next_obses = []
-            for _ in range(self.frame_stack):
-                obses.append(self.obses[prev_idxs])
-                next_obses.append(self.obses[(prev_idxs + 1) % self.capacity])
-                prev_idxs = self.prev(prev_idxs)
-            obses = np.concatenate(obses, axis=1)
-            next_obses = np.concatenate(next_obses, axis=1)
+    def _sample_idxs(self, batch_size):
+        if not self.full:
+            return super()._sample_idxs(batch_size)
 
-            obses = torch.as_tensor(obses, device=self.device).float()
-            next_obses = torch.as_tensor(next_obses, device=self.device).float()
+        # the oldest rows may stack frames that have been overwritten already
+        # (and the row at the ring index holds the latest next frame only when optimize_memory_usage)
+        start = self.frame_stack - 1 + self.optimize_memory_usage
+        idxs = (np.random.randint(start, self.capacity, size=batch_size) + self.idx) % self.capacity
+        env_idxs = np.random.randint(0, self.n_envs, size=batch_size)
 
-        actions = torch.as_tensor(self.actions[idxs], device=self.device).float()
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
+        return self._storage_order(idxs, env_idxs)
 
-        # TODO (chongyi zheng): We don't need to crop image as PAD
-        # obses = random_crop(obses)
-        # next_obses = random_crop(next_obses)
+    def _gather_obses(self, idxs, env_idxs, obs_out=None, next_obs_out=None):
+        batch_size = len(idxs)
+        k = self.frame_stack
+        offsets = np.arange(1 - k, 1)
+        stack_offsets = self.stack_offsets[idxs, env_idxs].astype(np.int64)[:, None]
+        next_stack_offsets = np.minimum(stack_offsets + 1, k - 1)
 
-        return obses, actions, rewards, next_obses, not_dones
+        # rows of the frames of obs and next_obs, clamped at the episode start
+        frame_rows = [idxs[:, None] + np.maximum(offsets, -stack_offsets)]
+        if self.optimize_memory_usage:
+            frame_rows.append(idxs[:, None] + 1 + np.maximum(offsets, -next_stack_offsets))
+        else:
+            # the newest frame of next_obs lives in next_obses
+            frame_rows.append(idxs[:, None] + 1 + np.maximum(offsets[:-1], -next_stack_offsets))
+        frame_rows = np.concatenate(frame_rows, axis=1) % self.capacity
+
+        flat_idxs = frame_rows * self.n_envs + env_idxs[:, None]
+        frames = self._take(self.obses, flat_idxs.reshape(-1)).reshape(batch_size, -1, *self.obses.shape[2:])
+        obses = frames[:, :k]
+        next_obses = frames[:, k:]
+        if not self.optimize_memory_usage:
+            newest_frames = self._take(self.next_obses, idxs * self.n_envs + env_idxs)
+            next_obses = np.concatenate([next_obses, newest_frames[:, None]], axis=1)
+
+        stack_shape = (batch_size, k * self.frame_dim, *self.obses.shape[3:])
+        obses = obses.reshape(stack_shape)
+        next_obses = next_obses.reshape(stack_shape)
+        if obs_out is not None:
+            np.copyto(obs_out, obses)
+            obses = obs_out
+        if next_obs_out is not None:
+            np.copyto(next_obs_out, next_obses)
+            next_obses = next_obs_out
+
+        return obses, next_obses
 
 
 # class AugmentFrameStackReplayBuffer(FrameStackReplayBuffer):
@@ -60,3 +60,22 @@ class VecNormalize(VecNormalize_):
 
     def eval(self):
         self.training = False
+
+    def process_workers(self, env_idxs, obs, rewards, dones, infos):
+        """step_wait() normalization for the results of the workers env_idxs only"""
+        if self.training and self.norm_obs:
+            self.obs_rms.update(obs)
+        obs = self.normalize_obs(obs)
+
+        if self.training:
+            self.ret[env_idxs] = self.ret[env_idxs] * self.gamma + rewards
+            self.ret_rms.update(self.ret[env_idxs])
+        rewards = self.normalize_reward(rewards)
+
+        for info, done in zip(infos, dones):
+            if done:
+                info['terminal_observation'] = self.normalize_obs(info['terminal_observation'])
+
+        self.ret[env_idxs[dones]] = 0
+
+        return obs, rewards, dones, infos
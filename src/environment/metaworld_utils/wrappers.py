@@ -612,7 +612,18 @@ class MultiEnvWrapper(gym.Wrapper):
         action = self._curtail_action(action)
 
         obs, reward, done, info = self.env.step(action)
+        obs, info = self.process_step(obs, info)
 
+        return obs, reward, done, info
+
+    def process_step(self, obs, info):
+        """Observation and info processing of step(), applied to the results of the active task environment.
+        Args:
+            obs (numpy.ndarray): observations of some or all workers of the active task environment.
+            info (dict or list(dict)): the corresponding infos.
+        Returns:
+            tuple: processed observations and infos.
+        """
         if self._mode == 'add-onehot':
             one_hots = np.repeat(
                 np.expand_dims(self._active_task_one_hot(), axis=0),
@@ -635,7 +646,7 @@ class MultiEnvWrapper(gym.Wrapper):
                 if self._env_names is not None:
                     info_['task_name'] = self._env_names[self._active_task_index]
 
-        return obs, reward, done, info
+        return obs, info
 
     def close(self):
         """Close all task envs."""
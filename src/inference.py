@@ -0,0 +1,159 @@
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from environment.gym_wrapper import VecNormalize
+
+
+class EnvStepper:
+    """Steps a continual vector environment in lockstep, one act_fn call per vector step
+
+    act_fn(obs, **act_kwargs) returns the actions or a tuple whose first element are the actions,
+    e.g. (action, log_pi, value). The tuple is passed on as is.
+    """
+    def __init__(self, env, obs, act_fn, **act_kwargs):
+        self.env = env
+        self.act_fn = act_fn
+        self.act_kwargs = act_kwargs
+        self._obs = obs
+
+    def steps(self, num_steps=None):
+        """Yield num_steps (or infinitely many) vector steps as (obs, act_out, reward, next_obs, done, infos)"""
+        step = 0
+        while num_steps is None or step < num_steps:
+            act_out = self.act_fn(self._obs, **self.act_kwargs)
+            action = act_out[0] if isinstance(act_out, tuple) else act_out
+            next_obs, reward, done, infos = self.env.step(action)
+
+            yield self._obs, act_out, reward, next_obs, done, infos
+
+            self._obs = next_obs
+            step += 1
+
+    def close(self):
+        pass
+
+
+class InferenceServer(EnvStepper):
+    """Steps the workers of a SubprocVecEnv independently and batches their action requests
+
+    A worker is sent its next action as soon as the policy has seen its observation, so a slow step or reset only
+    delays that worker. Once a worker returns, the others returning within max_wait seconds share its act_fn call.
+    The transitions are reassembled into vector steps, column i holding the transitions of worker i in order, and
+    a worker runs at most max_lag steps ahead of the vector steps handed out. A call to steps(num_steps) never steps
+    a worker beyond num_steps, so no transition acted on by an outdated policy is left over for the next call.
+    close() must be called before the environment is used directly again, e.g. reset, rendered or stepped.
+    """
+    def __init__(self, env, obs, act_fn, max_wait=1e-3, max_lag=4, **act_kwargs):
+        super().__init__(env, obs, act_fn, **act_kwargs)
+        self.max_wait = max_wait
+        self.max_lag = max_lag
+
+        venv = env.env
+        self._vec_norm = venv if isinstance(venv, VecNormalize) else None
+        if self._vec_norm is not None:
+            venv = venv.venv
+        # DummyVecEnv has no workers to decouple
+        self._remotes = getattr(venv, 'remotes', None)
+        self.num_envs = venv.num_envs
+
+        self._obs = list(obs)
+        self._act_outs = [None] * self.num_envs
+        self._in_flight = set()
+        self._transitions = [deque() for _ in range(self.num_envs)]
+
+    def steps(self, num_steps=None):
+        if self._remotes is None:
+            yield from self._lockstep(num_steps)
+            return
+
+        step = 0
+        while num_steps is None or step < num_steps:
+            while not all(self._transitions):
+                self._serve(None if num_steps is None else num_steps - step)
+
+            transitions = [worker_transitions.popleft() for worker_transitions in self._transitions]
+            obs, act_outs, rewards, next_obs, dones, infos = zip(*transitions)
+
+            yield np.stack(obs), self._stack(act_outs), np.stack(rewards), np.stack(next_obs), \
+                np.stack(dones), list(infos)
+
+            step += 1
+
+    def _lockstep(self, num_steps):
+        self._obs = np.stack(self._obs)
+        for transition in super().steps(num_steps):
+            yield transition
+        self._obs = list(self._obs)
+
+    def _serve(self, num_steps_left=None):
+        # one act_fn call for every idle worker that is neither too far ahead nor done with the current steps() call
+        max_queued = self.max_lag + 1 if num_steps_left is None else min(self.max_lag + 1, num_steps_left)
+        env_idxs = [env_idx for env_idx in range(self.num_envs)
+                    if env_idx not in self._in_flight and len(self._transitions[env_idx]) < max_queued]
+        if len(env_idxs) > 0:
+            act_outs = self._split(self.act_fn(np.stack([self._obs[env_idx] for env_idx in env_idxs]),
+                                               **self.act_kwargs), len(env_idxs))
+            for env_idx, act_out in zip(env_idxs, act_outs):
+                action = act_out[0] if isinstance(act_out, tuple) else act_out
+                self._remotes[env_idx].send(('step', self.env._curtail_action(action)[0]))
+                self._act_outs[env_idx] = act_out
+                self._in_flight.add(env_idx)
+
+        # wait for the first worker, then up to max_wait for the others
+        ready = self._wait(None)
+        deadline = time.time() + self.max_wait
+        while len(ready) < len(self._in_flight) and time.time() < deadline:
+            ready += [env_idx for env_idx in self._wait(deadline - time.time()) if env_idx not in ready]
+        ready = np.array(sorted(ready))
+
+        results = [self._remotes[env_idx].recv() for env_idx in ready]
+        self._in_flight.difference_update(ready.tolist())
+        next_obs, rewards, dones, infos = zip(*results)
+        next_obs, rewards, dones, infos = np.stack(next_obs), np.stack(rewards), np.stack(dones), list(infos)
+        if self._vec_norm is not None:
+            next_obs, rewards, dones, infos = self._vec_norm.process_workers(ready, next_obs, rewards, dones, infos)
+        next_obs, infos = self.env.process_step(next_obs, infos)
+
+        for i, env_idx in enumerate(ready):
+            self._transitions[env_idx].append((self._obs[env_idx], self._act_outs[env_idx], rewards[i],
+                                               next_obs[i], dones[i], infos[i]))
+            self._obs[env_idx] = next_obs[i]
+
+    def _wait(self, timeout):
+        in_flight = sorted(self._in_flight)
+        ready_remotes = wait([self._remotes[env_idx] for env_idx in in_flight], timeout)
+
+        return [env_idx for env_idx in in_flight if self._remotes[env_idx] in ready_remotes]
+
+    @staticmethod
+    def _split(act_out, num_envs):
+        if isinstance(act_out, tuple):
+            return list(zip(*[[None] * num_envs if out is None else list(out) for out in act_out]))
+        return list(act_out)
+
+    @staticmethod
+    def _stack(act_outs):
+        if isinstance(act_outs[0], tuple):
+            return tuple(None if outs[0] is None else np.stack(outs) for outs in zip(*act_outs))
+        return np.stack(act_outs)
+
+    def close(self):
+        """Drop the steps still in flight so that the environment can be used in lockstep again"""
+        if self._remotes is not None:
+            for env_idx in self._in_flight:
+                self._remotes[env_idx].recv()
+        self._in_flight.clear()
+        for worker_transitions in self._transitions:
+            worker_transitions.clear()
+
+
+def make_stepper(args, env, obs, act_fn, lockstep=False, **act_kwargs):
+    """InferenceServer if --inference_server is set and lockstep stepping is not required, EnvStepper otherwise"""
+    if args.inference_server and not lockstep:
+        return InferenceServer(env, obs, act_fn, max_wait=args.inference_max_wait, max_lag=args.inference_max_lag,
+                               **act_kwargs)
+
+    return EnvStepper(env, obs, act_fn, **act_kwargs)
@@ -90,24 +90,21 @@ class CmamlClassfier(nn.Module):
             class_entries = [active_classes[-1]] * x.size(0) \
                 if type(active_classes[0]) == list else active_classes
         else:
-            class_entries = [None] * x.size(0)
-
-        for single_x, single_y, single_class_entries in zip(x, y, class_entries):
-            self.total_sample_num += 1
-            sample_num = self.memory['sample_num']
-            if sample_num < self.memory_budget:
-                np.copyto(self.memory['x'][sample_num], utils.to_np(single_x))
-                np.copyto(self.memory['y'][sample_num], utils.to_np(single_y))
-                if single_class_entries is not None:
-                    self.memory['class_entries'].append(single_class_entries)
-                self.memory['sample_num'] += 1
-            else:
-                idx = np.random.randint(0, self.total_sample_num)
-                if idx < self.memory_budget:
-                    np.copyto(self.memory['x'][idx], utils.to_np(single_x))
-                    np.copyto(self.memory['y'][idx], utils.to_np(single_y))
-                    if single_class_entries is not None:
-                        self.memory['class_entries'][idx] = single_class_entries
+            class_entries = None
+
+        batch_size = x.size(0)
+        sample_idxs, slots = utils.reservoir_slots(
+            self.memory['sample_num'], self.total_sample_num, self.memory_budget, batch_size)
+        num_fill = min(self.memory['sample_num'] + batch_size, self.memory_budget) - self.memory['sample_num']
+        self.total_sample_num += batch_size
+        self.memory['sample_num'] += num_fill
+
+        self.memory['x'][slots] = utils.to_np(x)[sample_idxs]
+        self.memory['y'][slots] = utils.to_np(y).reshape(batch_size, -1)[sample_idxs]
+        if class_entries is not None:
+            self.memory['class_entries'].extend([None] * num_fill)
+            for idx, slot in zip(sample_idxs, slots):
+                self.memory['class_entries'][slot] = class_entries[idx]
 
     def _inner_update(self, x, y, active_classes=None, params=None):
         if params is None:
@@ -4,12 +4,13 @@ from torch.nn import functional as F
 from torch import optim
 
 from src.mnist_cl import utils
+from src.utils import EwcConsolidation, per_sample_fisher
 
 
 class EwcClassifier(nn.Module):
     def __init__(self, image_size, image_channels, classes, hidden_units=400, lr=0.001,
                  lam=5000, fisher_sample_size=None,
-                 online=False, gamma=1.0, device=None):
+                 online=False, gamma=1.0, fisher_chunk_size=0, device=None):
 
         super().__init__()
         self.image_size = image_size
@@ -21,6 +22,7 @@ class EwcClassifier(nn.Module):
         self.fisher_sample_size = fisher_sample_size
         self.online = online
         self.gamma = gamma
+        self.fisher_chunk_size = fisher_chunk_size
 
         # flatten image to 2D-tensor
         self.trunk = nn.Sequential(
@@ -37,8 +39,7 @@ class EwcClassifier(nn.Module):
         self.to(device)
 
         self.ewc_task_count = 0
-        self.prev_task_params = {}
-        self.prev_task_fishers = {}
+        self.ewc_consolidation = EwcConsolidation(online, gamma)
 
     def device(self):
         return next(self.parameters()).device
@@ -59,35 +60,31 @@ class EwcClassifier(nn.Module):
 
         # run forward pass of model
         x = x.to(self.device())
-        y_hat = self(x) if allowed_classes is None else self(x)[:, allowed_classes]
-        label = y_hat.max(1)[1]  # use predicted label to calculate loglikelihood
-        negloglikelihood = F.nll_loss(F.log_softmax(y_hat, dim=1), label)
-
-        self.zero_grad()
-        negloglikelihood.backward()
-
-        # critic_loss = self.compute_critic_loss(obs, action, reward, next_obs, not_done)
-        # self.critic_optimizer.zero_grad()
-        # critic_loss.backward()
-        #
-        # _, actor_loss, alpha_loss = self.compute_actor_and_alpha_loss(obs)
-        # self.actor_optimizer.zero_grad()
-        # actor_loss.backward()
-        # self.log_alpha_optimizer.zero_grad()
-        # alpha_loss.backward()
+
+        def compute_loss(x, label=None):
+            y_hat = self(x) if allowed_classes is None else self(x)[:, allowed_classes]
+            if label is None:
+                label = y_hat.max(1)[1]  # use predicted label to calculate loglikelihood
+            return F.nll_loss(F.log_softmax(y_hat, dim=1), label)
+
+        if self.fisher_chunk_size > 0:
+            # mean of the squared per-sample gradients instead of the squared gradient of the mean loss
+            with torch.no_grad():
+                y_hat = self(x) if allowed_classes is None else self(x)[:, allowed_classes]
+            fishers = per_sample_fisher(self.named_parameters(), [self], compute_loss, (x, y_hat.max(1)[1]),
+                                        self.fisher_chunk_size)
+        else:
+            negloglikelihood = compute_loss(x)
+
+            self.zero_grad()
+            negloglikelihood.backward()
+
+            fishers = {name: param.grad.detach().clone() ** 2
+                       for name, param in self.named_parameters() if param.grad is not None}
 
         for name, param in self.named_parameters():
-            if param.grad is not None:
-                if self.online:
-                    name = name + '_prev_task'
-                    self.prev_task_params[name] = param.detach().clone()
-                    self.prev_task_fishers[name] = \
-                        param.grad.detach().clone() ** 2 + \
-                        self.online_ewc_gamma * self.prev_task_fishers.get(name, torch.zeros_like(param.grad))
-                else:
-                    name = name + f'_prev_task{self.ewc_task_count}'
-                    self.prev_task_params[name] = param.detach().clone()
-                    self.prev_task_fishers[name] = param.grad.detach().clone() ** 2
+            if name in fishers:
+                self.ewc_consolidation.consolidate(name, param, fishers[name])
 
         self.ewc_task_count += 1
 
@@ -95,28 +92,9 @@ class EwcClassifier(nn.Module):
         self.train(mode=mode)
 
     def _ewc_loss(self):
-        ewc_losses = []
         if self.ewc_task_count >= 1:
-            if self.online:
-                for name, param in self.named_parameters():
-                    if param.grad is not None:
-                        name = name + '_prev_task'
-                        mean = self.prev_task_params[name]
-                        # apply decay-term to the running sum of the Fisher Information matrices
-                        fisher = self.gamma * self.prev_task_fishers[name]
-                        ewc_loss = torch.sum(fisher * (param - mean) ** 2)
-                        ewc_losses.append(ewc_loss)
-            else:
-                for task in range(self.ewc_task_count):
-                    # compute ewc loss for each parameter
-                    for name, param in self.named_parameters():
-                        if param.grad is not None:
-                            name = name + f'_prev_task{task}'
-                            mean = self.prev_task_params[name]
-                            fisher = self.prev_task_fishers[name]
-                            ewc_loss = torch.sum(fisher * (param - mean) ** 2)
-                            ewc_losses.append(ewc_loss)
-            return torch.sum(torch.stack(ewc_losses)) / 2.0
+            return self.ewc_consolidation.penalty(
+                (name, param) for name, param in self.named_parameters() if param.grad is not None)
         else:
             param = next(self.parameters())
             return torch.tensor(0.0, device=param.device)
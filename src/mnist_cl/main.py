@@ -34,7 +34,8 @@ def main(args):
         model = EwcClassifier(
             config['size'], config['channels'], config['classes'], hidden_units=args.hidden_units,
             lam=args.ewc_lambda, fisher_sample_size=args.ewc_fisher_sample_size,
-            online=args.ewc_online, gamma=args.ewc_gamma, device=device)
+            online=args.ewc_online, gamma=args.ewc_gamma, fisher_chunk_size=args.ewc_fisher_chunk_size,
+            device=device)
     elif args.si:
         model = SiClassifier(
             config['size'], config['channels'], config['classes'], hidden_units=args.hidden_units,
@@ -138,6 +139,7 @@ if __name__ == "__main__":
     parser.add_argument('--ewc', type=str2bool, default=False)
     parser.add_argument('--ewc_lambda', type=float, default=500)
     parser.add_argument('--ewc_fisher_sample_size', type=int)
+    parser.add_argument('--ewc_fisher_chunk_size', type=int, default=0)
     parser.add_argument('--ewc_online', type=str2bool, default=False)
     parser.add_argument('--ewc_gamma', type=float, default=1.0)
 
@@ -3,6 +3,7 @@ from torch import nn
 from torch.nn import functional as F
 from torch import optim
 import utils
+from src.utils import SiPathIntegral
 
 
 class SiClassifier(nn.Module):
@@ -32,17 +33,8 @@ class SiClassifier(nn.Module):
 
         self.to(device)
 
-        self.params_w = {}
-        self.omegas = {}
-        self.prev_task_params = {}
-
         # set prev_params and prev_task_params as weight initializations
-        self.prev_params = {}
-        self.prev_task_params = {}
-        for name, param in self.named_parameters():
-            if param.requires_grad:
-                self.prev_params[name] = param.detach().clone()
-                self.prev_task_params[name] = param.detach().clone()
+        self.si_path_integral = SiPathIntegral(self.named_parameters(), self.epsilon)
 
     def device(self):
         return next(self.parameters()).device
@@ -54,36 +46,13 @@ class SiClassifier(nn.Module):
         return self.trunk(x)
 
     def update_omegas(self):
-        for name, param in self.named_parameters():
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                current_param = param.detach().clone()
-                delta_param = current_param - prev_param
-                current_omega = self.params_w[name] / (delta_param ** 2 + self.epsilon)
-
-                self.prev_task_params[name] = current_param
-                self.omegas[name] = current_omega + self.omegas.get(name, torch.zeros_like(param))
-
-        # clear importance buffers for the next task
-        self.params_w = {}
+        self.si_path_integral.consolidate()
 
     def _estimate_importance(self):
-        for name, param in self.named_parameters():
-            if param.requires_grad:
-                self.params_w[name] = -param.grad * (param.detach() - self.prev_params[name]) + \
-                                      self.params_w.get(name, torch.zeros_like(param))
-                self.prev_params[name] = param.detach().clone()
+        self.si_path_integral.accumulate()
 
     def _surrogate_loss(self):
-        si_losses = []
-        for name, param in self.named_parameters():
-            if param.requires_grad:
-                prev_param = self.prev_task_params[name]
-                omega = self.omegas.get(name, torch.zeros_like(param))
-                si_loss = torch.sum(omega * (param - prev_param) ** 2)
-                si_losses.append(si_loss)
-
-        return torch.sum(torch.stack(si_losses))
+        return self.si_path_integral.penalty(self.named_parameters())
 
     def train_a_batch(self, x, y, active_classes=None):
         # Set model to training-mode
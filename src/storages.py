@@ -1,17 +1,59 @@
 # Adapt from https://github.com/ikostrikov/pytorch-a2c-ppo-acktr-gail
 
+import gym
 import numpy as np
 import torch
-from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+
+from utils import ObsCodec
 
 
 def _flatten_helper(T, N, _tensor):
     return _tensor.view(T * N, *_tensor.size()[2:])
 
 
+def _discounted_scan(deltas, discounts, chunk_size):
+    """Solve x_t = deltas_t + discounts_t * x_{t + 1} backwards from x_T = 0 for (T, N, 1) tensors
+
+    Within a chunk of chunk_size steps the recursion is unrolled into a matrix of discount products,
+    so only T / chunk_size sequential steps remain.
+    """
+    num_steps, num_processes = deltas.size()[0:2]
+    # (N, T)
+    deltas = deltas.view(num_steps, num_processes).t()
+    discounts = discounts.view(num_steps, num_processes).t()
+
+    xs = torch.empty_like(deltas)
+    x_next = deltas.new_zeros(num_processes)
+    for end in range(num_steps, 0, -chunk_size):
+        start = max(end - chunk_size, 0)
+        length = end - start
+        upper = torch.ones(length, length, dtype=torch.bool, device=deltas.device).triu()
+
+        # cum_discounts[n, t, s] = prod_{u=t}^{s} discounts[n, start + u] for s >= t
+        cum_discounts = torch.where(upper, discounts[:, None, start:end], torch.ones_like(upper, dtype=deltas.dtype))
+        cum_discounts = torch.cumprod(cum_discounts, dim=-1)
+        # weights[n, t, s] = prod_{u=t}^{s - 1} discounts[n, start + u] for s >= t
+        weights = torch.cat([torch.ones_like(cum_discounts[..., :1]), cum_discounts[..., :-1]], dim=-1) * upper
+
+        xs[:, start:end] = torch.matmul(weights, deltas[:, start:end, None]).squeeze(-1) \
+                           + cum_discounts[..., -1] * x_next[:, None]
+        x_next = xs[:, start]
+
+    return xs.t().unsqueeze(-1)
+
+
 class RolloutStorage(object):
-    def __init__(self, num_steps, num_processes, obs_shape, action_space, device):
-        self.obs = torch.zeros(num_steps + 1, num_processes, *obs_shape).to(device)
+    """obs_space, obs_dtype, obs_range: storage dtype of observations, see utils.ObsCodec
+
+    Observations are stored in their storage dtype, use set_obs() / get_obs() rather than indexing obs directly.
+    """
+    def __init__(self, num_steps, num_processes, obs_shape, action_space, device,
+                 obs_space=None, obs_dtype=None, obs_range=None):
+        if obs_space is None:
+            obs_space = gym.spaces.Box(-np.inf, np.inf, shape=obs_shape, dtype=np.float32)
+        self.obs_codec = ObsCodec(obs_space, obs_dtype, obs_range)
+        self.obs = torch.zeros(num_steps + 1, num_processes, *obs_shape,
+                               dtype=getattr(torch, self.obs_codec.dtype.name)).to(device)
         self.rewards = torch.zeros(num_steps, num_processes, 1).to(device)
         self.value_preds = torch.zeros(num_steps + 1, num_processes, 1).to(device)
         self.returns = torch.zeros(num_steps + 1, num_processes, 1).to(device)
@@ -34,6 +76,16 @@ class RolloutStorage(object):
         self.device = device
         self.step = 0
 
+        # insert() packs a step of every field into one float32 row, transfers it once and scatters it.
+        # (name, step offset, width) of each field in the row, stored obs and actions are exact in float32
+        self._insert_fields = []
+        for name, offset in [('obs', 1), ('actions', 0), ('log_pis', 0), ('value_preds', 0),
+                             ('rewards', 0), ('masks', 1), ('bad_masks', 1)]:
+            self._insert_fields.append((name, offset, int(np.prod(getattr(self, name).size()[2:]))))
+        row_size = sum(width for _, _, width in self._insert_fields)
+        self._insert_row = torch.empty(num_processes, row_size,
+                                       pin_memory=torch.device(device).type == 'cuda')
+
     # def to(self, device):
     #     self.obs = self.obs.to(device)
     #     self.rewards = self.rewards.to(device)
@@ -56,17 +108,30 @@ class RolloutStorage(object):
         self.masks = self.masks[:num_steps + 1]
         self.bad_masks = self.bad_masks[:num_steps + 1]
 
+    def set_obs(self, step, obs):
+        self.obs[step].copy_(torch.as_tensor(self.obs_codec.encode(obs)).to(self.device))
+
+    def get_obs(self, step):
+        return self.obs_codec.decode(self.obs[step])
+
     def insert(self, obs, actions, log_pis,
                value_preds, rewards, masks, bad_masks):
-        self.obs[self.step + 1].copy_(torch.Tensor(obs).to(self.device))
-        self.actions[self.step].copy_(torch.Tensor(actions).to(self.device))
-        self.log_pis[self.step].copy_(torch.Tensor(log_pis).to(self.device))
-        self.value_preds[self.step].copy_(torch.Tensor(value_preds).to(self.device))
-        self.rewards[self.step].copy_(torch.Tensor(
-            np.expand_dims(rewards, axis=-1)
-        ).to(self.device))
-        self.masks[self.step + 1].copy_(torch.Tensor(masks).to(self.device))
-        self.bad_masks[self.step + 1].copy_(torch.Tensor(bad_masks).to(self.device))
+        """Insert one step of numpy arrays (or cpu tensors) from each process"""
+        values = [self.obs_codec.encode(obs), actions, log_pis, value_preds, rewards, masks, bad_masks]
+        insert_row = self._insert_row.numpy()
+        col = 0
+        for (_, _, width), value in zip(self._insert_fields, values):
+            if isinstance(value, torch.Tensor):
+                value = value.detach().numpy()
+            insert_row[:, col:col + width] = np.reshape(value, (self.num_processes, width))
+            col += width
+
+        device_row = self._insert_row.to(self.device)
+        col = 0
+        for name, offset, width in self._insert_fields:
+            field = getattr(self, name)[self.step + offset]
+            field.copy_(device_row[:, col:col + width].view(field.size()))
+            col += width
 
         self.step = (self.step + 1) % self.num_steps
 
@@ -79,10 +144,22 @@ class RolloutStorage(object):
                         next_value,
                         gamma,
                         gae_lambda,
-                        use_proper_time_limits=True):
+                        use_proper_time_limits=True,
+                        gae_chunk_size=0):
+        """gae_chunk_size: if > 0, compute GAE with a vectorized scan over chunks of this many steps"""
         if not isinstance(next_value, torch.Tensor):
             next_value = torch.Tensor(next_value).to(self.device)
 
+        if gae_chunk_size > 0:
+            self.value_preds[-1] = next_value
+            deltas = self.rewards + gamma * self.value_preds[1:] * self.masks[1:] - self.value_preds[:-1]
+            discounts = gamma * gae_lambda * self.masks[1:]
+            if use_proper_time_limits:
+                deltas = deltas * self.bad_masks[1:]
+                discounts = discounts * self.bad_masks[1:]
+            self.returns[:-1] = _discounted_scan(deltas, discounts, gae_chunk_size) + self.value_preds[:-1]
+            return
+
         # (chongyi zheng): force use GAE
         if use_proper_time_limits:
             # if use_gae:
@@ -119,7 +196,13 @@ class RolloutStorage(object):
     def feed_forward_generator(self,
                                advantages,
                                num_mini_batch=None,
-                               mini_batch_size=None):
+                               mini_batch_size=None,
+                               num_epochs=1):
+        """Yield num_epochs passes of shuffled minibatches
+
+        The storage is flattened once and the permutations of all epochs are drawn on the storage device,
+        each minibatch is a contiguous slice of the permuted tensors.
+        """
         num_steps, num_processes = self.rewards.size()[0:2]
         batch_size = num_processes * num_steps
 
@@ -131,20 +214,30 @@ class RolloutStorage(object):
                 "".format(num_processes, num_steps, num_processes * num_steps,
                           num_mini_batch))
             mini_batch_size = batch_size // num_mini_batch
-        sampler = BatchSampler(
-            SubsetRandomSampler(range(batch_size)),
-            mini_batch_size,
-            drop_last=True)
-        for indices in sampler:
-            obs_batch = self.obs[:-1].view(-1, *self.obs.size()[2:])[indices]
-            actions_batch = self.actions.view(-1,
-                                              self.actions.size(-1))[indices]
-            value_preds_batch = self.value_preds[:-1].view(-1, 1)[indices]
-            return_batch = self.returns[:-1].view(-1, 1)[indices]
-            old_log_pis = self.log_pis.view(-1, 1)[indices]
+        num_batches = batch_size // mini_batch_size
+
+        # drop the last incomplete minibatch of each epoch
+        indices = torch.argsort(torch.rand(num_epochs, batch_size, device=self.device), dim=-1)
+        indices = indices[:, :num_batches * mini_batch_size].reshape(-1)
+
+        obs = self.obs[:-1].reshape(batch_size, *self.obs.size()[2:])[indices]
+        actions = self.actions.reshape(batch_size, self.actions.size(-1))[indices]
+        value_preds = self.value_preds[:-1].reshape(batch_size, 1)[indices]
+        returns = self.returns[:-1].reshape(batch_size, 1)[indices]
+        log_pis = self.log_pis.reshape(batch_size, 1)[indices]
+        if advantages is not None:
+            advantages = advantages.reshape(batch_size, 1)[indices]
+
+        for start in range(0, num_epochs * num_batches * mini_batch_size, mini_batch_size):
+            end = start + mini_batch_size
+            obs_batch = self.obs_codec.decode(obs[start:end])
+            actions_batch = actions[start:end]
+            value_preds_batch = value_preds[start:end]
+            return_batch = returns[start:end]
+            old_log_pis = log_pis[start:end]
             if advantages is None:
                 adv_targ = None
             else:
-                adv_targ = advantages.view(-1, 1)[indices]
+                adv_targ = advantages[start:end]
 
             yield obs_batch, actions_batch, value_preds_batch, return_batch, old_log_pis, adv_targ
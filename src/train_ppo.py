@@ -14,6 +14,7 @@ from agent import make_agent
 import utils
 from environment.env_utils import get_vec_normalize
 import storages
+from inference import make_stepper
 from logger import Logger
 from video import VideoRecorder
 
@@ -38,25 +39,31 @@ def evaluate(train_env, eval_env, agent, video, num_episodes, logger, step):
             obs = eval_env.reset(sample_task=True)
             video.record(eval_env.env)  # use actually vector env
 
-            while len(episode_rewards) < num_episodes:
-                with utils.eval_mode(agent):
-                    if 'mh' in args.algo:
-                        action, _ = agent.act(obs, sample=False, compute_log_pi=False, head_idx=task_id)
-                    else:
-                        action, _ = agent.act(obs, sample=False, compute_log_pi=False)
+            # rendering needs the workers in lockstep
+            if 'mh' in args.algo:
+                stepper = make_stepper(args, eval_env, obs, agent.act, lockstep=video.enabled,
+                                       sample=False, compute_log_pi=False, head_idx=task_id)
+            else:
+                stepper = make_stepper(args, eval_env, obs, agent.act, lockstep=video.enabled,
+                                       sample=False, compute_log_pi=False)
 
-                obs, _, done, infos = eval_env.step(action)
-                video.record(eval_env.env)  # use actually vector env
+            with utils.eval_mode(agent):
+                for _, _, _, _, done, infos in stepper.steps():
+                    video.record(eval_env.env)  # use actually vector env
 
-                for done_ in done:
-                    if done_ and len(episode_rewards) == 0:
-                        video.save('%s_%d.mp4' % (task_name, step))
-                        video.init(enabled=False)
+                    for done_ in done:
+                        if done_ and len(episode_rewards) == 0:
+                            video.save('%s_%d.mp4' % (task_name, step))
+                            video.init(enabled=False)
+
+                    for info in infos:
+                        if 'episode' in info.keys():
+                            episode_successes.append(info.get('success', False))
+                            episode_rewards.append(info['episode']['r'])
 
-                for info in infos:
-                    if 'episode' in info.keys():
-                        episode_successes.append(info.get('success', False))
-                        episode_rewards.append(info['episode']['r'])
+                    if len(episode_rewards) >= num_episodes:
+                        break
+            stepper.close()
             if len(episode_successes) > 0:
                 logger.log('eval/success_rate', np.mean(episode_successes), step)
             logger.log('eval/episode_reward', np.mean(episode_rewards), step, sw_prefix=task_name + '_')
@@ -222,14 +229,20 @@ def main(args):
                                            args.ppo_num_processes,
                                            env.observation_space.shape,
                                            env.action_space,
-                                           device)
+                                           device,
+                                           obs_space=env.observation_space,
+                                           obs_dtype=args.obs_storage_dtype,
+                                           obs_range=args.obs_storage_range)
 
         if 'ewc' in args.algo:
             est_fisher_rollouts = storages.RolloutStorage(args.ppo_ewc_rollout_steps_per_process,
                                                           args.ppo_num_processes,
                                                           env.observation_space.shape,
                                                           env.action_space,
-                                                          device)
+                                                          device,
+                                                          obs_space=env.observation_space,
+                                                          obs_dtype=args.obs_storage_dtype,
+                                                          obs_range=args.obs_storage_range)
 
     agent = make_agent(
         obs_space=env.observation_space,
@@ -238,6 +251,8 @@ def main(args):
         device=device,
         args=args
     )
+    if args.flat_params:
+        agent.flatten_parameters()
 
     logger = Logger(args.work_dir,
                     log_frequency=args.log_freq,
@@ -266,16 +281,30 @@ def main(args):
                                                    args.ppo_num_processes,
                                                    env.observation_space.shape,
                                                    env.all_action_spaces[task_id],
-                                                   device)
+                                                   device,
+                                                   obs_space=env.observation_space,
+                                                   obs_dtype=args.obs_storage_dtype,
+                                                   obs_range=args.obs_storage_range)
 
                 if 'ewc' in args.algo:
                     est_fisher_rollouts = storages.RolloutStorage(args.ppo_ewc_rollout_steps_per_process,
                                                                   args.ppo_num_processes,
                                                                   env.observation_space.shape,
                                                                   env.all_action_spaces[task_id],
-                                                                  device)
+                                                                  device,
+                                                                  obs_space=env.observation_space,
+                                                                  obs_dtype=args.obs_storage_dtype,
+                                                                  obs_range=args.obs_storage_range)
 
-            rollouts.obs[0].copy_(torch.Tensor(obs).to(device))
+            def explore(obs):
+                with utils.eval_mode(agent):
+                    if 'mh' in args.algo:
+                        return agent.act_and_value(obs, sample=True, head_idx=task_id)
+                    else:
+                        return agent.act_and_value(obs, sample=True)
+
+            rollouts.set_obs(0, obs)
+            stepper = make_stepper(args, env, obs, explore)
             for task_epoch in range(total_epochs_per_task):
                 agent.update_learning_rate(task_epoch, total_epochs_per_task)
 
@@ -288,17 +317,8 @@ def main(args):
                     logger.log('eval/episode', episode, total_steps)
                     evaluate(env, eval_env, agent, video, args.num_eval_episodes, logger, total_steps)
 
-                for step in range(args.ppo_num_rollout_steps_per_process):
-                    with utils.eval_mode(agent):
-                        if 'mh' in args.algo:
-                            action, log_pi = agent.act(obs, sample=True, compute_log_pi=True, head_idx=task_id)
-                            value = agent.predict_value(obs, head_idx=task_id)
-                        else:
-                            action, log_pi = agent.act(obs, sample=True, compute_log_pi=True)
-                            value = agent.predict_value(obs)
-
-                    obs, reward, done, infos = env.step(action)
-
+                for _, (action, log_pi, value), reward, obs, done, infos in \
+                        stepper.steps(args.ppo_num_rollout_steps_per_process):
                     for done_ in done:
                         if done_:
                             episode += 1
@@ -319,12 +339,13 @@ def main(args):
                 task_steps += args.ppo_num_rollout_steps_per_process * args.ppo_num_processes
                 total_steps += args.ppo_num_rollout_steps_per_process * args.ppo_num_processes
                 if 'mh' in args.algo:
-                    next_value = agent.predict_value(rollouts.obs[-1], head_idx=task_id)
+                    next_value = agent.predict_value(rollouts.get_obs(-1), head_idx=task_id)
                 else:
-                    next_value = agent.predict_value(rollouts.obs[-1])
+                    next_value = agent.predict_value(rollouts.get_obs(-1))
                 rollouts.compute_returns(next_value, args.discount,
                                          args.ppo_gae_lambda,
-                                         args.ppo_use_proper_time_limits)
+                                         args.ppo_use_proper_time_limits,
+                                         gae_chunk_size=args.ppo_gae_chunk_size)
                 if 'mh' in args.algo:
                     agent.update(rollouts, logger, total_steps, head_idx=task_id)
                 else:
@@ -341,11 +362,13 @@ def main(args):
                 log_info = {'train/task_name': infos[0]['task_name']}
                 logger.dump(total_steps, ty='train', save=True, info=log_info)
 
+            stepper.close()
             if 'ewc' in args.algo:
                 compute_returns_kwargs = {
                     'gamma': args.discount,
                     'gae_lambda': args.ppo_gae_lambda,
-                    'use_proper_time_limits': args.ppo_use_proper_time_limits
+                    'use_proper_time_limits': args.ppo_use_proper_time_limits,
+                    'gae_chunk_size': args.ppo_gae_chunk_size,
                 }
                 print(f"Estimating EWC fisher: {infos[0]['task_name']}")
                 if 'mh' in args.algo:
@@ -359,7 +382,8 @@ def main(args):
                 compute_returns_kwargs = {
                     'gamma': args.discount,
                     'gae_lambda': args.ppo_gae_lambda,
-                    'use_proper_time_limits': args.ppo_use_proper_time_limits
+                    'use_proper_time_limits': args.ppo_use_proper_time_limits,
+                    'gae_chunk_size': args.ppo_gae_chunk_size,
                 }
                 print(f"Constructing AGEM memory: {infos[0]['task_name']}")
                 if 'mh' in args.algo:
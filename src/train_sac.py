@@ -3,6 +3,7 @@ import numpy as np
 import os
 from collections import deque
 import copy
+import queue
 
 
 from arguments import parse_args
@@ -14,6 +15,7 @@ from agent import make_agent
 import utils
 import buffers
 import time
+from inference import make_stepper
 from logger import Logger
 from video import VideoRecorder
 
@@ -38,15 +40,15 @@ def evaluate(train_env, eval_env, agent, video, num_episodes, logger, step):
             obs = eval_env.reset(sample_task=True)
             video.record(eval_env.env)  # use actually vector env
 
-            while len(episode_rewards) < num_episodes:
-                with utils.eval_mode(agent):
-                    with utils.eval_mode(agent):
-                        if any(x in args.algo for x in ['mh', 'mi', 'individual']):
-                            action = agent.act(obs, sample=False, head_idx=task_id)
-                        else:
-                            action = agent.act(obs, sample=False)
+            # rendering needs the workers in lockstep
+            if any(x in args.algo for x in ['mh', 'mi', 'individual']):
+                stepper = make_stepper(args, eval_env, obs, agent.act, lockstep=video.enabled,
+                                       sample=False, head_idx=task_id)
+            else:
+                stepper = make_stepper(args, eval_env, obs, agent.act, lockstep=video.enabled, sample=False)
 
-                    obs, _, done, infos = eval_env.step(action)
+            with utils.eval_mode(agent):
+                for _, _, _, _, done, infos in stepper.steps():
                     video.record(eval_env.env)  # use actually vector env
 
                     for done_ in done:
@@ -59,6 +61,10 @@ def evaluate(train_env, eval_env, agent, video, num_episodes, logger, step):
                             episode_successes.append(info.get('success', False))
                             episode_rewards.append(info['episode']['r'])
 
+                    if len(episode_rewards) >= num_episodes:
+                        break
+            stepper.close()
+
             if 'ewc_v2' in args.algo:
                 kl_div = agent.kl_with_optimal_actor(task_id)
                 logger.log('eval/kl_divergence', kl_div, step)
@@ -105,6 +111,225 @@ def evaluate(train_env, eval_env, agent, video, num_episodes, logger, step):
             logger.dump(step, ty='eval', info=log_info)
 
 
+def finish_task(args, agent, env, replay_buffer, task_id, task_name):
+    """End-of-task consolidation: estimate the EWC fisher, update the SI omegas or construct the A-GEM memory"""
+    if 'ewc' in args.algo:
+        print(f"Estimating EWC fisher: {task_name}")
+        if 'ewc_v2' in args.algo:
+            if any(x in args.algo for x in ['mh', 'mi', 'individual']):
+                agent.estimate_fisher(env, head_idx=task_id)
+            else:
+                agent.estimate_fisher(env)
+        else:
+            if any(x in args.algo for x in ['mh', 'mi', 'individual']):
+                agent.estimate_fisher(replay_buffer, head_idx=task_id)
+            else:
+                agent.estimate_fisher(replay_buffer)
+    elif 'si' in args.algo:
+        print(f"Updating SI omega: {task_name}")
+        agent.update_omegas()
+    elif 'agem' in args.algo:
+        print(f"Constructing AGEM memory: {task_name}")
+        if 'agem_v2' in args.algo:
+            if any(x in args.algo for x in ['mh', 'mi', 'individual']):
+                agent.construct_memory(env, head_idx=task_id)
+            else:
+                agent.construct_memory(env)
+        else:
+            agent.construct_memory(replay_buffer)
+
+
+def make_train_env(args, log_dir_name='train_env'):
+    return make_continual_vec_envs(
+        args.env_names, args.seed, args.sac_num_processes,
+        args.discount, utils.make_dir(os.path.join(args.work_dir, log_dir_name)),
+        allow_early_resets=True,
+        normalize=False,
+        add_onehot=args.add_onehot,
+    )
+
+
+def collect_async(args, replay_buffer, epochs_allowed, actor_weights, stats_queue, task_barrier):
+    """Collector process of the asynchronous mode
+
+    Steps its own copy of the training environments with the latest actor published to actor_weights and adds
+    the transitions to the shared replay buffer. Collection stops after epochs_allowed epochs of each task and
+    the statistics of every epoch are sent back through stats_queue.
+    """
+    torch.set_num_threads(1)
+    utils.set_seed_everywhere(args.seed)
+    # the learner keeps the default train_env directory for its own environments
+    env = make_train_env(args, 'async_train_env')
+    multi_head = any(x in args.algo for x in ['mh', 'mi', 'individual'])
+    agent = make_agent(
+        obs_space=env.observation_space,
+        action_space=[env.action_space for _ in range(env.num_tasks)] if multi_head else env.action_space,
+        device=torch.device('cpu'),
+        args=args
+    )
+    total_epochs_per_task = int(args.train_steps_per_task) // args.sac_num_expl_steps_per_process \
+                            // args.sac_num_processes
+
+    for task_id in range(env.num_tasks):
+        task_steps = 0
+        obs = env.reset(sample_task=True)
+        task_barrier.wait()
+
+        def explore(obs):
+            actor_weights.load(agent.actor)
+
+            if task_steps < args.sac_init_steps:
+                return np.array([env.action_space.sample() for _ in range(len(obs))])
+
+            with utils.eval_mode(agent):
+                if multi_head:
+                    return agent.act(obs, sample=True, head_idx=task_id)
+                else:
+                    return agent.act(obs, sample=True)
+
+        stepper = make_stepper(args, env, obs, explore)
+        for task_epoch in range(total_epochs_per_task):
+            while epochs_allowed.value <= task_epoch:
+                time.sleep(1e-3)
+
+            episodes = 0
+            successes, episode_rewards = [], []
+            for obs, action, reward, next_obs, done, infos in stepper.steps(args.sac_num_expl_steps_per_process):
+                episodes += int(np.sum(done))
+                for info in infos:
+                    if 'episode' in info.keys():
+                        successes.append(info.get('success', False))
+                        episode_rewards.append(info['episode']['r'])
+
+                replay_buffer.add(obs, action, reward, next_obs, done, infos)
+
+            task_steps += args.sac_num_expl_steps_per_process * args.sac_num_processes
+            stats_queue.put({
+                'episodes': episodes,
+                'successes': successes,
+                'episode_rewards': episode_rewards,
+                'task_name': infos[0]['task_name'],
+            })
+        stepper.close()
+
+    env.close()
+
+
+def train_async(args, env, eval_env, agent, replay_buffer_kwargs, logger, video, model_dir):
+    """Update the agent while collect_async steps the training environments in another process
+
+    Collection runs ahead of the updates epoch by epoch. It pauses before the epochs at which the synchronous
+    loop saves or evaluates the agent and at the end of each task, so these see the same amount of data and
+    updates. After the sac_init_steps warm-up, the learner does at most sac_async_update_ratio updates per collected
+    env step.
+    """
+    ctx = torch.multiprocessing.get_context('spawn')
+    replay_buffer = buffers.SharedReplayBuffer(mp_context=ctx, **replay_buffer_kwargs)
+    epochs_allowed = ctx.Value('q', 0, lock=False)
+    actor_weights = utils.WeightBroadcast(agent.actor)
+    stats_queue = ctx.Queue()
+    task_barrier = ctx.Barrier(2)
+    # not a daemon, the collector starts its own environment workers
+    collector = ctx.Process(target=collect_async,
+                            args=(args, replay_buffer, epochs_allowed, actor_weights, stats_queue, task_barrier))
+    collector.start()
+
+    multi_head = any(x in args.algo for x in ['mh', 'mi', 'individual'])
+    total_epochs_per_task = int(args.train_steps_per_task) // args.sac_num_expl_steps_per_process \
+                            // args.sac_num_processes
+    epoch_steps = args.sac_num_expl_steps_per_process * args.sac_num_processes
+    update_ratio = args.sac_async_update_ratio or args.sac_num_train_iters / epoch_steps
+    # epochs collected before the synchronous loop starts updating
+    warmup_epochs = max(-(-args.sac_init_steps // epoch_steps) - 1, 0)
+
+    def next_checkpoint(task_epoch):
+        for epoch in range(task_epoch + 1, total_epochs_per_task):
+            if epoch % args.eval_freq == 0 or (args.save_model and epoch % args.save_freq == 0):
+                return epoch
+        return total_epochs_per_task
+
+    episode = 0
+    total_steps = 0
+    recent_success = deque(maxlen=100)
+    recent_episode_reward = deque(maxlen=100)
+    try:
+        for task_id in range(env.num_tasks):
+            head_kwargs = {'head_idx': task_id} if multi_head else {}
+            task_epoch = 0
+            task_steps = 0
+            num_updates = 0
+            start_time = time.time()
+            env.reset(sample_task=True)
+
+            # prefetching is not used, every add() of the collector would invalidate the prepared minibatches
+            replay_buffer.reset()
+            epochs_allowed.value = 0
+            actor_weights.publish(agent.actor)
+            task_barrier.wait()
+
+            while True:
+                max_updates = int(update_ratio * epoch_steps * max(task_epoch - warmup_epochs, 0))
+                if num_updates < max_updates:
+                    block_size = min(args.sac_update_block_size, max_updates - num_updates)
+                    agent.update_many(replay_buffer, logger, total_steps, block_size, **head_kwargs)
+                    if (num_updates + block_size) // args.sac_async_actor_sync_freq > \
+                            num_updates // args.sac_async_actor_sync_freq:
+                        actor_weights.publish(agent.actor)
+                    num_updates += block_size
+                elif task_epoch == epochs_allowed.value:
+                    # the collector is paused and the updates have caught up
+                    if task_epoch == total_epochs_per_task:
+                        break
+
+                    # Save agent periodically
+                    if task_epoch % args.save_freq == 0:
+                        if args.save_model:
+                            agent.save(model_dir, total_steps)
+
+                    # Evaluate agent periodically
+                    if task_epoch % args.eval_freq == 0:
+                        print('Evaluating:', args.work_dir)
+                        logger.log('eval/episode', episode, total_steps)
+                        evaluate(env, eval_env, agent, video, args.num_eval_episodes, logger, total_steps)
+
+                    actor_weights.publish(agent.actor)
+                    epochs_allowed.value = next_checkpoint(task_epoch)
+
+                try:
+                    # only block when there is nothing to update
+                    stats = stats_queue.get(block=num_updates >= max_updates, timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                task_epoch += 1
+                task_steps += epoch_steps
+                total_steps += epoch_steps
+                episode += stats['episodes']
+                recent_success.extend(stats['successes'])
+                recent_episode_reward.extend(stats['episode_rewards'])
+                task_name = stats['task_name']
+
+                end_time = time.time()
+                print("FPS: ", int(task_steps / (end_time - start_time)))
+
+                logger.log('train/recent_success', np.mean(recent_success), total_steps)
+                logger.log('train/recent_episode_reward', np.mean(recent_episode_reward), total_steps)
+                logger.log('train/episode', episode, total_steps)
+                log_info = {'train/task_name': task_name}
+                logger.dump(total_steps, ty='train', save=(task_steps > args.sac_init_steps), info=log_info)
+
+            finish_task(args, agent, env, replay_buffer, task_id, task_name)
+            agent.reset(reset_critic=args.reset_agent)
+
+        collector.join()
+    finally:
+        if collector.is_alive():
+            task_barrier.abort()
+            collector.terminate()
+
+    return total_steps
+
+
 def main(args):
     # Initialize environment
     if args.env_type == 'atari':
@@ -248,6 +473,8 @@ def main(args):
         device=device,
         args=args
     )
+    if args.flat_params:
+        agent.flatten_parameters()
 
     logger = Logger(args.work_dir,
                     log_frequency=args.log_freq,
@@ -268,20 +495,58 @@ def main(args):
         total_epochs_per_task = int(args.train_steps_per_task) // args.sac_num_expl_steps_per_process \
                                 // args.sac_num_processes
 
+        replay_buffer_kwargs = {
+            'obs_space': env.observation_space,
+            'action_space': env.action_space,
+            'capacity': args.replay_buffer_capacity,
+            'device': device,
+            'n_envs': args.sac_num_processes,
+            'optimize_memory_usage': True,
+            'storage_dir': os.path.join(args.work_dir, 'replay_buffer') if args.replay_buffer_on_disk else None,
+            'obs_dtype': args.obs_storage_dtype,
+            'obs_range': args.obs_storage_range,
+        }
+        if args.persistent_replay_buffer:
+            # allocate once, each task writes into its own segment
+            replay_buffer = buffers.TaskPartitionedReplayBuffer(num_tasks=env.num_tasks, **replay_buffer_kwargs)
+        if args.sac_async:
+            total_steps = train_async(args, env, eval_env, agent, replay_buffer_kwargs, logger, video, model_dir)
+            print('Final evaluating:', args.work_dir)
+            evaluate(env, eval_env, agent, video, args.num_eval_episodes, logger, total_steps)
+            return
+
         for task_id in range(env.num_tasks):
             task_steps = 0
             start_time = time.time()
             obs = env.reset(sample_task=True)
 
             # reset replay buffer
-            replay_buffer = buffers.ReplayBuffer(
-                obs_space=env.observation_space,
-                action_space=env.action_space,
-                capacity=args.replay_buffer_capacity,
-                device=device,
-                optimize_memory_usage=True,
-            )
+            if args.persistent_replay_buffer:
+                replay_buffer.set_task(task_id)
+            elif args.prioritized_replay:
+                replay_buffer = buffers.PrioritizedReplayBuffer(alpha=args.prioritized_replay_alpha,
+                                                                beta=args.prioritized_replay_beta,
+                                                                eps=args.prioritized_replay_eps,
+                                                                **replay_buffer_kwargs)
+            elif args.pixel_obs and args.frame_stack > 1:
+                # store every frame once instead of frame_stack times
+                replay_buffer = buffers.FrameStackReplayBuffer(frame_stack=args.frame_stack, **replay_buffer_kwargs)
+            else:
+                replay_buffer = buffers.ReplayBuffer(**replay_buffer_kwargs)
+            if args.replay_buffer_num_prefetch > 0:
+                replay_buffer.start_prefetch(args.batch_size, args.replay_buffer_num_prefetch)
+
+            def explore(obs):
+                if task_steps < args.sac_init_steps:
+                    return np.array([env.action_space.sample() for _ in range(len(obs))])
 
+                with utils.eval_mode(agent):
+                    if any(x in args.algo for x in ['mh', 'mi', 'individual']):
+                        return agent.act(obs, sample=True, head_idx=task_id)
+                    else:
+                        return agent.act(obs, sample=True)
+
+            stepper = make_stepper(args, env, obs, explore)
             for task_epoch in range(total_epochs_per_task):
                 # Save agent periodically
                 if task_epoch % args.save_freq == 0:
@@ -308,19 +573,7 @@ def main(args):
                 #     agent.reset_target_critic()
                 #     replay_buffer.reset()
 
-                for step in range(args.sac_num_expl_steps_per_process):
-                    if task_steps < args.sac_init_steps:
-                        action = np.array([env.action_space.sample()
-                                           for _ in range(env.unwrapped.num_envs)])
-                    else:
-                        with utils.eval_mode(agent):
-                            if any(x in args.algo for x in ['mh', 'mi', 'individual']):
-                                action = agent.act(obs, sample=True, head_idx=task_id)
-                            else:
-                                action = agent.act(obs, sample=True)
-
-                    next_obs, reward, done, infos = env.step(action)
-
+                for obs, action, reward, next_obs, done, infos in stepper.steps(args.sac_num_expl_steps_per_process):
                     for done_ in done:
                         if done_:
                             episode += 1
@@ -332,17 +585,17 @@ def main(args):
 
                     replay_buffer.add(obs, action, reward, next_obs, done, infos)
 
-                    obs = next_obs
-
                 task_steps += args.sac_num_expl_steps_per_process * args.sac_num_processes
                 total_steps += args.sac_num_expl_steps_per_process * args.sac_num_processes
 
                 if task_steps >= args.sac_init_steps:
-                    for _ in range(args.sac_num_train_iters):
+                    # sample sac_update_block_size minibatches at once
+                    for block_start in range(0, args.sac_num_train_iters, args.sac_update_block_size):
+                        num_updates = min(args.sac_update_block_size, args.sac_num_train_iters - block_start)
                         if any(x in args.algo for x in ['mh', 'mi', 'individual']):
-                            agent.update(replay_buffer, logger, total_steps, head_idx=task_id)
+                            agent.update_many(replay_buffer, logger, total_steps, num_updates, head_idx=task_id)
                         else:
-                            agent.update(replay_buffer, logger, total_steps)
+                            agent.update_many(replay_buffer, logger, total_steps, num_updates)
 
                 end_time = time.time()
                 print("FPS: ", int(task_steps / (end_time - start_time)))
@@ -415,31 +668,9 @@ def main(args):
                 # episode_step += 1
                 # total_steps += 1
 
-            if 'ewc' in args.algo:
-                print(f"Estimating EWC fisher: {infos[0]['task_name']}")
-                if 'ewc_v2' in args.algo:
-                    if any(x in args.algo for x in ['mh', 'mi', 'individual']):
-                        agent.estimate_fisher(env, head_idx=task_id)
-                    else:
-                        agent.estimate_fisher(env)
-                else:
-                    if any(x in args.algo for x in ['mh', 'mi', 'individual']):
-                        agent.estimate_fisher(replay_buffer, head_idx=task_id)
-                    else:
-                        agent.estimate_fisher(replay_buffer)
-            elif 'si' in args.algo:
-                print(f"Updating SI omega: {infos[0]['task_name']}")
-                agent.update_omegas()
-            elif 'agem' in args.algo:
-                print(f"Constructing AGEM memory: {infos[0]['task_name']}")
-                if 'agem_v2' in args.algo:
-                    if any(x in args.algo for x in ['mh', 'mi', 'individual']):
-                        agent.construct_memory(env, head_idx=task_id)
-                    else:
-                        agent.construct_memory(env)
-                else:
-                    agent.construct_memory(replay_buffer)
-
+            stepper.close()
+            finish_task(args, agent, env, replay_buffer, task_id, infos[0]['task_name'])
+            replay_buffer.stop_prefetch()
             agent.reset(reset_critic=args.reset_agent)
 
     print('Final evaluating:', args.work_dir)
@@ -3,9 +3,11 @@ from torch import nn
 import torch.nn.functional as F
 from torch import distributions as pyd
 
+import functools
 import numpy as np
 import os
 import random
+import time
 
 
 class eval_mode(object):
@@ -118,6 +120,14 @@ class DiagGaussian(nn.Module):
 
 
 def soft_update_params(net, target_net, tau):
+    found = FlatParams.find(net.parameters())
+    target_found = FlatParams.find(target_net.parameters())
+    if found is not None and target_found is not None:
+        (flat_params, start, end), (target_flat_params, target_start, target_end) = found, target_found
+        with torch.no_grad():
+            target_flat_params.data[target_start:target_end].lerp_(flat_params.data[start:end], tau)
+        return
+
     with torch.no_grad():
         for param, target_param in zip(net.parameters(), target_net.parameters()):
             target_param.data.copy_(
@@ -125,6 +135,226 @@ def soft_update_params(net, target_net, tau):
             )
 
 
+class FlatParams(object):
+    """Parameters backed by one contiguous buffer and their gradients by another
+
+    Each param.data and param.grad becomes a view of data and grad, so operations over a network
+    (gradient projection, Polyak averaging, dot products, norms) are single vector ops on slices of them.
+    Create it after the modules are moved to their device, load_state_dict() and optimizer steps update
+    the parameters in place. Pass the optimizers to zero_grad_in_place() so that zero_grad() keeps the
+    gradient views, a gradient autograd allocates after a reset to None is moved into grad once accumulated.
+    """
+    def __init__(self, parameters):
+        self.params = list(parameters)
+        assert self.params, "'parameters' must not be empty"
+        assert all(not hasattr(param, '_flat_params') for param in self.params), \
+            "parameters are already flattened"
+
+        self.data = torch.cat([param.detach().flatten() for param in self.params])
+        self._grad = torch.zeros_like(self.data)
+        self._grad_views = []
+        self._offsets = [0]
+        for idx, param in enumerate(self.params):
+            offset = self._offsets[-1]
+            num_param = param.numel()
+            param.data = self.data[offset:offset + num_param].view_as(param)
+            self._grad_views.append(self._grad[offset:offset + num_param].view_as(param))
+            self._offsets.append(offset + num_param)
+            param._flat_params = (self, idx)
+            if param.grad is not None:
+                self._grad_views[-1].copy_(param.grad)
+            param.grad = self._grad_views[-1]
+            param.register_post_accumulate_grad_hook(self._rebind_grad)
+
+    @staticmethod
+    def find(parameters):
+        """(flat_params, start, end) if parameters are a consecutive run of one FlatParams, else None"""
+        parameters = list(parameters)
+        if not parameters or not hasattr(parameters[0], '_flat_params'):
+            return None
+
+        flat_params, first = parameters[0]._flat_params
+        last = first + len(parameters)
+        flat_run = flat_params.params[first:last]
+        if len(flat_run) != len(parameters) or \
+                any(param is not flat_param for param, flat_param in zip(parameters, flat_run)):
+            return None
+
+        return flat_params, flat_params._offsets[first], flat_params._offsets[last]
+
+    @staticmethod
+    def zero_grad_in_place(*optimizers):
+        """Make zero_grad() of the optimizers holding flattened parameters zero the gradients instead of
+        resetting them to None"""
+        for optimizer in optimizers:
+            if any(hasattr(param, '_flat_params') for group in optimizer.param_groups for param in group['params']):
+                optimizer.zero_grad = functools.partial(optimizer.zero_grad, set_to_none=False)
+
+    def _rebind_grad(self, param):
+        grad = self._grad_views[param._flat_params[1]]
+        if param.grad is not grad:
+            grad.copy_(param.grad)
+            param.grad = grad
+
+    @property
+    def grad(self):
+        return self._grad
+
+
+def assign_grads(parameters, grads):
+    """Set param.grad = grad, in place for the parameters backed by FlatParams"""
+    for param, grad in zip(parameters, grads):
+        if not hasattr(param, '_flat_params'):
+            param.grad = grad
+            continue
+
+        flat_params, idx = param._flat_params
+        grad_view = flat_params._grad_views[idx]
+        if grad is None:
+            grad_view.zero_()
+        else:
+            grad_view.copy_(grad)
+        param.grad = grad_view
+
+
+def skip_inactive_heads(optimizer):
+    """Leave the heads without gradient in stacked per-head parameters (see network.MultiHeadMlp) and their
+    optimizer state untouched by optimizer.step()
+
+    With one parameter per head, the heads of other tasks have no gradient and are skipped by the optimizer.
+    Stacked, they get zero gradient rows that Adam would keep moving with the momentum of earlier tasks.
+    """
+    params = [param for group in optimizer.param_groups for param in group['params']
+              if getattr(param, '_stacked_heads', False)]
+    if not params:
+        return
+    saved = []
+
+    def save_inactive_heads(optimizer, args, kwargs):
+        saved.clear()
+        for param in params:
+            if param.grad is None:
+                continue
+            # (num_heads, 1, ...) mask, computed on the device without synchronizing
+            inactive = (param.grad.flatten(1) == 0).all(dim=1).view(-1, *[1] * (param.dim() - 1))
+            state = {name: value.clone() for name, value in optimizer.state.get(param, {}).items()
+                     if torch.is_tensor(value) and value.shape == param.shape}
+            saved.append((param, inactive, param.detach().clone(), state))
+
+    def restore_inactive_heads(optimizer, args, kwargs):
+        with torch.no_grad():
+            for param, inactive, data, state in saved:
+                param.copy_(torch.where(inactive, data, param))
+                for name, value in optimizer.state[param].items():
+                    if not torch.is_tensor(value) or value.shape != param.shape:
+                        continue
+                    if name in state:
+                        value.copy_(torch.where(inactive, state[name], value))
+                    else:
+                        # state created by this step
+                        value.masked_fill_(inactive, 0.0)
+        saved.clear()
+
+    optimizer.register_step_pre_hook(save_inactive_heads)
+    optimizer.register_step_post_hook(restore_inactive_heads)
+
+
+def get_flat_grad(parameters):
+    """Gradients of the parameters that require grad as one vector, a view if they are backed by FlatParams"""
+    parameters = [param for param in parameters if param.requires_grad]
+    found = FlatParams.find(parameters)
+    if found is not None:
+        flat_params, start, end = found
+        return flat_params.grad[start:end]
+
+    return torch.cat([param.grad.flatten() for param in parameters])
+
+
+def set_flat_grad(parameters, grad):
+    """Copy a gradient vector laid out as in get_flat_grad() into the parameters that require grad"""
+    parameters = [param for param in parameters if param.requires_grad]
+    found = FlatParams.find(parameters)
+    if found is not None:
+        flat_params, start, end = found
+        flat_params.grad[start:end].copy_(grad)
+        return
+
+    idx = 0
+    for param in parameters:
+        num_param = param.numel()
+        param.grad.copy_(grad[idx:idx + num_param].view_as(param))
+        idx += num_param
+
+
+def batched_task_grads(task_losses, parameters):
+    """(num_tasks, num_params) gradients of each entry of task_losses w.r.t. the parameters that require grad,
+    laid out as in get_flat_grad() and computed in one batched backward pass"""
+    parameters = [param for param in parameters if param.requires_grad]
+    num_tasks = task_losses.size(0)
+    grads = torch.autograd.grad(task_losses, parameters,
+                                grad_outputs=torch.eye(num_tasks, device=task_losses.device),
+                                is_grads_batched=True, allow_unused=True)
+
+    return torch.cat([
+        grad.reshape(num_tasks, -1) if grad is not None else task_losses.new_zeros(num_tasks, param.numel())
+        for param, grad in zip(parameters, grads)
+    ], dim=1)
+
+
+def clip_task_grads(task_grads, max_norm):
+    """Scale each row of task_grads as clip_grad_norm_() would scale that gradient"""
+    clip_coefs = (max_norm / (task_grads.norm(dim=1, keepdim=True) + 1e-6)).clamp(max=1.0)
+
+    return task_grads * clip_coefs
+
+
+class _SampleLoss(nn.Module):
+    """Module calling sample_loss, so torch.func.functional_call() can swap the parameters of modules"""
+    def __init__(self, modules, sample_loss):
+        super().__init__()
+        self.nets = nn.ModuleList(modules)
+        self.sample_loss = sample_loss
+
+    def forward(self, *sample):
+        return self.sample_loss(*sample)
+
+
+def per_sample_fisher(named_parameters, modules, sample_loss, inputs, chunk_size):
+    """Diagonal empirical Fisher Information {name: mean over samples of the squared per-sample gradient}
+
+    named_parameters: parameters of modules to estimate the Fisher of, sample_loss(*batch) computes the loss
+    of a batch with the modules, inputs are tensors with one sample per row. Per-sample gradients of chunk_size
+    samples are computed at once with torch.func.vmap(torch.func.grad(...)), which bounds the memory, and their
+    squares are summed as the chunks stream by.
+    """
+    named_parameters = [(name, param) for name, param in named_parameters if param.requires_grad]
+    loss_module = _SampleLoss(modules, sample_loss)
+    # parameters are swapped in by their names inside loss_module
+    full_names = {id(param): name for name, param in loss_module.named_parameters()}
+    params = {full_names[id(param)]: param.detach() for _, param in named_parameters}
+
+    def compute_loss(params, *sample):
+        return torch.func.functional_call(loss_module, params, tuple(x.unsqueeze(0) for x in sample))
+
+    per_sample_grads = torch.func.vmap(torch.func.grad(compute_loss), in_dims=(None,) + (0,) * len(inputs),
+                                       randomness='different')
+
+    num_samples = inputs[0].size(0)
+    sq_grads = {name: torch.zeros_like(param) for name, param in params.items()}
+    # distributions check their arguments with data dependent control flow, which vmap does not support
+    validate_args = torch.distributions.Distribution._validate_args
+    torch.distributions.Distribution.set_default_validate_args(False)
+    try:
+        for start in range(0, num_samples, chunk_size):
+            grads = per_sample_grads(params, *[x[start:start + chunk_size] for x in inputs])
+            for name, grad in grads.items():
+                sq_grads[name].add_(torch.sum(grad ** 2, dim=0))
+    finally:
+        torch.distributions.Distribution.set_default_validate_args(validate_args)
+
+    return {name: sq_grads[full_names[id(param)]] / num_samples for name, param in named_parameters}
+
+
 def set_seed_everywhere(seed):
     # Seed python RNG
     random.seed(seed)
@@ -153,6 +383,346 @@ def to_np(t):
         return t.cpu().detach().numpy()
 
 
+class ObsCodec(object):
+    """Storage dtype for observations in replay and rollout buffers
+
+    Pixel observations (uint8 spaces) are always stored as uint8. Other observations are stored as float32,
+    float16, or int16 affine quantized over obs_range (the observation space bounds by default).
+    encode() converts numpy observations before they are stored, decode() converts the sampled tensors
+    to float32 on the device they were transferred to.
+    """
+    DTYPES = ('float32', 'float16', 'int16')
+
+    def __init__(self, obs_space, dtype=None, obs_range=None):
+        self.scale = None
+        self.offset = None
+
+        if obs_space.dtype == np.uint8:
+            self.dtype = np.dtype(np.uint8)
+        elif dtype is None or dtype in ('float32', 'float16'):
+            self.dtype = np.dtype(dtype or np.float32)
+        elif dtype == 'int16':
+            low, high = (obs_space.low, obs_space.high) if obs_range is None else obs_range
+            low = np.broadcast_to(np.asarray(low, dtype=np.float32), obs_space.shape)
+            high = np.broadcast_to(np.asarray(high, dtype=np.float32), obs_space.shape)
+            if not (np.all(np.isfinite(low)) and np.all(np.isfinite(high))):
+                raise ValueError("int16 observation storage requires a finite observation range")
+
+            self.dtype = np.dtype(np.int16)
+            self.offset = (high + low) / 2
+            self.scale = np.maximum((high - low) / (2 * np.iinfo(np.int16).max), np.finfo(np.float32).tiny)
+            self._device_params = {}
+        else:
+            raise ValueError(f"Unknown observation storage dtype: {dtype}")
+
+    def encode(self, obs):
+        if self.scale is None:
+            return np.asarray(obs).astype(self.dtype, copy=False)
+
+        max_value = np.iinfo(np.int16).max
+        quantized = np.rint((np.asarray(obs, dtype=np.float32) - self.offset) / self.scale)
+
+        return np.clip(quantized, -max_value, max_value).astype(np.int16)
+
+    def decode(self, obs):
+        if self.scale is None:
+            return obs.float()
+
+        if obs.device not in self._device_params:
+            self._device_params[obs.device] = (torch.as_tensor(self.offset, device=obs.device),
+                                               torch.as_tensor(self.scale, device=obs.device))
+        offset, scale = self._device_params[obs.device]
+
+        # single fused multiply-add on the device the compact observations were copied to
+        return torch.addcmul(offset, obs.float(), scale)
+
+
+class EwcConsolidation(object):
+    """Quadratic EWC penalties of all previous tasks folded into one quadratic per parameter
+
+    Offline EWC: sum_t F_t (theta - theta_t)^2 = P (theta - m)^2 + c, with precision P = sum_t F_t,
+    anchor m the precision weighted mean of the theta_t and a constant c, so penalty() costs the same
+    for any number of tasks. Online EWC: precision = gamma * running Fisher, anchor = latest theta.
+    """
+    def __init__(self, online=False, gamma=1.0):
+        self.online = online
+        self.gamma = gamma
+        self.precisions = {}
+        self.anchors = {}
+        self.constants = {}
+        # running Fisher Information of online EWC
+        self.fishers = {}
+
+    def consolidate(self, name, param, fisher):
+        """Add the quadratic penalty of parameter name around its value param with Fisher Information fisher"""
+        param = param.detach().clone()
+        fisher = fisher.detach().clone()
+
+        if self.online:
+            if name in self.fishers:
+                fisher = fisher + self.gamma * self.fishers[name]
+            self.fishers[name] = fisher
+            self.precisions[name] = self.gamma * fisher
+            self.anchors[name] = param
+            self.constants[name] = torch.zeros((), device=param.device)
+        elif name not in self.precisions:
+            self.precisions[name] = fisher
+            self.anchors[name] = param
+            self.constants[name] = torch.zeros((), device=param.device)
+        else:
+            precision, anchor = self.precisions[name], self.anchors[name]
+            new_precision = precision + fisher
+            # P (theta - m)^2 + F (theta - mu)^2 = P' (theta - m')^2 + P F / P' (m - mu)^2
+            ratio = torch.where(new_precision > 0, fisher / new_precision, torch.zeros_like(fisher))
+            self.constants[name] = self.constants[name] + torch.sum(precision * ratio * (anchor - param) ** 2)
+            self.precisions[name] = new_precision
+            self.anchors[name] = anchor + ratio * (param - anchor)
+
+    def penalty(self, named_parameters):
+        ewc_losses = []
+        for name, param in named_parameters:
+            ewc_loss = torch.sum(self.precisions[name] * (param - self.anchors[name]) ** 2) + self.constants[name]
+            ewc_losses.append(ewc_loss)
+
+        return torch.sum(torch.stack(ewc_losses)) / 2.0
+
+    def state_dict(self):
+        return {
+            'online': self.online,
+            'gamma': self.gamma,
+            'precisions': self.precisions,
+            'anchors': self.anchors,
+            'constants': self.constants,
+            'fishers': self.fishers,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.online = state_dict['online']
+        self.gamma = state_dict['gamma']
+        self.precisions = state_dict['precisions']
+        self.anchors = state_dict['anchors']
+        self.constants = state_dict['constants']
+        self.fishers = state_dict['fishers']
+
+
+class SiPathIntegral(object):
+    """Synaptic Intelligence importance of a fixed set of parameters kept in preallocated buffers
+
+    accumulate() adds the path integral -grad * (theta - theta_prev) of every parameter with in-place
+    foreach ops and allocates no tensors. With accumulate_freq = k only every k-th call accumulates,
+    theta_prev then being the parameters at the previous accumulation.
+    """
+    def __init__(self, named_parameters, epsilon=0.1, accumulate_freq=1):
+        named_parameters = [(name, param) for name, param in named_parameters if param.requires_grad]
+        self.names = [name for name, _ in named_parameters]
+        self.params = [param for _, param in named_parameters]
+        self.epsilon = epsilon
+        self.accumulate_freq = accumulate_freq
+        self.num_calls = 0
+        # buffers are looked up by parameter, names of different networks may collide
+        self._indices = {id(param): idx for idx, param in enumerate(self.params)}
+
+        self.prev_params = [param.detach().clone() for param in self.params]
+        self.prev_task_params = [param.detach().clone() for param in self.params]
+        self.params_w = [torch.zeros_like(param) for param in self.params]
+        self.omegas = [torch.zeros_like(param) for param in self.params]
+
+    @torch.no_grad()
+    def accumulate(self):
+        self.num_calls += 1
+        if self.num_calls % self.accumulate_freq != 0:
+            return
+
+        params, grads, prev_params, params_w = [], [], [], []
+        for idx, param in enumerate(self.params):
+            # parameters without gradient did not move along the loss
+            if param.grad is not None:
+                params.append(param)
+                grads.append(param.grad)
+                prev_params.append(self.prev_params[idx])
+                params_w.append(self.params_w[idx])
+
+        if params:
+            # prev_params hold -grad * (theta - theta_prev) before they are overwritten with theta
+            torch._foreach_sub_(prev_params, params)
+            torch._foreach_mul_(prev_params, grads)
+            torch._foreach_add_(params_w, prev_params)
+        for prev_param, param in zip(self.prev_params, self.params):
+            prev_param.copy_(param)
+
+    @torch.no_grad()
+    def consolidate(self):
+        """Add the importance of the finished task to omegas and anchor the penalty at the current parameters"""
+        for param, prev_task_param, param_w, omega in zip(self.params, self.prev_task_params,
+                                                          self.params_w, self.omegas):
+            delta_param = param - prev_task_param
+            omega.add_(param_w / (delta_param ** 2 + self.epsilon))
+            prev_task_param.copy_(param)
+            # clear importance buffers for the next task
+            param_w.zero_()
+
+    def penalty(self, named_parameters):
+        si_losses = []
+        for _, param in named_parameters:
+            if param.requires_grad:
+                idx = self._indices[id(param)]
+                si_loss = torch.sum(self.omegas[idx] * (param - self.prev_task_params[idx]) ** 2)
+                si_losses.append(si_loss)
+
+        return torch.sum(torch.stack(si_losses))
+
+    def state_dict(self):
+        return {
+            'names': self.names,
+            'num_calls': self.num_calls,
+            'prev_params': self.prev_params,
+            'prev_task_params': self.prev_task_params,
+            'params_w': self.params_w,
+            'omegas': self.omegas,
+        }
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        assert state_dict['names'] == self.names, "parameters of the state_dict do not match"
+        self.num_calls = state_dict['num_calls']
+        for key in ['prev_params', 'prev_task_params', 'params_w', 'omegas']:
+            for dst, src in zip(getattr(self, key), state_dict[key]):
+                dst.copy_(src)
+
+
+class TaskMemoryCache(object):
+    """Episodic memories of all tasks concatenated into one contiguous tensor per field
+
+    update() rebuilds the concatenation only when a memory tensor was replaced (construction, resizing, loading),
+    sample() then draws the minibatches of all tasks with one gather per field.
+    """
+    def __init__(self):
+        self._sources = []
+        self.fields = {}
+        self.sizes = []
+
+    def update(self, sources, task_fields):
+        """sources: the memory tensors, task_fields() is called to rebuild the cache when one was replaced and
+        returns one dict of equally long tensors per task"""
+        sources = list(sources)
+        if len(sources) == len(self._sources) and \
+                all(source is cached for source, cached in zip(sources, self._sources)):
+            return
+
+        self._sources = sources
+        task_fields = task_fields()
+        self.fields = {key: torch.cat([fields[key] for fields in task_fields]) for key in task_fields[0]}
+        self.sizes = [len(next(iter(fields.values()))) for fields in task_fields]
+
+        device = next(iter(self.fields.values())).device
+        self._sizes = torch.as_tensor(self.sizes, device=device)
+        self._offsets = torch.cumsum(self._sizes, dim=0) - self._sizes
+
+    def sample(self, batch_size_per_task, replacement=True):
+        """Dict of (num_tasks * batch_size_per_task, ...) tensors, grouped by task in order"""
+        num_tasks = len(self.sizes)
+        device = self._sizes.device
+        if replacement:
+            idxs = (torch.rand(num_tasks, batch_size_per_task, device=device) * self._sizes[:, None]).long()
+            idxs = torch.minimum(idxs, self._sizes[:, None] - 1)
+        else:
+            assert batch_size_per_task <= min(self.sizes), "not enough samples in a task memory"
+            # the first batch_size_per_task entries of a random permutation of each memory
+            keys = torch.rand(num_tasks, max(self.sizes), device=device)
+            keys.masked_fill_(torch.arange(max(self.sizes), device=device)[None] >= self._sizes[:, None], 2.0)
+            idxs = torch.argsort(keys, dim=1)[:, :batch_size_per_task]
+        idxs = (idxs + self._offsets[:, None]).flatten()
+
+        return {key: field[idxs] for key, field in self.fields.items()}
+
+
+def reservoir_slots(sample_num, total_sample_num, budget, batch_size):
+    """Reservoir sampling of a whole minibatch with one random draw
+
+    Returns the indices of the samples to store and their memory slots. When several samples draw the same slot,
+    only the last one is kept, as if they had been inserted one by one.
+    """
+    idxs = np.arange(batch_size)
+    num_fill = min(max(budget - sample_num, 0), batch_size)
+    slots = np.empty(batch_size, dtype=np.int64)
+    slots[:num_fill] = sample_num + idxs[:num_fill]
+    # the i-th sample of the batch is the (total_sample_num + i + 1)-th sample seen
+    slots[num_fill:] = np.random.randint(0, total_sample_num + idxs[num_fill:] + 1)
+
+    keep = slots < budget
+    idxs, slots = idxs[keep], slots[keep]
+    _, last = np.unique(slots[::-1], return_index=True)
+    last = len(slots) - 1 - last
+
+    return idxs[last], slots[last]
+
+
+class WeightBroadcast(object):
+    """State dict of a module (e.g. an actor) in shared memory, published by one process and loaded by others
+
+    The tensors are packed into one shared buffer guarded by a seqlock: the sequence number is odd while
+    publish() writes and is bumped to the next even number afterwards, version = sequence // 2. load() copies
+    the buffer into a module with load_state_dict() and retries if a publish() overlapped the copy, so readers
+    never block the writer. Readers already at the latest version return without copying. Pass the broadcast
+    to a torch.multiprocessing process (e.g. as a Process argument) to attach it to the same memory.
+    """
+    def __init__(self, module):
+        state_dict = module.state_dict()
+        dtypes = {tensor.dtype for tensor in state_dict.values()}
+        assert len(dtypes) == 1, "state dict tensors must share one dtype"
+
+        self._shapes = [(name, tensor.shape) for name, tensor in state_dict.items()]
+        self._data = torch.cat([tensor.detach().cpu().flatten() for tensor in state_dict.values()]).share_memory_()
+        self._seq = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._bind()
+
+    def _bind(self):
+        self._seq_view = self._seq.numpy()
+        self._state_dict = {}
+        offset = 0
+        for name, shape in self._shapes:
+            num_elements = shape.numel()
+            self._state_dict[name] = self._data[offset:offset + num_elements].view(shape)
+            offset += num_elements
+        # sequence number of the snapshot loaded by this process
+        self._loaded_seq = -1
+
+    @property
+    def version(self):
+        return int(self._seq_view[0]) // 2
+
+    def publish(self, module):
+        """Write the state dict of module and bump the version, only one process may publish"""
+        # gather on the module's device first so that the critical section is a single copy
+        data = torch.cat([tensor.detach().flatten() for tensor in module.state_dict().values()]).cpu()
+
+        self._seq_view[0] += 1
+        self._data.copy_(data)
+        self._seq_view[0] += 1
+
+    def load(self, module):
+        """Load the latest consistent snapshot into module, returns False if it was already loaded"""
+        while True:
+            seq = int(self._seq_view[0])
+            if seq == self._loaded_seq:
+                return False
+            if seq % 2 == 1:
+                time.sleep(0)
+                continue
+
+            module.load_state_dict(self._state_dict)
+            if int(self._seq_view[0]) == seq:
+                self._loaded_seq = seq
+                return True
+
+    def __getstate__(self):
+        return {'_shapes': self._shapes, '_data': self._data, '_seq': self._seq}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bind()
+
+
 def get_curl_pos_neg(obs, replay_buffer):
     """Returns one positive pair + batch of negative samples from buffer"""
     obs = torch.as_tensor(obs).cuda().float().unsqueeze(0)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('kornia')
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [SRC_DIR, os.path.dirname(SRC_DIR)]
+
+import gym
+import numpy as np
+import torch
+
+import buffers
+from agent.sac.agem_sac_agent import AgemSacMlpAgent
+from agent.sac.agem_mh_sac_agent import AgemMultiHeadSacMlpAgent
+
+
+class _NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+
+def _filled_buffer(obs_dim, action_dim, num_steps=64):
+    replay_buffer = buffers.ReplayBuffer(gym.spaces.Box(-1, 1, (obs_dim,)), gym.spaces.Box(-1, 1, (action_dim,)),
+                                         capacity=num_steps, device=torch.device('cpu'))
+    for _ in range(num_steps):
+        replay_buffer.add(np.random.randn(obs_dim), np.random.uniform(-1, 1, action_dim), np.random.randn(),
+                          np.random.randn(obs_dim), False, [{}])
+
+    return replay_buffer
+
+
+@pytest.mark.parametrize('multi_head', [False, True])
+def test_update_after_construct_memory(multi_head):
+    """Projections against the memory (including the 0-d log_alpha gradient) run on the default path"""
+    if multi_head:
+        agent = AgemMultiHeadSacMlpAgent((5,), [(3,), (3,)], [[-1, 1], [-1, 1]], torch.device('cpu'),
+                                         actor_hidden_dim=16, critic_hidden_dim=16, actor_update_freq=1,
+                                         batch_size=8, agem_memory_budget=32, agem_ref_grad_batch_size=8)
+        kwargs = {'head_idx': 0}
+    else:
+        agent = AgemSacMlpAgent((5,), (3,), [-1, 1], torch.device('cpu'),
+                                actor_hidden_dim=16, critic_hidden_dim=16, actor_update_freq=1,
+                                batch_size=8, agem_memory_budget=32, agem_ref_grad_batch_size=8)
+        kwargs = {}
+    replay_buffer = _filled_buffer(5, 3)
+
+    agent.construct_memory(replay_buffer)
+    for step in range(2):
+        agent.update(replay_buffer, _NullLogger(), step, **kwargs)
@@ -0,0 +1,89 @@
+import contextlib
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('kornia')
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [SRC_DIR, os.path.dirname(SRC_DIR)]
+
+import gym
+import numpy as np
+import torch
+
+import buffers
+
+
+def test_take_rejects_out_of_range_indices():
+    arr = np.arange(12, dtype=np.float32).reshape(2, 2, 3)
+    out = np.empty((1, 3), dtype=np.float32)
+
+    assert np.array_equal(buffers.ReplayBuffer._take(arr, np.array([3]), out), [[9, 10, 11]])
+    with pytest.raises(IndexError):
+        buffers.ReplayBuffer._take(arr, np.array([4]), out)
+
+
+class _CountingSampling:
+    """Mixin counting how often sampling enters the _sampling() guard"""
+    num_sampling = 0
+
+    @contextlib.contextmanager
+    def _sampling(self):
+        self.num_sampling += 1
+        yield
+
+
+def _fill(replay_buffer, num_steps):
+    for _ in range(num_steps):
+        replay_buffer.add(np.random.randn(5), np.random.uniform(-1, 1, 3), np.random.randn(),
+                          np.random.randn(5), False, [{}])
+
+
+def test_task_partitioned_sample_takes_the_sampling_guard():
+    class Buffer(_CountingSampling, buffers.TaskPartitionedReplayBuffer):
+        pass
+
+    replay_buffer = Buffer(gym.spaces.Box(-1, 1, (5,)), gym.spaces.Box(-1, 1, (3,)), capacity=32,
+                           device=torch.device('cpu'), num_tasks=2)
+    replay_buffer.set_task(0)
+    _fill(replay_buffer, 8)
+
+    replay_buffer.sample(4)
+    replay_buffer.sample(4, task_ids=[0])
+
+    assert replay_buffer.num_sampling == 2
+
+
+def test_prioritized_sample_with_weights_takes_the_sampling_guard():
+    class Buffer(_CountingSampling, buffers.PrioritizedReplayBuffer):
+        pass
+
+    replay_buffer = Buffer(gym.spaces.Box(-1, 1, (5,)), gym.spaces.Box(-1, 1, (3,)), capacity=32,
+                           device=torch.device('cpu'))
+    _fill(replay_buffer, 8)
+
+    replay_buffer.sample(4)
+    *_, weights, idxs = replay_buffer.sample(4, return_weights=True)
+
+    assert replay_buffer.num_sampling == 2
+    assert weights.shape == (4, 1) and idxs.shape == (4,)
+
+
+def test_sample_raises_when_prefetching_fails():
+    class Buffer(buffers.ReplayBuffer):
+        def _gather(self, idxs, env_idxs, out=None):
+            raise ValueError("gather failed")
+
+    replay_buffer = Buffer(gym.spaces.Box(-1, 1, (5,)), gym.spaces.Box(-1, 1, (3,)), capacity=32,
+                           device=torch.device('cpu'))
+    _fill(replay_buffer, 8)
+
+    replay_buffer.start_prefetch(4)
+    try:
+        with pytest.raises(RuntimeError) as exc_info:
+            replay_buffer.sample(4)
+        assert isinstance(exc_info.value.__cause__, ValueError)
+    finally:
+        replay_buffer.stop_prefetch()
@@ -0,0 +1,50 @@
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [SRC_DIR, os.path.dirname(SRC_DIR)]
+
+import torch
+
+import utils
+
+
+def _assert_bound(module, flat_params):
+    for param, grad_view in zip(module.parameters(), flat_params._grad_views):
+        assert param.grad is grad_view
+
+
+def test_grads_stay_views_of_the_buffer():
+    module = torch.nn.Linear(3, 2)
+    flat_params = utils.FlatParams(module.parameters())
+    optimizer = torch.optim.SGD(module.parameters(), lr=0.1)
+    utils.FlatParams.zero_grad_in_place(optimizer)
+
+    for _ in range(2):
+        optimizer.zero_grad()
+        module(torch.ones(4, 3)).sum().backward()
+        _assert_bound(module, flat_params)
+        assert torch.equal(flat_params.grad, torch.full((8,), 4.0))
+        optimizer.step()
+
+
+def test_grads_reset_to_none_are_moved_into_the_buffer():
+    module = torch.nn.Linear(3, 2)
+    flat_params = utils.FlatParams(module.parameters())
+    optimizer = torch.optim.SGD(module.parameters(), lr=0.1)
+
+    optimizer.zero_grad(set_to_none=True)
+    module(torch.ones(4, 3)).sum().backward()
+
+    _assert_bound(module, flat_params)
+    assert torch.equal(flat_params.grad, torch.full((8,), 4.0))
+
+
+def test_assign_grads():
+    module = torch.nn.Linear(3, 2)
+    flat_params = utils.FlatParams(module.parameters())
+
+    utils.assign_grads(list(module.parameters()), [torch.ones(2, 3), None])
+
+    _assert_bound(module, flat_params)
+    assert torch.equal(flat_params.grad, torch.tensor([1.0] * 6 + [0.0] * 2))
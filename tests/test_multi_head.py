@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('kornia')
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [SRC_DIR, os.path.dirname(SRC_DIR)]
+
+import gym
+import numpy as np
+import torch
+
+import buffers
+from agent.sac import MultiHeadSacMlpAgent, MultiInputSacMlpAgentV2
+
+
+class _NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+
+def _head_state(module, head_idx):
+    return {name: param[head_idx].detach().clone() for name, param in module.named_parameters()
+            if getattr(param, '_stacked_heads', False)}
+
+
+@pytest.mark.parametrize('agent_cls', [MultiHeadSacMlpAgent, MultiInputSacMlpAgentV2])
+def test_finished_head_is_left_untouched(agent_cls):
+    """The head of a finished task stays bit-identical while the head of the next task is trained"""
+    torch.manual_seed(0)
+    replay_buffer = buffers.ReplayBuffer(gym.spaces.Box(-1, 1, (5,)), gym.spaces.Box(-1, 1, (3,)),
+                                         capacity=64, device=torch.device('cpu'))
+    for _ in range(64):
+        replay_buffer.add(np.random.randn(5), np.random.uniform(-1, 1, 3), np.random.randn(),
+                          np.random.randn(5), False, [{}])
+    agent = agent_cls((5,), [(3,), (3,)], [[-1, 1], [-1, 1]], torch.device('cpu'),
+                      actor_hidden_dim=16, critic_hidden_dim=16, actor_update_freq=1, batch_size=8)
+
+    for step in range(10):
+        agent.update(replay_buffer, _NullLogger(), step, head_idx=0)
+    actor_head, critic_head = _head_state(agent.actor, 0), _head_state(agent.critic, 0)
+    for step in range(10, 20):
+        agent.update(replay_buffer, _NullLogger(), step, head_idx=1)
+
+    assert actor_head
+    for expected, actual in [(actor_head, _head_state(agent.actor, 0)), (critic_head, _head_state(agent.critic, 0))]:
+        for name in expected:
+            assert torch.equal(expected[name], actual[name]), name
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('kornia')
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [SRC_DIR, os.path.dirname(SRC_DIR)]
+
+import gym
+import numpy as np
+import torch
+
+import buffers
+from agent.sac import SacMlpAgent, EwcSacMlpAgent, SiSacMlpAgent, AgemSacMlpAgent
+
+
+class _NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+
+@pytest.mark.parametrize('agent_cls', [SacMlpAgent, EwcSacMlpAgent, SiSacMlpAgent, AgemSacMlpAgent])
+def test_update_sets_priorities(agent_cls):
+    """Every SAC agent samples with importance weights and writes the TD errors back as priorities"""
+    replay_buffer = buffers.PrioritizedReplayBuffer(gym.spaces.Box(-1, 1, (5,)), gym.spaces.Box(-1, 1, (3,)),
+                                                    capacity=64, device=torch.device('cpu'))
+    for _ in range(64):
+        replay_buffer.add(np.random.randn(5), np.random.uniform(-1, 1, 3), np.random.randn(),
+                          np.random.randn(5), False, [{}])
+    # all transitions start with the same (maximum) priority
+    initial_total = replay_buffer.sum_tree.total
+
+    kwargs = {'agem_memory_budget': 32, 'agem_ref_grad_batch_size': 8} if agent_cls is AgemSacMlpAgent else {}
+    agent = agent_cls((5,), (3,), [-1, 1], torch.device('cpu'), actor_hidden_dim=16, critic_hidden_dim=16,
+                      batch_size=8, **kwargs)
+    if agent_cls is AgemSacMlpAgent:
+        agent.construct_memory(replay_buffer)
+    agent.update(replay_buffer, _NullLogger(), 0)
+
+    assert replay_buffer.sum_tree.total != initial_total
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('kornia')
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [SRC_DIR, os.path.dirname(SRC_DIR)]
+
+import gym
+import numpy as np
+import torch
+
+import buffers
+from agent.sac import SacMlpAgent
+
+
+class _NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+
+@pytest.mark.parametrize('buffer_cls', [buffers.ReplayBuffer, buffers.PrioritizedReplayBuffer])
+@pytest.mark.parametrize('fused_update', [False, True])
+def test_update_with_three_critics(buffer_cls, fused_update):
+    """Target values, critic and actor losses take all q-functions of the ensemble"""
+    replay_buffer = buffer_cls(gym.spaces.Box(-1, 1, (5,)), gym.spaces.Box(-1, 1, (3,)),
+                               capacity=64, device=torch.device('cpu'))
+    for _ in range(64):
+        replay_buffer.add(np.random.randn(5), np.random.uniform(-1, 1, 3), np.random.randn(),
+                          np.random.randn(5), False, [{}])
+    agent = SacMlpAgent((5,), (3,), [-1, 1], torch.device('cpu'), actor_hidden_dim=16, critic_hidden_dim=16,
+                        actor_update_freq=1, batch_size=8, fused_update=fused_update, num_critics=3)
+    critic_state = {name: param.detach().clone() for name, param in agent.critic.named_parameters()}
+
+    for step in range(2):
+        agent.update(replay_buffer, _NullLogger(), step)
+
+    assert agent.critic.forward_ensemble(torch.zeros(2, 5), torch.zeros(2, 3)).shape == (3, 2, 1)
+    for name, param in agent.critic.named_parameters():
+        # every member of the ensemble is trained
+        assert (param - critic_state[name]).flatten(1).abs().sum(dim=1).gt(0).all(), name